@@ -0,0 +1,182 @@
+"""
+Measures the turns by second and the cost by particle pair of every engine backend.
+
+    python benchmarks/engines.py --particles 100 300 1000 --cores 1 2 4 --output before.json
+    python benchmarks/engines.py --particles 100 300 1000 --cores 1 2 4 --output after.json --compare before.json
+"""
+import json
+import os
+import platform
+import random
+import sys
+from argparse import ArgumentParser, Namespace
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from itertools import product
+from time import perf_counter
+from typing import List, Dict, Any, Callable, Optional
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from newchanic.array_engine import ArrayEngine  # noqa: E402
+from newchanic.distributed import DistributedPool  # noqa: E402
+from newchanic.engine import Engine  # noqa: E402
+from newchanic.laws import Gravity, Merge  # noqa: E402
+from newchanic.multicore import WorkerPool  # noqa: E402
+from newchanic.solvers import BarnesHutSolver  # noqa: E402
+from newchanic.utils import random_between  # noqa: E402
+from newchanic.v2 import engine as v2  # noqa: E402
+
+LAW_SETS = {"gravity": (Gravity,), "gravity+merge": (Gravity, Merge)}
+
+
+def build_v1_engine(engine_type, solver=None, **kwargs) -> Callable[[int, tuple], Engine]:
+    def build(particle_nbr: int, laws: tuple) -> Engine:
+        return engine_type(
+            particle_number=particle_nbr,
+            force_generators=tuple(law() for law in laws if law is Gravity),
+            arbitrary_laws=tuple(law() for law in laws if law is Merge),
+            solver=solver,
+            **kwargs,
+        )
+
+    return build
+
+
+def build_v2_engine(particle_nbr: int, laws: tuple) -> v2.Engine:
+    if Merge in laws:
+        raise NotImplementedError("The v2 engine has no merge law")
+    engine = v2.Engine()
+    engine.laws = [v2.Gravity()]
+    for _ in range(particle_nbr):
+        particle = v2.Particle()
+        position = [random_between(-1000, 1000), random_between(-500, 500), random_between(-500, 500)]
+        particle.MASS = random_between(10, 100)
+        particle._position = position
+        particle.position = position
+        particle.update()
+        engine.particles.append(particle)
+    return engine
+
+
+# name: (engine factory, pool of the workers running on several cores or None for single core backends)
+BACKENDS = {
+    "objects": (build_v1_engine(Engine), None),
+    "objects-multicore": (build_v1_engine(Engine), WorkerPool),
+    "arrays": (build_v1_engine(ArrayEngine), None),
+    "arrays-multicore": (build_v1_engine(ArrayEngine), WorkerPool),
+    "arrays-float32": (build_v1_engine(ArrayEngine, dtype=np.float32), None),
+    "arrays-multicore-float32": (build_v1_engine(ArrayEngine, dtype=np.float32), WorkerPool),
+    "arrays-distributed": (build_v1_engine(ArrayEngine), DistributedPool),
+    "arrays-barnes-hut": (build_v1_engine(ArrayEngine, BarnesHutSolver()), None),
+    "v2": (build_v2_engine, None),
+}
+
+
+def measure(backend: str, particle_nbr: int, core_nbr: int, law_set: str, arguments: Namespace) -> Dict[str, Any]:
+    result = {"backend": backend, "particles": particle_nbr, "cores": core_nbr, "laws": law_set}
+    build, pool_type = BACKENDS[backend]
+    random.seed(arguments.seed)
+    np.random.seed(arguments.seed)
+    try:
+        engine = build(particle_nbr, LAW_SETS[law_set])
+        # The workers of parallel backends are started once, their start-up time is reported apart from the turns
+        start = perf_counter()
+        with engine.build_pool(pool_type, core_nbr) if pool_type is not None else nullcontext() as pool:
+            pool_start_seconds = perf_counter() - start
+
+            def run(max_turns: int, max_seconds: Optional[float] = None) -> int:
+                if pool is not None:
+                    return engine.run_with_pool(pool, max_turns=max_turns, max_seconds=max_seconds)
+                return engine.run(max_turns=max_turns, max_seconds=max_seconds)
+
+            run(arguments.warmup_turns)
+            start = perf_counter()
+            turn_number = run(arguments.turns, arguments.max_seconds)
+            duration = perf_counter() - start
+    except Exception as e:
+        result["error"] = f"{e.__class__.__name__}: {e}"
+        return result
+    seconds_by_turn = duration / max(turn_number, 1)
+    result.update(
+        turns=turn_number,
+        seconds=duration,
+        turns_per_second=turn_number / duration if duration else None,
+        seconds_per_pair=seconds_by_turn / max(particle_nbr * (particle_nbr - 1) / 2, 1),
+        pool_start_seconds=pool_start_seconds if pool_type is not None else None,
+    )
+    return result
+
+
+def get_metadata(arguments: Namespace) -> Dict[str, Any]:
+    return {
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "seed": arguments.seed,
+        "turns": arguments.turns,
+        "warmup_turns": arguments.warmup_turns,
+    }
+
+
+def load_reference(reference_path: str) -> Dict[tuple, Dict[str, Any]]:
+    with open(reference_path) as file:
+        results = json.load(file)["results"]
+    return {(r["backend"], r["particles"], r["cores"], r["laws"]): r for r in results if "error" not in r}
+
+
+def compare(results: List[Dict[str, Any]], reference: Dict[tuple, Dict[str, Any]], reference_path: str):
+    print(f"\nCompared to {reference_path} (ratio > 1 means faster now)")
+    for result in results:
+        key = (result["backend"], result["particles"], result["cores"], result["laws"])
+        if "error" in result or key not in reference:
+            continue
+        ratio = result["turns_per_second"] / reference[key]["turns_per_second"]
+        print(f"{' '.join(map(str, key)):<50} {ratio:8.2f}")
+
+
+def parse_arguments(arguments: List[str] = None) -> Namespace:
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backends", nargs="+", choices=tuple(BACKENDS), default=list(BACKENDS))
+    parser.add_argument("--particles", nargs="+", type=int, default=[100, 300, 1000])
+    parser.add_argument("--cores", nargs="+", type=int, default=[2, 4], help="core or node counts of parallel backends")
+    parser.add_argument("--laws", nargs="+", choices=tuple(LAW_SETS), default=list(LAW_SETS))
+    parser.add_argument("--turns", type=int, default=5, help="measured turns by case")
+    parser.add_argument("--warmup-turns", type=int, default=1, help="turns run before measuring")
+    parser.add_argument("--max-seconds", type=float, default=30, help="time budget of a single case")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json", help="JSON file receiving the results")
+    parser.add_argument("--compare", default=None, help="previous JSON results to compare with")
+    return parser.parse_args(arguments)
+
+
+def main(arguments: List[str] = None):
+    arguments = parse_arguments(arguments)
+    # The reference is read first since it may be the file the results are written to
+    reference = load_reference(arguments.compare) if arguments.compare else None
+    results = []
+    for backend, particle_nbr, law_set in product(arguments.backends, arguments.particles, arguments.laws):
+        for core_nbr in arguments.cores if BACKENDS[backend][1] is not None else [1]:
+            result = measure(backend, particle_nbr, core_nbr, law_set, arguments)
+            results.append(result)
+            if "error" in result:
+                print(f"{backend:<20} {particle_nbr:>7} {core_nbr:>3} {law_set:<15} {result['error']}")
+            else:
+                pool_start = result["pool_start_seconds"]
+                print(
+                    f"{backend:<20} {particle_nbr:>7} {core_nbr:>3} {law_set:<15} "
+                    f"{result['turns_per_second']:10.3f} turns/s {result['seconds_per_pair']:.3e} s/pair"
+                    + (f" {pool_start:.3f} s pool start" if pool_start is not None else "")
+                )
+    with open(arguments.output, "w") as file:
+        json.dump({"metadata": get_metadata(arguments), "results": results}, file, indent=2, sort_keys=True)
+    if reference is not None:
+        compare(results, reference, arguments.compare)
+
+
+if __name__ == "__main__":
+    main()
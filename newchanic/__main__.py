@@ -1,20 +1,188 @@
+from argparse import ArgumentParser, Namespace
+from random import seed
 from time import time
+from typing import List
 
-from newchanic.graphical_engine import GraphicalEngine2D
-from newchanic.laws import Gravity
+from newchanic.array_engine import ArrayEngine
+from newchanic.checkpoint import AutoCheckpoint, load_checkpoint
+from newchanic.engine import Engine
+from newchanic.integrators import EulerIntegrator, LeapfrogIntegrator, BlockTimestepIntegrator
+from newchanic.initial_conditions import GENERATORS
+from newchanic.instrumentation import Instrumentation, CsvSink, JsonLinesSink
+from newchanic.laws import Gravity, Merge
+from newchanic.solvers import DirectSolver, BarnesHutSolver, ParticleMeshSolver
+from newchanic.streaming import StreamingServer
+from newchanic.trajectory import TrajectoryRecorder
 
-if __name__ == "__main__":
+LAWS = {"gravity": Gravity, "merge": Merge}
+SOLVERS = {
+    "pairwise": lambda _: None,
+    "direct": lambda _: DirectSolver(),
+    "barnes-hut": lambda arguments: BarnesHutSolver(arguments.theta),
+    "particle-mesh": lambda arguments: ParticleMeshSolver(
+        arguments.grid_size,
+        "periodic" if arguments.box_size else "isolated",
+        arguments.box_size,
+        (-arguments.box_size / 2,) * 3 if arguments.box_size else None,
+        arguments.short_range,
+    ),
+}
+
+INTEGRATORS = {
+    "euler": lambda arguments: EulerIntegrator(arguments.dt),
+    "leapfrog": lambda arguments: LeapfrogIntegrator(arguments.dt),
+    "block": lambda arguments: BlockTimestepIntegrator(arguments.dt, arguments.max_level, arguments.eta),
+}
+
+
+def parse_arguments(arguments: List[str] = None) -> Namespace:
+    parser = ArgumentParser(prog="newchanic", description="Simulate a universe powered by Newton's mechanic")
+    parser.add_argument("--engine", choices=("objects", "arrays"), default="arrays", help="particle storage backend")
+    parser.add_argument("--solver", choices=tuple(SOLVERS), default="direct", help="gravity solver")
+    parser.add_argument("--theta", type=float, default=0.5, help="opening angle of the Barnes-Hut solver")
+    parser.add_argument("--grid-size", type=int, default=64, help="particle-mesh solver: nodes along each axis")
+    parser.add_argument(
+        "--box-size",
+        type=float,
+        default=None,
+        help="particle-mesh solver: side of a periodic box centered on the origin, isolated boundaries without it",
+    )
+    parser.add_argument(
+        "--short-range", action="store_true", help="particle-mesh solver: add the forces between close pairs (P3M)"
+    )
+    parser.add_argument(
+        "--integrator", choices=tuple(INTEGRATORS), default="euler", help="time integration scheme of the arrays engine"
+    )
+    parser.add_argument("--dt", type=float, default=1.0, help="timestep of a turn")
+    parser.add_argument("--max-level", type=int, default=8, help="block integrator: substeps go down to dt / 2**level")
+    parser.add_argument("--eta", type=float, default=0.05, help="block integrator: accuracy of the timestep criterion")
+    parser.add_argument(
+        "--precision",
+        choices=("float64", "float32"),
+        default="float64",
+        help="storage precision of the arrays engine, of its exchanges with the workers and of the recordings",
+    )
+    parser.add_argument("--particles", type=int, default=100, help="number of particles")
+    parser.add_argument(
+        "--initial-conditions",
+        choices=tuple(GENERATORS),
+        default=None,
+        help="generate the particles in bulk from this distribution instead of one by one",
+    )
+    parser.add_argument("--laws", nargs="+", choices=tuple(LAWS), default=["gravity"], help="laws to apply")
+    parser.add_argument("--cores", type=int, default=1, help="number of worker processes, 1 runs in this process")
+    parser.add_argument("--nodes", type=int, default=None, help="number of TCP workers of a distributed run")
+    parser.add_argument(
+        "--listen", default="127.0.0.1:0", help="HOST:PORT the workers of a distributed run connect to"
+    )
+    parser.add_argument(
+        "--remote-workers",
+        action="store_true",
+        help="do not start the workers, run python -m newchanic.distributed HOST PORT on the nodes instead",
+    )
+    parser.add_argument(
+        "--domain-theta", type=float, default=0.0, help="send far domains as monopoles to the workers, 0 is exact"
+    )
+    parser.add_argument("--turns", type=int, default=None, help="stop after this number of turns")
+    parser.add_argument("--seconds", type=float, default=None, help="stop after this number of seconds")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the initial conditions")
+    parser.add_argument(
+        "--profile", default=None, help="write the per-turn phase timings and counters to this .csv or .jsonl file"
+    )
+    parser.add_argument("--record", default=None, help="record the trajectories of the particles in this file")
+    parser.add_argument("--replay", default=None, help="play a file written with --record instead of simulating")
+    parser.add_argument("--checkpoint", default=None, help="periodically save the engine state in this file")
+    parser.add_argument("--checkpoint-every", type=int, default=1000, help="turns between two checkpoints")
+    parser.add_argument("--resume", default=None, help="start from a file written with --checkpoint")
+    parser.add_argument("--stream", default=None, help="HOST:PORT streaming the positions to TCP and WebSocket clients")
+    parser.add_argument("--stream-fps", type=float, default=30, help="frames sent by second to every stream client")
+    parser.add_argument("--render", action="store_true", help="display the simulation in a window")
+    parser.add_argument(
+        "--fps", type=float, default=60, help="frames drawn by second while the physics runs aside, 0 draws every turn"
+    )
+    return parser.parse_args(arguments)
+
+
+def build_engine(arguments: Namespace) -> Engine:
+    if arguments.seed is not None:
+        seed(arguments.seed)
+    laws = [LAWS[name]() for name in arguments.laws]
+    kwargs = dict(
+        particle_number=arguments.particles,
+        force_generators=tuple(law for law in laws if isinstance(law, Gravity)),
+        arbitrary_laws=tuple(law for law in laws if isinstance(law, Merge)),
+        solver=SOLVERS[arguments.solver](arguments),
+    )
+    if arguments.initial_conditions is not None:
+        kwargs["initial_conditions"] = GENERATORS[arguments.initial_conditions](arguments.particles, seed=arguments.seed)
+    if arguments.engine == "arrays":
+        kwargs["integrator"] = INTEGRATORS[arguments.integrator](arguments)
+        kwargs["dtype"] = arguments.precision
+    elif arguments.integrator != "euler" or arguments.dt != 1:
+        raise SystemExit("Only the arrays engine supports --integrator and --dt")
+    elif arguments.precision != "float64":
+        raise SystemExit("Only the arrays engine supports --precision")
+    if arguments.profile is not None:
+        sink_type = CsvSink if arguments.profile.endswith(".csv") else JsonLinesSink
+        kwargs["instrumentation"] = Instrumentation([sink_type(arguments.profile)])
+    if arguments.render:
+        # pygame is only imported when a window is requested, so that headless nodes do not need a display
+        from newchanic.graphical_engine import GraphicalEngine2D, GraphicalArrayEngine2D
 
-    def main():
-        engine = GraphicalEngine2D(
-            graphical_options={},
-            particle_number=100,
-            force_generators=(Gravity(),),
-            # arbitrary_laws=(Merge(),)
-        )
-        start = time()
-        # turn_number = engine.run()
-        turn_number = engine.run_multiprocess(8)
-        print(f"{round((time() - start) / turn_number, 3)} seconds by turn")
+        engine_type = GraphicalArrayEngine2D if arguments.engine == "arrays" else GraphicalEngine2D
+        engine = engine_type(graphical_options={}, frames_per_second=arguments.fps or None, **kwargs)
+    else:
+        engine = (ArrayEngine if arguments.engine == "arrays" else Engine)(**kwargs)
+    if arguments.resume is not None:
+        load_checkpoint(engine, arguments.resume)
+    if arguments.record is not None:
+        engine.features["record"] = TrajectoryRecorder(arguments.record, record_masses=True, dtype=engine.dtype)
+    if arguments.stream is not None:
+        host, port = arguments.stream.rsplit(":", 1)
+        engine.features["stream"] = StreamingServer(host, int(port), max_fps=arguments.stream_fps)
+        print(f"Streaming on {':'.join(map(str, engine.features['stream'].address))}")
+    if arguments.checkpoint is not None:
+        engine.features["checkpoint"] = AutoCheckpoint(arguments.checkpoint, every=arguments.checkpoint_every)
+    return engine
 
+
+def main(arguments: List[str] = None):
+    arguments = parse_arguments(arguments)
+    if arguments.replay is not None:
+        from newchanic.graphical_engine import GraphicalReplay2D
+
+        GraphicalReplay2D(arguments.replay, graphical_options={}).run(max_turns=arguments.turns)
+        return
+    if not arguments.render and arguments.turns is None and arguments.seconds is None:
+        raise SystemExit("A headless run needs --turns or --seconds")
+    engine = build_engine(arguments)
+    start = time()
+    try:
+        if arguments.nodes is not None:
+            host, port = arguments.listen.rsplit(":", 1)
+            turn_number = engine.run_distributed(
+                arguments.nodes,
+                max_turns=arguments.turns,
+                max_seconds=arguments.seconds,
+                address=(host, int(port)),
+                spawn_workers=not arguments.remote_workers,
+                theta=arguments.domain_theta,
+            )
+        elif arguments.cores > 1:
+            turn_number = engine.run_multicore(
+                arguments.cores, max_turns=arguments.turns, max_seconds=arguments.seconds
+            )
+        else:
+            turn_number = engine.run(max_turns=arguments.turns, max_seconds=arguments.seconds)
+    finally:
+        engine.instrumentation.close()
+        if "record" in engine.features:
+            engine.features["record"].close()
+        if "stream" in engine.features:
+            engine.features["stream"].close()
+    duration = max(time() - start, 1e-9)
+    print(f"{turn_number} turns in {round(duration, 3)} seconds, {round(turn_number / duration, 3)} turns by second")
+
+
+if __name__ == "__main__":
     main()
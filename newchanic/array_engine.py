@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+from time import time
+from typing import List, Type, Dict, Any, Callable, Set, Tuple, Optional
+
+import numpy as np
+
+from newchanic.engine import Engine, RemoveFeature
+from newchanic.initial_conditions import from_callables
+from newchanic.integrators import Integrator, EulerIntegrator
+from newchanic.multicore import WorkerPool
+from newchanic.physics import ArrayParticle, ParticleStore
+from newchanic.solvers import ForceSolver, DirectSolver, DEFAULT_BLOCK_SIZE, compute_block_accelerations
+from newchanic.utils import Number, iter_unique_pairs
+
+
+class ArrayRemoveFeature(RemoveFeature):
+    # Removed particles are tombstoned in the store, which is only compacted once the dead particles are more than
+    # compaction_threshold of its slots, so that the cost of the removals stays proportional to their number
+    def __call__(self, engine: ArrayEngine):
+        if self.particles_to_remove:
+            engine.store.remove(self.particles_to_remove)
+            if engine.store.dead_nbr > engine.compaction_threshold * len(engine.store):
+                with engine.instrumentation.phase("compaction"):
+                    engine.compact()
+        super().__call__(engine)
+
+
+class ArrayEngine(Engine):
+    def __init__(
+        self,
+        *args,
+        particle_type: Type[ArrayParticle] = ArrayParticle,
+        solver: ForceSolver = None,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        integrator: Integrator = None,
+        compaction_threshold: float = 0.25,
+        dtype: np.dtype = np.float64,
+        **kwargs,
+    ):
+        assert 0 <= compaction_threshold <= 1, "compaction_threshold must be between 0 and 1"
+        self.store: ParticleStore
+        self.integrator = integrator or EulerIntegrator()
+        self.compaction_threshold = compaction_threshold
+        # Single precision halves the memory and the exchanges with the workers, forces are summed in double precision
+        self.dtype = np.dtype(dtype)
+        self.block_size = block_size
+        self._pool: Optional[WorkerPool] = None
+        super().__init__(*args, particle_type=particle_type, solver=solver or DirectSolver(block_size), **kwargs)
+        self.features["remove"] = ArrayRemoveFeature()
+
+    def init_particles(
+        self,
+        particle_nbr: int,
+        particle_type: Type[ArrayParticle],
+        particle_kwargs: Dict[str, Any],
+        get_mass: Callable[[int], Number],
+        get_position: Callable[[int], List[Number]],
+        get_velocity: Callable[[int], List[Number]],
+    ) -> Set[ArrayParticle]:
+        return set(self.build_particles(*from_callables(particle_nbr, get_mass, get_position, get_velocity)))
+
+    def build_particle_views(
+        self, particle_type: Type[ArrayParticle], particle_kwargs: Dict[str, Any]
+    ) -> List[ArrayParticle]:
+        if particle_type.__init__ is ArrayParticle.__init__ and not particle_kwargs:
+            # The store is already filled, views are built without writing the values back into it
+            return [particle_type.view(self.store, i) for i in range(len(self.store))]
+        return [
+            particle_type(
+                mass=self.store.masses[i],
+                position=self.store.positions[i],
+                velocity=self.store.velocities[i],
+                store=self.store,
+                index=i,
+                **(particle_kwargs or {}),
+            )
+            for i in range(len(self.store))
+        ]
+
+    def get_dimension_nbr(self) -> int:
+        return self.store.positions.shape[1]
+
+    def get_capacity(self) -> int:
+        return len(self.store)
+
+    def compact(self):
+        # Indexes of the particles change, ids do not
+        self.store.compact()
+        if self.neighbour_list is not None:
+            self.neighbour_list.invalidate()
+
+    def filter_pairs(self, first: np.ndarray, second: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        if not self.store.dead_nbr:
+            return first, second
+        alive = self.store.alive[first] & self.store.alive[second]
+        return first[alive], second[alive]
+
+    def run_with_pool(self, pool: WorkerPool, max_turns: int = None, max_seconds: Number = None) -> int:
+        # The store lives in the arrays of the pool during the run, so nothing has to be copied for the workers
+        self.store.bind(pool.state.masses, pool.state.positions, pool.state.velocities)
+        self._pool = pool
+        i = 0
+        start = time()
+        try:
+            while self.must_continue(i, start, max_turns, max_seconds):
+                self.apply_laws()
+                self.finish_turn()
+                i += 1
+        finally:
+            self._pool = None
+            self.store.bind(self.store.masses.copy(), self.store.positions.copy(), self.store.velocities.copy())
+        return i
+
+    def run(self, max_turns: int = None, max_seconds: Number = None) -> int:
+        start = time()
+        i = 0
+        while self.must_continue(i, start, max_turns, max_seconds):
+            self.apply_laws()
+            self.finish_turn()
+            i += 1
+        return i
+
+    def apply_laws(self):
+        # Forces are not applied here but by the integrator, once the pending updates of the turn have been applied
+        instrumentation = self.instrumentation
+        with instrumentation.phase("local_laws"):
+            self.apply_local_arbitrary_laws(self.store.particles, self.store.positions)
+        if self.global_arbitrary_laws:
+            particles = self.store.get_alive_particles()
+            with instrumentation.phase("pairs"):
+                for particle_1, particle_2 in iter_unique_pairs(particles, self.tile_size):
+                    self.apply_arbitrary_laws(particle_1, particle_2, self.global_arbitrary_laws)
+            instrumentation.count("pairs", len(particles) * (len(particles) - 1) // 2)
+
+    def compute_accelerations(self, targets: np.ndarray = None) -> np.ndarray:
+        # Accelerations of all the particles, or of the particles of index targets, caused by all the particles
+        instrumentation = self.instrumentation
+        store = self.store
+        particle_nbr = len(store)
+        instrumentation.count("force_evaluations", particle_nbr if targets is None else len(targets))
+        accelerations = np.zeros((particle_nbr if targets is None else len(targets), store.positions.shape[1]))
+        solved_force_generators = self.solved_force_generators
+        pairwise_force_generators = self.pairwise_force_generators
+        batch_force_generators = self.batch_force_generators
+        if self._pool is not None:
+            with instrumentation.phase("workers"):
+                pool_accelerations = self._pool.compute_accelerations(particle_nbr)
+            # Only the accelerations cross the shared memory, the store already lives there
+            instrumentation.count("ipc_bytes", pool_accelerations.nbytes)
+            accelerations += pool_accelerations if targets is None else pool_accelerations[targets]
+            pool_force_generators = self._pool.solved_force_generators
+            solved_force_generators = tuple(f for f in solved_force_generators if f not in pool_force_generators)
+            pairwise_force_generators = batch_force_generators = ()
+        if solved_force_generators:
+            with instrumentation.phase("solver"):
+                for force_generator in solved_force_generators:
+                    if targets is None:
+                        accelerations += self.solver.compute_accelerations(
+                            force_generator, store.masses, store.positions
+                        )
+                    else:
+                        accelerations += self.solver.compute_target_accelerations(
+                            force_generator, store.masses, store.positions, targets
+                        )
+        if batch_force_generators:
+            with instrumentation.phase("batch"):
+                accelerations += compute_block_accelerations(
+                    batch_force_generators, store.masses, store.positions, targets, self.block_size
+                )
+        if pairwise_force_generators or self.short_range_force_generators:
+            # Particle.apply_force accelerates both particles of a pair, so a double precision copy of the velocities
+            # is used as accumulator
+            velocities = store.velocities
+            store.velocities = velocities.astype(np.float64)
+            try:
+                if pairwise_force_generators:
+                    particles = store.get_alive_particles()
+                    with instrumentation.phase("pairs"):
+                        for particle_1, particle_2 in iter_unique_pairs(particles, self.tile_size):
+                            total_force = self.compute_total_force(particle_1, particle_2, pairwise_force_generators)
+                            if total_force is not None:
+                                particle_1.apply_force(total_force, particle_2)
+                    instrumentation.count("pairs", len(particles) * (len(particles) - 1) // 2)
+                with instrumentation.phase("short_range"):
+                    self.apply_short_range_forces(store.particles, store.positions)
+                pairwise_accelerations = store.velocities - velocities
+            finally:
+                store.velocities = velocities
+            accelerations += pairwise_accelerations if targets is None else pairwise_accelerations[targets]
+        if store.dead_nbr:
+            # Dead particles have no mass, they must stay where they are until the store is compacted
+            accelerations[~store.alive if targets is None else ~store.alive[targets]] = 0
+        return accelerations
+
+    def get_state(self) -> Tuple[List[ArrayParticle], np.ndarray, np.ndarray, np.ndarray]:
+        store = self.store
+        if not store.dead_nbr:
+            return store.particles, store.masses, store.positions, store.velocities
+        return (
+            store.get_alive_particles(),
+            store.masses[store.alive],
+            store.positions[store.alive],
+            store.velocities[store.alive],
+        )
+
+    def build_particles(
+        self, masses: np.ndarray, positions: np.ndarray, velocities: np.ndarray, ids: np.ndarray = None
+    ) -> List[ArrayParticle]:
+        self.store = ParticleStore(
+            np.array(masses, dtype=self.dtype),
+            np.array(positions, dtype=self.dtype),
+            np.array(velocities, dtype=self.dtype),
+            ids,
+            self.dtype,
+        )
+        self.store.particles = self.build_particle_views(self.particle_type, self.particle_kwargs)
+        return self.store.particles
+
+    def apply_updates(self):
+        with self.instrumentation.phase("update"):
+            for particle in self.store.particles:
+                if particle._next_values:
+                    particle.update()
+        # The integrator moves the particles in place, so that the store may stay in shared memory
+        self.integrator.step(self)
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import json
+import os
+from time import time
+from typing import Dict, Any
+
+import numpy as np
+
+from newchanic.engine import Engine, Feature
+from newchanic.utils import Number
+
+CHECKPOINT_VERSION = 1
+# Pending updates of these fields, i.e. the next positions of the particles saved during a turn, are dumped as an
+# array of particle indexes and an array of values, under these names. Pending updates of other fields are rare and
+# stored in the JSON metadata.
+BULK_PENDING_FIELDS = {"position": "pending_positions", "_position": "pending_store_positions"}
+
+
+def get_parameters(obj: Any) -> Dict[str, Any]:
+    # Public scalar attributes, either set on the instance or overridden by its class (e.g. Gravity.g)
+    parameters = {}
+    for name in dir(obj):
+        if name.startswith("_") or isinstance(getattr(type(obj), name, None), property):
+            continue
+        value = getattr(obj, name)
+        if isinstance(value, (bool, int, float, str)):
+            parameters[name] = value
+    return parameters
+
+
+def set_parameters(obj: Any, parameters: Dict[str, Any]):
+    for name, value in parameters.items():
+        setattr(obj, name, value)
+
+
+def save_checkpoint(engine: Engine, path: str, in_turn: bool = False):
+    # in_turn tells the state is saved by a feature, before the pending updates of the turn are applied
+    particles, masses, positions, velocities = engine.get_state()
+    indexes = {particle: index for index, particle in enumerate(particles)}
+    pending = []
+    bulk_pending = {field: ([], []) for field in BULK_PENDING_FIELDS}
+    for index, particle in enumerate(particles):
+        for field, value in particle.get_pending_updates().items():
+            if field in bulk_pending:
+                bulk_pending[field][0].append(index)
+                bulk_pending[field][1].append(value)
+            else:
+                pending.append((index, field, np.asarray(value).tolist()))
+    bulk_arrays = {}
+    for field, (pending_indexes, pending_values) in bulk_pending.items():
+        name = BULK_PENDING_FIELDS[field]
+        bulk_arrays[f"{name}_indexes"] = np.array(pending_indexes, dtype=np.int64)
+        bulk_arrays[name] = np.array(pending_values, dtype=positions.dtype).reshape(
+            len(pending_indexes), positions.shape[1]
+        )
+    metadata = {
+        "version": CHECKPOINT_VERSION,
+        "engine": type(engine).__name__,
+        "turn": engine.turn,
+        "in_turn": in_turn,
+        "pending": pending,
+        "removing": [indexes[particle] for particle in engine.features["remove"].particles_to_remove],
+        "laws": [
+            [type(law).__name__, get_parameters(law)] for law in (*engine.force_generators, *engine.arbitrary_laws)
+        ],
+        "features": {name: get_parameters(feature) for name, feature in engine.features.items()},
+    }
+    # The checkpoint is written next to its destination then renamed, so that a crash never leaves a partial file
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as file:
+        np.savez(
+            file,
+            masses=masses,
+            positions=positions,
+            velocities=velocities,
+            ids=np.array([particle.id for particle in particles], dtype=np.int64),
+            metadata=json.dumps(metadata),
+            **bulk_arrays,
+        )
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path)
+
+
+def load_checkpoint(engine: Engine, path: str):
+    # The engine must have been built with the same laws and features as the one which has been saved
+    with np.load(path) as data:
+        masses, positions, velocities = data["masses"], data["positions"], data["velocities"]
+        # Checkpoints saved before particles had ids get the ids of their order
+        ids = data["ids"] if "ids" in data else None
+        metadata = json.loads(str(data["metadata"]))
+        # Checkpoints saved before the bulk arrays have all their pending updates in the metadata
+        bulk_pending = {
+            field: (data[f"{name}_indexes"], data[name])
+            for field, name in BULK_PENDING_FIELDS.items()
+            if name in data
+        }
+    if metadata["version"] != CHECKPOINT_VERSION:
+        raise ValueError(f"Unsupported checkpoint version {metadata['version']}")
+    laws = (*engine.force_generators, *engine.arbitrary_laws)
+    if [type(law).__name__ for law in laws] != [name for name, _ in metadata["laws"]]:
+        raise ValueError(f"The laws of the engine do not match the ones of {path}")
+    for law, (_, parameters) in zip(laws, metadata["laws"]):
+        set_parameters(law, parameters)
+    for name, parameters in metadata["features"].items():
+        if name in engine.features:
+            set_parameters(engine.features[name], parameters)
+    particles = engine.set_state(masses, positions, velocities, ids)
+    for index, field, value in metadata["pending"]:
+        particles[index].delay_update(field, value)
+    for field, (indexes, values) in bulk_pending.items():
+        for index, value in zip(indexes.tolist(), values.tolist()):
+            particles[index].delay_update(field, value)
+    engine.features["remove"].particles_to_remove = {particles[index] for index in metadata["removing"]}
+    engine.turn = metadata["turn"]
+    if metadata["in_turn"]:
+        # Ends the turn during which the checkpoint has been saved
+        engine.apply_updates()
+        engine.turn += 1
+
+
+class AutoCheckpoint(Feature[None]):
+    # Saves the engine every `every` turns and/or `every_seconds` seconds. It should be registered after the
+    # "remove" feature, so that the removals of the turn are part of the checkpoint.
+    def __init__(self, path: str, every: int = None, every_seconds: Number = None):
+        assert every is not None or every_seconds is not None, "every or every_seconds must be given"
+        self.path = path
+        self.every = every
+        self.every_seconds = every_seconds
+        self._last_save = time()
+
+    def __call__(self, engine: Engine):
+        if (self.every is not None and (engine.turn + 1) % self.every == 0) or (
+            self.every_seconds is not None and time() - self._last_save >= self.every_seconds
+        ):
+            save_checkpoint(engine, self.path, in_turn=True)
+            self._last_save = time()
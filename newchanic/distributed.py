@@ -0,0 +1,305 @@
+from __future__ import annotations
+
+import pickle
+import socket
+import struct
+import traceback
+from argparse import ArgumentParser
+from functools import partial
+from multiprocessing import Process
+from time import time, sleep
+from typing import Tuple, Optional, List
+
+import numpy as np
+
+from newchanic.laws import Gravity
+from newchanic.multicore import compute_target_accelerations
+from newchanic.physics import ForceGenerator
+from newchanic.solvers import DirectSolver
+
+# kind, then three values depending on the kind (sizes of the payload)
+HEADER = struct.Struct("<IIII")
+SETUP, TURN, RESULT, ERROR, STOP = 1, 2, 3, 4, 5
+
+
+def receive_exactly(connection: socket.socket, size: int) -> bytearray:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        chunk_size = connection.recv_into(view[received:])
+        if not chunk_size:
+            raise ConnectionError("The connection has been closed")
+        received += chunk_size
+    return buffer
+
+
+def send_message(connection: socket.socket, kind: int, values: Tuple[int, int, int] = (0, 0, 0), *payloads: bytes):
+    connection.sendall(b"".join((HEADER.pack(kind, *values), *payloads)))
+
+
+def receive_message(connection: socket.socket, payload_size) -> Tuple[int, Tuple[int, int, int], bytearray]:
+    # payload_size gives the size of the payload from the kind and values of the header
+    kind, *values = HEADER.unpack(receive_exactly(connection, HEADER.size))
+    return kind, tuple(values), receive_exactly(connection, payload_size(kind, *values))
+
+
+def get_payload_size(kind: int, first: int, second: int, third: int, itemsize: int = 8) -> int:
+    # itemsize is the size of the floats, given by the precision of the engine's store
+    if kind == SETUP or kind == ERROR:
+        return first
+    if kind == TURN:
+        # target number, source number, dimension number: masses then positions of the sources
+        return second * (1 + third) * itemsize
+    if kind == RESULT:
+        # target number, dimension number: accelerations of the targets
+        return first * second * itemsize
+    return 0
+
+
+def partition(positions: np.ndarray, domain_nbr: int) -> List[np.ndarray]:
+    # Recursive coordinate bisection: every domain is a compact box of particles, the domains of a same level holding
+    # the same number of particles up to one
+    domains = []
+    pending = [(np.arange(len(positions)), domain_nbr)]
+    while pending:
+        indices, nbr = pending.pop()
+        if nbr == 1:
+            domains.append(indices)
+            continue
+        left_nbr = nbr // 2
+        split = len(indices) * left_nbr // nbr
+        if 0 < split < len(indices):
+            points = positions[indices]
+            axis = int(np.argmax(points.max(axis=0) - points.min(axis=0)))
+            indices = indices[np.argpartition(points[:, axis], split)]
+        pending.append((indices[split:], nbr - left_nbr))
+        pending.append((indices[:split], left_nbr))
+    return domains
+
+
+class DomainSummaries:
+    # Monopole and bounding box of every domain, far domains are sent to the workers as a single pseudo particle
+    def __init__(self, domains: List[np.ndarray], masses: np.ndarray, positions: np.ndarray):
+        domain_nbr, dimension_nbr = len(domains), positions.shape[1]
+        self.masses = np.zeros(domain_nbr)
+        self.centers_of_mass = np.zeros((domain_nbr, dimension_nbr))
+        self.lower_corners = np.zeros((domain_nbr, dimension_nbr))
+        self.upper_corners = np.zeros((domain_nbr, dimension_nbr))
+        for index, domain in enumerate(domains):
+            if not len(domain):
+                continue
+            domain_masses, domain_positions = masses[domain], positions[domain]
+            self.masses[index] = domain_masses.sum()
+            if self.masses[index] > 0:
+                self.centers_of_mass[index] = domain_masses @ domain_positions / self.masses[index]
+            self.lower_corners[index] = domain_positions.min(axis=0)
+            self.upper_corners[index] = domain_positions.max(axis=0)
+        self.sizes = (self.upper_corners - self.lower_corners).max(axis=1)
+
+    def get_far_domains(self, target: int, theta: float) -> np.ndarray:
+        # Domains whose size seen from the box of the target domain is smaller than theta
+        gaps = np.maximum(
+            self.lower_corners[target] - self.centers_of_mass, self.centers_of_mass - self.upper_corners[target]
+        )
+        distances = np.linalg.norm(np.maximum(gaps, 0), axis=1)
+        far = self.sizes < theta * distances
+        far[target] = False
+        return far
+
+
+class ParticleState:
+    # Arrays the engine binds its store to during a run, the distributed counterpart of SharedParticleState
+    def __init__(self, capacity: int, dimension_nbr: int, dtype: np.dtype = np.float64):
+        self.masses = np.zeros(capacity, dtype=dtype)
+        self.positions = np.zeros((capacity, dimension_nbr), dtype=dtype)
+        self.velocities = np.zeros((capacity, dimension_nbr), dtype=dtype)
+        self.accelerations = np.zeros((capacity, dimension_nbr), dtype=dtype)
+
+
+class DistributedPool:
+    # Same interface as multicore.WorkerPool, with workers connected over TCP instead of shared memory. The engine
+    # writes its particles in state, the pool sends every worker its domain followed by the particles it interacts
+    # with, and gathers the accelerations of the domains.
+    def __init__(
+        self,
+        worker_nbr: int,
+        capacity: int,
+        dimension_nbr: int,
+        solver: Optional[DirectSolver],
+        solved_force_generators: Tuple[ForceGenerator, ...],
+        pairwise_force_generators: Tuple[ForceGenerator, ...],
+        address: Tuple[str, int] = ("127.0.0.1", 0),
+        spawn_workers: bool = True,
+        theta: float = 0.0,
+        timeout: float = 60.0,
+        dtype: np.dtype = np.float64,
+    ):
+        assert worker_nbr > 0, "worker_nbr must be > 0"
+        assert theta == 0 or all(
+            isinstance(force_generator, Gravity)
+            for force_generator in (*solved_force_generators, *pairwise_force_generators)
+        ), "Domain summaries are only valid for gravity"
+        self.capacity = capacity
+        self.solved_force_generators = solved_force_generators
+        self.theta = theta
+        self.state = ParticleState(capacity, dimension_nbr, dtype)
+        # Floats are sent with the precision of the engine's store
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self._payload_size = partial(get_payload_size, itemsize=self.dtype.itemsize)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.connections: List[socket.socket] = []
+        self.processes: List[Process] = []
+        self._server = socket.create_server(address)
+        self._server.settimeout(timeout)
+        self.address = self._server.getsockname()[:2]
+        try:
+            if spawn_workers:
+                host = "127.0.0.1" if self.address[0] in ("0.0.0.0", "") else self.address[0]
+                self.processes = [
+                    Process(target=run_worker, args=(host, self.address[1]), daemon=True) for _ in range(worker_nbr)
+                ]
+                for process in self.processes:
+                    process.start()
+            # The workers started on other nodes are expected to connect within timeout
+            setup = pickle.dumps((solver, solved_force_generators, pairwise_force_generators, self.dtype))
+            for _ in range(worker_nbr):
+                connection, _ = self._server.accept()
+                connection.settimeout(None)
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.connections.append(connection)
+                send_message(connection, SETUP, (len(setup), 0, 0), setup)
+        except BaseException:
+            self.close()
+            raise
+
+    def compute_accelerations(self, particle_nbr: int) -> np.ndarray:
+        # Masses and positions of the particle_nbr first particles must have been written in state beforehand
+        assert particle_nbr <= self.capacity, "The pool is too small for this number of particles"
+        masses, positions = self.state.masses[:particle_nbr], self.state.positions[:particle_nbr]
+        domains = partition(positions, len(self.connections))
+        summaries = DomainSummaries(domains, masses, positions) if self.theta > 0 else None
+        working = []
+        # Every worker gets its request before any result is read, so that they all compute at the same time
+        for index, (connection, domain) in enumerate(zip(self.connections, domains)):
+            if not len(domain):
+                continue
+            source_masses, source_positions = self._get_sources(index, domains, summaries, masses, positions)
+            payloads = (source_masses.astype(self.dtype).tobytes(), source_positions.astype(self.dtype).tobytes())
+            send_message(connection, TURN, (len(domain), len(source_masses), positions.shape[1]), *payloads)
+            self.bytes_sent += HEADER.size + sum(map(len, payloads))
+            working.append((connection, domain))
+        # Every reply is read before raising the errors, so that no frame of this turn is left in the connections
+        errors = []
+        for connection, domain in working:
+            kind, values, payload = receive_message(connection, self._payload_size)
+            self.bytes_received += HEADER.size + len(payload)
+            if kind == ERROR:
+                errors.append(payload.decode())
+                continue
+            accelerations = np.frombuffer(payload, dtype=self.dtype).reshape(values[0], values[1])
+            self.state.accelerations[domain] = accelerations
+        if errors:
+            raise RuntimeError(f"{len(errors)} of {len(working)} workers failed:\n" + "\n".join(errors))
+        return self.state.accelerations[:particle_nbr]
+
+    def _get_sources(
+        self,
+        index: int,
+        domains: List[np.ndarray],
+        summaries: Optional[DomainSummaries],
+        masses: np.ndarray,
+        positions: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # The particles of the domain come first, then the particles of the near domains and the monopoles of the far
+        # ones
+        far = summaries.get_far_domains(index, self.theta) if summaries is not None else np.zeros(len(domains), bool)
+        near = [domains[index]] + [domain for i, domain in enumerate(domains) if i != index and not far[i]]
+        indices = np.concatenate(near)
+        if not far.any():
+            return masses[indices], positions[indices]
+        return (
+            np.concatenate((masses[indices], summaries.masses[far])),
+            np.concatenate((positions[indices], summaries.centers_of_mass[far])),
+        )
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                send_message(connection, STOP)
+            except OSError:
+                pass
+            connection.close()
+        self.connections = []
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self._server.close()
+
+    def __enter__(self) -> DistributedPool:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def connect(host: str, port: int, timeout: float) -> socket.socket:
+    # Workers may be started before the coordinator listens
+    deadline = time() + timeout
+    while True:
+        try:
+            return socket.create_connection((host, port))
+        except ConnectionRefusedError:
+            if time() > deadline:
+                raise
+            sleep(0.1)
+
+
+def run_worker(host: str, port: int, timeout: float = 60.0):
+    # The setup is unpickled: workers must only connect to a trusted coordinator
+    with connect(host, port, timeout) as connection:
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        kind, _, payload = receive_message(connection, get_payload_size)
+        assert kind == SETUP, f"Unexpected message {kind} instead of the setup"
+        solver, solved_force_generators, pairwise_force_generators, dtype = pickle.loads(payload)
+        payload_size = partial(get_payload_size, itemsize=dtype.itemsize)
+        while True:
+            kind, (target_nbr, source_nbr, dimension_nbr), payload = receive_message(connection, payload_size)
+            if kind == STOP:
+                break
+            try:
+                sources = np.frombuffer(payload, dtype=dtype)
+                masses = sources[:source_nbr]
+                positions = sources[source_nbr:].reshape(source_nbr, dimension_nbr)
+                accelerations = compute_target_accelerations(
+                    masses,
+                    positions,
+                    np.zeros_like(positions),
+                    0,
+                    target_nbr,
+                    solver,
+                    solved_force_generators,
+                    pairwise_force_generators,
+                )
+            except Exception:
+                error = traceback.format_exc().encode()
+                send_message(connection, ERROR, (len(error), 0, 0), error)
+                continue
+            send_message(
+                connection, RESULT, (target_nbr, dimension_nbr, 0), accelerations.astype(dtype).tobytes()
+            )
+
+
+def main(arguments: List[str] = None):
+    parser = ArgumentParser(prog="newchanic.distributed", description="Worker of a distributed engine")
+    parser.add_argument("host", help="address of the coordinator, i.e. of the engine calling run_distributed")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the coordinator")
+    arguments = parser.parse_args(arguments)
+    run_worker(arguments.host, arguments.port, arguments.timeout)
+
+
+if __name__ == "__main__":
+    main()
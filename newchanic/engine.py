@@ -1,16 +1,37 @@
 from __future__ import annotations
 
-from multiprocessing import Process, Queue
-from typing import List, Type, Dict, Set, Generic, TypeVar, Any, Callable, Tuple
+from operator import attrgetter
+from time import time
+from typing import List, Type, Dict, Set, Generic, TypeVar, Any, Callable, Tuple, Optional
 
-from newchanic.physics import ForceGenerator
-from newchanic.utils import split_into_lists, random_between
-from physics import Particle, ArbitraryLaw
-from utils import Number
+import numpy as np
+
+from newchanic.initial_conditions import InitialConditions
+from newchanic.instrumentation import Instrumentation, NULL_INSTRUMENTATION
+from newchanic.physics import (
+    ForceGenerator,
+    Particle,
+    ArbitraryLaw,
+    PairGeometry,
+    compute_total_force,
+    compute_force,
+    apply_law,
+    uses_block_forces,
+)
+from newchanic.distributed import DistributedPool
+from newchanic.multicore import WorkerPool
+from newchanic.solvers import ForceSolver, DirectSolver, compute_block_accelerations
+from newchanic.spatial import SpatialHash, NeighbourList
+from newchanic.utils import random_between, Number, iter_unique_pairs, DEFAULT_TILE_SIZE
 
 T = TypeVar("T")
 
 
+def stack_rows(rows: List[List[Number]]) -> np.ndarray:
+    # One row by particle, without any column when there is no particle
+    return np.array(rows, dtype=float).reshape(len(rows), -1 if rows else 0)
+
+
 class Feature(Generic[T]):
     def update(self, data: T):
         raise NotImplementedError
@@ -22,21 +43,26 @@ class Feature(Generic[T]):
 class RemoveFeature(Feature[Set]):
     def __init__(self):
         self.particles_to_remove = set()
+        # Particles removed by the last call, for the features running after this one
+        self.last_removed = set()
 
     def update(self, data: Set[Particle]):
         self.particles_to_remove.update(data)
 
     def __call__(self, engine: Engine):
+        engine.instrumentation.count("removed_particles", len(self.particles_to_remove))
+        # In place difference, which only costs the number of removed particles
         engine.particles -= self.particles_to_remove  # May cause not null total force sum
-        self.particles_to_remove.clear()
+        self.last_removed, self.particles_to_remove = self.particles_to_remove, set()
 
 
 class Engine:
-    STOP_FLAG = "stop_flag"
+    # Precision of the particle state exchanged with the workers, the particles of this engine hold Python floats
+    dtype = np.dtype(np.float64)
 
     def __init__(
         self,
-        particle_number: int,
+        particle_number: int = None,
         particle_type: Type[Particle] = Particle,
         particle_kwargs: Dict[str, Any] = None,
         get_mass: Callable[[int], Number] = lambda _: random_between(10, 100),
@@ -48,13 +74,63 @@ class Engine:
         get_velocity: Callable[[int], List[Number]] = lambda _: [0, 0, 0],
         force_generators: Tuple[ForceGenerator] = (),
         arbitrary_laws: Tuple[ArbitraryLaw] = (),
+        solver: ForceSolver = None,
+        tile_size: int = DEFAULT_TILE_SIZE,
+        instrumentation: Instrumentation = None,
+        neighbour_skin: Number = None,
+        initial_conditions: InitialConditions = None,
     ):
-        self.particles: Set[Particle] = self.init_particles(
-            particle_number, particle_type, particle_kwargs, get_mass, get_position, get_velocity
-        )
+        self.particle_type = particle_type
+        self.particle_kwargs = particle_kwargs
+        # Initial conditions give all the particles at once, the callables are called particle by particle
+        if initial_conditions is None:
+            assert particle_number is not None, "particle_number or initial_conditions must be given"
+            self.particles: Set[Particle] = self.init_particles(
+                particle_number, particle_type, particle_kwargs, get_mass, get_position, get_velocity
+            )
+        else:
+            assert particle_number in (None, len(initial_conditions.masses)), "particle_number does not match"
+            self.particles = set(self.build_particles(*initial_conditions))
         self.force_generators = force_generators
+        self.solver = solver
+        # Force generators handled by the solver are not evaluated pair by pair
+        self.solved_force_generators = tuple(
+            force_generator
+            for force_generator in force_generators
+            if solver is not None and solver.handles(force_generator)
+        )
+        # Long-range generators implementing the batch protocol are evaluated by blocks instead of pair by pair
+        self.batch_force_generators = tuple(
+            force_generator
+            for force_generator in force_generators
+            if force_generator not in self.solved_force_generators
+            and force_generator.cutoff_radius is None
+            and uses_block_forces(force_generator)
+        )
+        self.pairwise_force_generators = tuple(
+            force_generator
+            for force_generator in force_generators
+            if force_generator not in self.solved_force_generators
+            and force_generator.cutoff_radius is None
+            and force_generator not in self.batch_force_generators
+        )
+        self.short_range_force_generators = tuple(
+            force_generator
+            for force_generator in force_generators
+            if force_generator not in self.solved_force_generators and force_generator.cutoff_radius is not None
+        )
+        self.neighbour_list: Optional[NeighbourList] = None
+        if self.short_range_force_generators:
+            cutoff = max(force_generator.cutoff_radius for force_generator in self.short_range_force_generators)
+            self.neighbour_list = NeighbourList(cutoff, cutoff / 4 if neighbour_skin is None else neighbour_skin)
         self.arbitrary_laws = arbitrary_laws
+        self.local_arbitrary_laws = tuple(law for law in arbitrary_laws if law.interaction_radius is not None)
+        self.global_arbitrary_laws = tuple(law for law in arbitrary_laws if law.interaction_radius is None)
         self.features = {"remove": RemoveFeature()}
+        self.tile_size = tile_size
+        # Disabled instrumentation is a null object, so the engine loops never have to check for it
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+        self.turn = 0
         self._keep_running = True
 
     @staticmethod
@@ -66,94 +142,273 @@ class Engine:
         get_position: Callable[[int], List[Number]],
         get_velocity: Callable[[int], List[Number]],
     ) -> Set[Particle]:
-        return {
-            particle_type(
+        particles = set()
+        for i in range(particle_nbr):
+            particle = particle_type(
                 mass=get_mass(i), position=get_position(i), velocity=get_velocity(i), **(particle_kwargs or {})
             )
-            for i in range(particle_nbr)
-        }
+            particle.id = i
+            particles.add(particle)
+        return particles
 
     def run_custom_engine_features(self):
         pass
 
-    def run_multicore(self, core_nbr: int) -> int:
+    def get_parallel_force_generators(self) -> Tuple[Tuple[ForceGenerator, ...], Tuple[ForceGenerator, ...]]:
+        # Only the direct solver can share its work between workers, other solvers run in the engine's process
+        solved_force_generators = self.solved_force_generators if isinstance(self.solver, DirectSolver) else ()
+        # Workers tell batch generators from per pair ones by themselves
+        return solved_force_generators, self.pairwise_force_generators + self.batch_force_generators
+
+    def must_continue(
+        self, turn_number: int, start: float, max_turns: Optional[int], max_seconds: Optional[Number]
+    ) -> bool:
+        return (
+            self._keep_running
+            and (max_turns is None or turn_number < max_turns)
+            and (max_seconds is None or time() - start < max_seconds)
+        )
+
+    def get_dimension_nbr(self) -> int:
+        return max([len(particle.position) for particle in self.particles], default=0)
+
+    def get_capacity(self) -> int:
+        # Number of particle slots the workers must be able to hold
+        return len(self.particles)
+
+    def build_pool(self, pool_type: Type[WorkerPool], worker_nbr: int, **kwargs) -> WorkerPool:
+        solved_force_generators, pairwise_force_generators = self.get_parallel_force_generators()
+        return pool_type(
+            worker_nbr,
+            self.get_capacity(),
+            self.get_dimension_nbr(),
+            self.solver,
+            solved_force_generators,
+            pairwise_force_generators,
+            dtype=self.dtype,
+            **kwargs,
+        )
+
+    def run_multicore(self, core_nbr: int, max_turns: int = None, max_seconds: Number = None) -> int:
         # todo : find out how many cores are best
-        workers = []
-        input_queue, output_queue = Queue(), Queue()
-        for i in range(core_nbr):
-            workers.append(
-                Process(
-                    target=process_particle_interaction,
-                    args=(input_queue, output_queue, self.force_generators),
-                )
-            )
-        [worker.start() for worker in workers]
+        with self.build_pool(WorkerPool, core_nbr) as pool:
+            return self.run_with_pool(pool, max_turns, max_seconds)
+
+    def run_distributed(
+        self,
+        worker_nbr: int,
+        max_turns: int = None,
+        max_seconds: Number = None,
+        address: Tuple[str, int] = ("127.0.0.1", 0),
+        spawn_workers: bool = True,
+        theta: float = 0.0,
+    ) -> int:
+        # Workers connect over TCP: they are started on this node when spawn_workers is true, otherwise they must be
+        # started on the other nodes with python -m newchanic.distributed HOST PORT
+        with self.build_pool(
+            DistributedPool, worker_nbr, address=address, spawn_workers=spawn_workers, theta=theta
+        ) as pool:
+            return self.run_with_pool(pool, max_turns, max_seconds)
+
+    def run_with_pool(self, pool: WorkerPool, max_turns: int = None, max_seconds: Number = None) -> int:
+        dimension_nbr = pool.state.positions.shape[1]
         i = 0
-        while self._keep_running:
-            items_by_worker = split_into_lists(list(self.particles), core_nbr)
-            for items in items_by_worker:
-                input_queue.put((items, self.particles))
-            particles = set()
-            for _ in items_by_worker:
-                particles.update(output_queue.get())
-            self.particles = particles
-            self.run_custom_engine_features()
+        start = time()
+        while self.must_continue(i, start, max_turns, max_seconds):
+            instrumentation = self.instrumentation
+            particles = list(self.particles)
+            with instrumentation.phase("ipc"):
+                for index, particle in enumerate(particles):
+                    pool.state.masses[index] = particle.mass
+                    pool.state.positions[index] = particle.position
+            if not pool.solved_force_generators:
+                with instrumentation.phase("solver"):
+                    self.apply_solver()
+            with instrumentation.phase("local_laws"):
+                self.apply_local_arbitrary_laws(particles, pool.state.positions[: len(particles)])
+            with instrumentation.phase("short_range"):
+                self.apply_short_range_forces(particles, pool.state.positions[: len(particles)])
+            if self.global_arbitrary_laws:
+                with instrumentation.phase("pairs"):
+                    for particle_1, particle_2 in iter_unique_pairs(particles, self.tile_size):
+                        self.apply_arbitrary_laws(particle_1, particle_2, self.global_arbitrary_laws)
+                instrumentation.count("pairs", len(particles) * (len(particles) - 1) // 2)
+            with instrumentation.phase("workers"):
+                accelerations = pool.compute_accelerations(len(particles))
+            # Masses and positions are sent to the workers, accelerations are read back
+            instrumentation.count("ipc_bytes", len(particles) * (1 + 2 * dimension_nbr) * pool.state.masses.itemsize)
+            with instrumentation.phase("integration"):
+                for particle, acceleration in zip(particles, accelerations.tolist()):
+                    particle.accelerate(acceleration)
+                    particle.run()
+            self.finish_turn()
             i += 1
-        [input_queue.put(Engine.STOP_FLAG) for _ in workers]
         return i
 
-    def run(self) -> int:
+    def run(self, max_turns: int = None, max_seconds: Number = None) -> int:
+        start = time()
         i = 0
-        while self._keep_running:
-            for particle_1 in self.particles:
-                for particle_2 in self.particles:
-                    if particle_1 is not particle_2:
+        while self.must_continue(i, start, max_turns, max_seconds):
+            instrumentation = self.instrumentation
+            particles = list(self.particles)
+            with instrumentation.phase("solver"):
+                self.apply_solver()
+            if self.batch_force_generators:
+                with instrumentation.phase("batch"):
+                    self.apply_batch_force_generators()
+            if self.local_arbitrary_laws or self.short_range_force_generators:
+                positions = stack_rows([particle.position for particle in particles])
+                with instrumentation.phase("local_laws"):
+                    self.apply_local_arbitrary_laws(particles, positions)
+                with instrumentation.phase("short_range"):
+                    self.apply_short_range_forces(particles, positions)
+            if self.global_arbitrary_laws or self.pairwise_force_generators:
+                with instrumentation.phase("pairs"):
+                    # Particle.apply_force acts on both particles, so each unordered pair is processed once
+                    for particle_1, particle_2 in iter_unique_pairs(particles, self.tile_size):
                         self.manage_particle_interaction(particle_1, particle_2)
+                instrumentation.count("pairs", len(particles) * (len(particles) - 1) // 2)
+            with instrumentation.phase("integration"):
+                for particle in particles:
+                    particle.run()
+            self.finish_turn()
+            i += 1
+        return i
+
+    def finish_turn(self):
+        with self.instrumentation.phase("features"):
             for feature in self.features.values():
                 feature(self)
+        self.apply_updates()
+        with self.instrumentation.phase("custom_features"):
+            self.run_custom_engine_features()
+        self.instrumentation.end_turn()
+        self.turn += 1
+
+    def apply_updates(self):
+        with self.instrumentation.phase("update"):
             for particle in self.particles:
                 particle.update()
-            self.run_custom_engine_features()
-            i += 1
-        return i
+
+    def get_state(self) -> Tuple[List[Particle], np.ndarray, np.ndarray, np.ndarray]:
+        # Particles are sorted by id, so that the order of the state is the same from a turn to another
+        particles = sorted(self.particles, key=attrgetter("id"))
+        return (
+            particles,
+            np.array([particle.mass for particle in particles], dtype=float),
+            stack_rows([particle.position for particle in particles]),
+            stack_rows([particle._velocity for particle in particles]),
+        )
+
+    def build_particles(
+        self, masses: np.ndarray, positions: np.ndarray, velocities: np.ndarray, ids: np.ndarray = None
+    ) -> List[Particle]:
+        particles = [
+            self.particle_type(mass=mass, position=position, velocity=velocity, **(self.particle_kwargs or {}))
+            for mass, position, velocity in zip(masses.tolist(), positions.tolist(), velocities.tolist())
+        ]
+        for particle, particle_id in zip(particles, range(len(particles)) if ids is None else ids.tolist()):
+            particle.id = particle_id
+        return particles
+
+    def set_state(
+        self, masses: np.ndarray, positions: np.ndarray, velocities: np.ndarray, ids: np.ndarray = None
+    ) -> List[Particle]:
+        # Replaces the particles, which are returned in the order of the given arrays
+        particles = self.build_particles(masses, positions, velocities, ids)
+        self.particles = set(particles)
+        if self.neighbour_list is not None:
+            self.neighbour_list.invalidate()
+        return particles
+
+    def apply_solver(self):
+        if not self.solved_force_generators:
+            return
+        particles = list(self.particles)
+        masses = np.array([particle.mass for particle in particles], dtype=float)
+        positions = stack_rows([particle.position for particle in particles])
+        accelerations = sum(
+            self.solver.compute_accelerations(force_generator, masses, positions)
+            for force_generator in self.solved_force_generators
+        )
+        for particle, acceleration in zip(particles, accelerations.tolist()):
+            particle.accelerate(acceleration)
+
+    def apply_batch_force_generators(self):
+        particles = list(self.particles)
+        masses = np.array([particle.mass for particle in particles], dtype=float)
+        positions = stack_rows([particle.position for particle in particles])
+        accelerations = compute_block_accelerations(self.batch_force_generators, masses, positions)
+        for particle, acceleration in zip(particles, accelerations.tolist()):
+            particle.accelerate(acceleration)
 
     def manage_particle_interaction(self, particle_1: Particle, particle_2: Particle):
-        for law in self.arbitrary_laws:
-            output = law.apply(particle_1, particle_2, self)
+        # The geometry of the pair is computed once for all the laws and force generators
+        geometry = PairGeometry.between(particle_1, particle_2)
+        self.apply_arbitrary_laws(particle_1, particle_2, self.global_arbitrary_laws, geometry)
+        total_force = self.compute_total_force(particle_1, particle_2, self.pairwise_force_generators, geometry)
+        if total_force is not None:
+            particle_1.apply_force(total_force, particle_2)
+
+    def filter_pairs(self, first: np.ndarray, second: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Pairs of indexes found by the broad phases, which may include particles that must not interact
+        return first, second
+
+    def apply_local_arbitrary_laws(self, particles: List[Particle], positions: np.ndarray):
+        # The broad phase only returns the pairs close enough for at least one of the local laws
+        if not self.local_arbitrary_laws:
+            return
+        radius = max(law.interaction_radius for law in self.local_arbitrary_laws)
+        first, second = self.filter_pairs(*SpatialHash(radius).candidate_pairs(positions, radius))
+        self.instrumentation.count("local_pairs", len(first))
+        # The broad phase already computed the deltas, they are reused as the geometry of the pairs
+        deltas = positions[first] - positions[second]
+        squared_distances = np.einsum("ij,ij->i", deltas, deltas)
+        for index_1, index_2, delta, squared_distance in zip(
+            first.tolist(), second.tolist(), deltas.tolist(), squared_distances.tolist()
+        ):
+            self.apply_arbitrary_laws(
+                particles[index_1], particles[index_2], self.local_arbitrary_laws, PairGeometry(delta, squared_distance)
+            )
+
+    def apply_short_range_forces(self, particles: List[Particle], positions: np.ndarray):
+        # Short-range force generators are only evaluated on the pairs of the neighbour list closer than their cutoff
+        if not self.short_range_force_generators:
+            return
+        first, second = self.filter_pairs(*self.neighbour_list.get_pairs(positions))
+        deltas = positions[first] - positions[second]
+        squared_distances = np.einsum("ij,ij->i", deltas, deltas)
+        for force_generator in self.short_range_force_generators:
+            close = squared_distances < force_generator.cutoff_radius ** 2
+            self.instrumentation.count("short_range_pairs", int(close.sum()))
+            for index_1, index_2, delta, squared_distance in zip(
+                first[close].tolist(), second[close].tolist(), deltas[close].tolist(), squared_distances[close].tolist()
+            ):
+                particle_1, particle_2 = particles[index_1], particles[index_2]
+                geometry = PairGeometry(delta, squared_distance)
+                particle_1.apply_force(compute_force(force_generator, particle_1, particle_2, geometry), particle_2)
+
+    def apply_arbitrary_laws(
+        self,
+        particle_1: Particle,
+        particle_2: Particle,
+        arbitrary_laws: Tuple[ArbitraryLaw, ...] = None,
+        geometry: PairGeometry = None,
+    ):
+        arbitrary_laws = self.arbitrary_laws if arbitrary_laws is None else arbitrary_laws
+        if geometry is None and arbitrary_laws:
+            geometry = PairGeometry.between(particle_1, particle_2)
+        for law in arbitrary_laws:
+            output = apply_law(law, particle_1, particle_2, self, geometry)
             for feature_name, data in output.items():
                 self.features[feature_name].update(data)
-        total_force = None
-        for force_generator in self.force_generators:
-            force = force_generator.compute_force(particle_1, particle_2)
-            if total_force is None:
-                total_force = force
-            for dimension, (dimensional_total_force, dimensional_force) in enumerate(zip(total_force, force)):
-                total_force[dimension] = dimensional_total_force + dimensional_force
-        particle_1.apply_force(total_force, particle_2)
-        particle_1.run()
-
-
-def process_particle_interaction(input_queue: Queue, output_queue: Queue, force_generators: Tuple[ForceGenerator]):
-    while True:
-        data = input_queue.get()
-        if data == Engine.STOP_FLAG:
-            break
-        particles_to_process: List[Particle] = data[0]
-        particles: Set[Particle] = data[1]
-        for particle_1 in particles_to_process:
-            for particle_2 in particles:
-                if particle_1 is not particle_2:
-                    total_force = None
-                    for force_generator in force_generators:
-                        force = force_generator.compute_force(particle_1, particle_2)
-                        if total_force is None:
-                            total_force = force
-                        for dimension, (dimensional_total_force, dimensional_force) in enumerate(
-                            zip(total_force, force)
-                        ):
-                            total_force[dimension] = dimensional_total_force + dimensional_force
-                    particle_1.apply_force(total_force, particle_2)
-                    particle_1.run()
-        for particle in particles_to_process:
-            particle.update()
-        output_queue.put(particles_to_process)
+
+    @staticmethod
+    def compute_total_force(
+        particle_1: Particle,
+        particle_2: Particle,
+        force_generators: Tuple[ForceGenerator, ...],
+        geometry: PairGeometry = None,
+    ) -> Optional[List[Number]]:
+        return compute_total_force(particle_1, particle_2, force_generators, geometry)
+
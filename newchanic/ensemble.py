@@ -0,0 +1,239 @@
+from __future__ import annotations
+
+from time import time
+from typing import List, NamedTuple, Sequence, Callable, Optional, Union
+
+import numpy as np
+
+from newchanic.initial_conditions import InitialConditions
+from newchanic.instrumentation import Instrumentation, NULL_INSTRUMENTATION
+from newchanic.integrators import Integrator, EulerIntegrator, BlockTimestepIntegrator
+from newchanic.laws import Gravity
+from newchanic.solvers import DEFAULT_BLOCK_SIZE
+from newchanic.utils import Number
+
+
+class EnsembleResult(NamedTuple):
+    # State of the alive particles of a member when it stopped, or when the results were asked for
+    masses: np.ndarray
+    positions: np.ndarray
+    velocities: np.ndarray
+    turns: int
+    stopped: bool
+
+
+def compute_squared_distances(positions: np.ndarray) -> np.ndarray:
+    # Squared distances between the particles of every member, from the |a|² + |b|² - 2a.b expansion
+    positions = positions - positions.mean(axis=1, keepdims=True, dtype=np.float64)
+    squared_norms = np.einsum("kij,kij->ki", positions, positions)
+    squared_distances = positions @ positions.transpose(0, 2, 1)
+    squared_distances *= -2
+    squared_distances += squared_norms[:, :, np.newaxis]
+    squared_distances += squared_norms[:, np.newaxis, :]
+    return squared_distances
+
+
+def compute_ensemble_gravity_accelerations(
+    masses: np.ndarray, positions: np.ndarray, g: np.ndarray, block_size: int = DEFAULT_BLOCK_SIZE
+) -> np.ndarray:
+    # Same kernel as compute_gravity_accelerations, for a stack of independent systems of the same particle number,
+    # computed by blocks of members of about block_size pairs
+    member_nbr, particle_nbr, _ = positions.shape
+    accelerations = np.zeros(positions.shape)
+    if particle_nbr < 2:
+        return accelerations
+    masses = np.asarray(masses, dtype=np.float64)
+    positions = positions - positions.mean(axis=1, keepdims=True, dtype=np.float64)
+    diagonal = np.arange(particle_nbr)
+    members_by_block = max(1, block_size // particle_nbr ** 2)
+    for block_start in range(0, member_nbr, members_by_block):
+        block = slice(block_start, block_start + members_by_block)
+        block_positions = positions[block]
+        weights = compute_squared_distances(block_positions)
+        # Self interactions and coincident particles do not produce any force
+        weights[:, diagonal, diagonal] = np.inf
+        weights[weights <= 0] = np.inf
+        distances = np.sqrt(weights)
+        weights *= distances
+        np.divide(masses[block, np.newaxis, :], weights, out=weights)
+        accelerations[block] = weights @ block_positions - weights.sum(axis=2)[..., np.newaxis] * block_positions
+    accelerations *= np.asarray(g, dtype=np.float64)[:, np.newaxis, np.newaxis]
+    return accelerations
+
+
+class EnsembleStore:
+    # Particles of the running members, stacked along a first axis. Members with fewer particles are padded with dead
+    # particles, which have no mass nor velocity, as the tombstones of ParticleStore.
+    def __init__(self, members: Sequence[InitialConditions]):
+        assert members, "An ensemble needs at least one member"
+        dimension_nbrs = {np.shape(member.positions)[1] for member in members}
+        assert len(dimension_nbrs) == 1, "All the members must have the same dimension number"
+        member_nbr, particle_nbr = len(members), max(len(member.masses) for member in members)
+        shape = (member_nbr, particle_nbr, dimension_nbrs.pop())
+        self.masses = np.zeros(shape[:2])
+        self.positions = np.zeros(shape)
+        self.velocities = np.zeros(shape)
+        self.alive = np.zeros(shape[:2], dtype=bool)
+        for i, (masses, positions, velocities) in enumerate(members):
+            self.masses[i, : len(masses)] = masses
+            self.positions[i, : len(masses)] = positions
+            self.velocities[i, : len(masses)] = velocities
+            self.alive[i, : len(masses)] = True
+        # Index of the running members in the sequence given to the ensemble
+        self.members = np.arange(member_nbr)
+
+    def __len__(self):
+        return self.masses.size
+
+    @property
+    def dead_nbr(self) -> int:
+        return len(self) - int(self.alive.sum())
+
+    def get_member_state(self, i: int) -> InitialConditions:
+        alive = self.alive[i]
+        return InitialConditions(self.masses[i, alive], self.positions[i, alive], self.velocities[i, alive])
+
+    def remove(self, members: np.ndarray, indexes: np.ndarray):
+        self.alive[members, indexes] = False
+        self.masses[members, indexes] = 0
+        self.velocities[members, indexes] = 0
+
+    def keep_members(self, kept: np.ndarray):
+        self.masses, self.positions = self.masses[kept], self.positions[kept]
+        self.velocities, self.alive = self.velocities[kept], self.alive[kept]
+        self.members = self.members[kept]
+
+    def compact(self):
+        # Alive particles are moved to the front of their member, then the slots dead in every member are dropped
+        order = np.argsort(~self.alive, axis=1, kind="stable")
+        particle_nbr = int(self.alive.sum(axis=1).max(initial=0))
+        order = order[:, :particle_nbr]
+        self.masses = np.take_along_axis(self.masses, order, axis=1)
+        self.alive = np.take_along_axis(self.alive, order, axis=1)
+        self.positions = np.take_along_axis(self.positions, order[..., np.newaxis], axis=1)
+        self.velocities = np.take_along_axis(self.velocities, order[..., np.newaxis], axis=1)
+
+
+class Ensemble:
+    # Independent systems under gravity, and optionally merges, advanced together: every turn costs one vectorized
+    # kernel for all the members instead of one engine turn by member. g and umd, the parameters of Gravity and Merge,
+    # are given for the whole ensemble or by member, umd=None disables the merges.
+    # stop_condition gets the ensemble after every turn and returns a boolean by running member (rows of the store),
+    # the members for which it is true are stopped and their results kept until the end of the sweep.
+    def __init__(
+        self,
+        members: Sequence[InitialConditions],
+        g: Union[Number, Sequence[Number]] = Gravity.g,
+        umd: Union[Number, Sequence[Number]] = None,
+        integrator: Integrator = None,
+        stop_condition: Callable[[Ensemble], np.ndarray] = None,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        compaction_threshold: float = 0.25,
+        instrumentation: Instrumentation = None,
+    ):
+        assert not isinstance(integrator, BlockTimestepIntegrator), "Block timesteps are not supported by ensembles"
+        assert 0 <= compaction_threshold <= 1, "compaction_threshold must be between 0 and 1"
+        self.store = EnsembleStore(members)
+        member_nbr = len(members)
+        self.g = np.broadcast_to(np.asarray(g, dtype=np.float64), member_nbr)
+        self.umd = None if umd is None else np.broadcast_to(np.asarray(umd, dtype=np.float64), member_nbr)
+        self.integrator = integrator or EulerIntegrator()
+        self.stop_condition = stop_condition
+        self.block_size = block_size
+        self.compaction_threshold = compaction_threshold
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+        self.turn = 0
+        self.results: List[Optional[EnsembleResult]] = [None] * member_nbr
+
+    def get_dimension_nbr(self) -> int:
+        return self.store.positions.shape[2]
+
+    def run(self, max_turns: int = None, max_seconds: Number = None) -> int:
+        start = time()
+        i = 0
+        while (
+            len(self.store.members)
+            and (max_turns is None or i < max_turns)
+            and (max_seconds is None or time() - start < max_seconds)
+        ):
+            if self.umd is not None:
+                with self.instrumentation.phase("local_laws"):
+                    self.apply_merges()
+            self.integrator.step(self)
+            self.instrumentation.end_turn()
+            self.turn += 1
+            i += 1
+            if self.stop_condition is not None:
+                with self.instrumentation.phase("stop_condition"):
+                    self.stop(np.asarray(self.stop_condition(self), dtype=bool))
+        return i
+
+    def compute_accelerations(self) -> np.ndarray:
+        store = self.store
+        self.instrumentation.count("force_evaluations", len(store))
+        with self.instrumentation.phase("solver"):
+            accelerations = compute_ensemble_gravity_accelerations(
+                store.masses, store.positions, self.g[store.members], self.block_size
+            )
+        # Dead particles have no mass, they must stay where they are
+        accelerations[~store.alive] = 0
+        return accelerations
+
+    def apply_merges(self):
+        # As Merge, the lighter particle of a pair closer than umd is absorbed by the heavier one, which keeps its
+        # position and gets the momentum of both. Merges are resolved between mutual nearest neighbours, so that a
+        # particle takes part in a single merge by turn and chains of close particles merge over the next turns.
+        store = self.store
+        member_nbr, particle_nbr, _ = store.positions.shape
+        umd = self.umd[store.members]
+        members_by_block = max(1, self.block_size // max(particle_nbr ** 2, 1))
+        diagonal = np.arange(particle_nbr)
+        for block_start in range(0, member_nbr, members_by_block):
+            block = slice(block_start, block_start + members_by_block)
+            squared_distances = compute_squared_distances(store.positions[block])
+            alive = store.alive[block]
+            close = (squared_distances < umd[block, np.newaxis, np.newaxis] ** 2) & alive[:, :, np.newaxis]
+            close &= alive[:, np.newaxis, :]
+            close[:, diagonal, diagonal] = False
+            squared_distances[~close] = np.inf
+            nearest = squared_distances.argmin(axis=2)
+            members, firsts = np.nonzero(close.any(axis=2))
+            seconds = nearest[members, firsts]
+            mutual = (nearest[members, seconds] == firsts) & (firsts < seconds)
+            members, firsts, seconds = members[mutual] + block_start, firsts[mutual], seconds[mutual]
+            if not len(members):
+                continue
+            # On equal masses the second particle of the pair absorbs the first one, as in Merge
+            first_masses, second_masses = store.masses[members, firsts], store.masses[members, seconds]
+            absorbed_first = first_masses <= second_masses
+            absorbers = np.where(absorbed_first, seconds, firsts)
+            absorbed = np.where(absorbed_first, firsts, seconds)
+            total_masses = first_masses + second_masses
+            store.velocities[members, absorbers] = (
+                store.velocities[members, firsts] * first_masses[:, np.newaxis]
+                + store.velocities[members, seconds] * second_masses[:, np.newaxis]
+            ) / total_masses[:, np.newaxis]
+            store.masses[members, absorbers] = total_masses
+            store.remove(members, absorbed)
+            self.instrumentation.count("merges", len(members))
+        if store.dead_nbr > self.compaction_threshold * len(store):
+            with self.instrumentation.phase("compaction"):
+                store.compact()
+
+    def stop(self, stopped: np.ndarray):
+        # Results of the stopped members are kept, and the members are dropped from the store
+        if not stopped.any():
+            return
+        for i in np.flatnonzero(stopped).tolist():
+            self.results[self.store.members[i]] = self.get_result(i, stopped=True)
+        self.store.keep_members(~stopped)
+
+    def get_result(self, i: int, stopped: bool = False) -> EnsembleResult:
+        return EnsembleResult(*(array.copy() for array in self.store.get_member_state(i)), self.turn, stopped)
+
+    def get_results(self) -> List[EnsembleResult]:
+        # Results of every member, in the order they were given, with the current state of the running ones
+        results = list(self.results)
+        for i, member in enumerate(self.store.members.tolist()):
+            results[member] = self.get_result(i)
+        return results
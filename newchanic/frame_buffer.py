@@ -0,0 +1,33 @@
+from collections import deque
+from threading import Lock
+from typing import NamedTuple, List, Any, Optional
+
+import numpy as np
+
+
+class Snapshot(NamedTuple):
+    turn: int
+    particles: List[Any]
+    masses: np.ndarray
+    positions: np.ndarray
+
+
+class FrameRingBuffer:
+    # Snapshots published by the physics thread, only the last `capacity` ones are kept
+    def __init__(self, capacity: int = 3):
+        assert capacity >= 1, "capacity must be >= 1"
+        self._frames = deque(maxlen=capacity)
+        self._lock = Lock()
+        self.published = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def publish(self, frame: Snapshot):
+        with self._lock:
+            self._frames.append(frame)
+            self.published += 1
+
+    def latest(self) -> Optional[Snapshot]:
+        with self._lock:
+            return self._frames[-1] if self._frames else None
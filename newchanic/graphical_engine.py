@@ -1,14 +1,25 @@
+from functools import partial
 from itertools import combinations
 from math import sqrt
 from random import randint
+from threading import Thread
 from time import time
-from typing import Tuple, List, Dict, Callable, Union, Any
+from typing import Tuple, List, Dict, Callable, Union, Any, Optional
 
+import numpy as np
 import pygame
 
-from engine import Engine
-from physics import Particle
-from utils import Number
+from newchanic.array_engine import ArrayEngine, ArrayParticle
+from newchanic.engine import Engine
+from newchanic.frame_buffer import FrameRingBuffer, Snapshot
+from newchanic.instrumentation import Instrumentation
+from newchanic.physics import Particle
+from newchanic.spatial import GridIndex
+from newchanic.trajectory import TrajectoryReader
+from newchanic.utils import Number
+
+# Particles up to this size are stamped pixel by pixel with numpy, bigger ones are blitted from cached sprites
+STAMPED_MAX_SIZE = 6
 
 
 class CachedPropertiesMixin:
@@ -44,10 +55,44 @@ class GraphicalOptions:
         info = pygame.display.Info()
         return info.current_w, info.current_h
 
+    def project(self, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Same projection as GraphicalParticle.compute_graphical_position, for all the particles at once
+        x_dimension, y_dimension = self.represented_dimensions
+        xs = positions[:, x_dimension] / self.zoom_level + (self.size[0] / 2 + self.shift_level[0])
+        ys = positions[:, y_dimension] / self.zoom_level + (self.size[1] / 2 + self.shift_level[1])
+        return xs.astype(int), ys.astype(int)
+
+    def get_viewport(self) -> Tuple[np.ndarray, np.ndarray]:
+        # Lower and upper corners of the window in the represented dimensions of the universe
+        size, shift = np.array(self.size, dtype=float), np.array(self.shift_level, dtype=float)
+        return (-size / 2 - shift) * self.zoom_level, (size / 2 - shift) * self.zoom_level
+
+    def compute_sizes(self, masses: np.ndarray) -> np.ndarray:
+        return np.rint(np.sqrt(masses / (self.zoom_level * 7))).astype(int)
+
+
+def map_colors(surface: pygame.Surface, colors: np.ndarray) -> np.ndarray:
+    # Vectorized pygame.Surface.map_rgb of an (n, 3) array of colors
+    shifts, losses = surface.get_shifts(), surface.get_losses()
+    mapped = np.zeros(len(colors), dtype=np.uint32)
+    for channel in range(3):
+        mapped |= (colors[:, channel].astype(np.uint32) >> losses[channel]) << shifts[channel]
+    return mapped
+
+
+def build_heat_palette(background_color: Tuple[int, int, int]) -> np.ndarray:
+    # 256 colors going from the background to red, yellow then white
+    levels = np.linspace(0, 1, 256)[:, None]
+    palette = (np.clip(levels * 3 - np.arange(3), 0, 1) * 255).astype(np.uint8)
+    palette[0] = background_color
+    return palette
+
 
 class GraphicalParticle(Particle, CachedPropertiesMixin):
-    def __init__(self, mass: Number, position: List[Number], velocity: List[Number], options: GraphicalOptions):
-        super().__init__(mass, position, velocity)
+    def __init__(
+        self, mass: Number, position: List[Number], velocity: List[Number], options: GraphicalOptions, *args, **kwargs
+    ):
+        super().__init__(mass, position, velocity, *args, **kwargs)
         self.options = options
         self.old_position: List[Number]
 
@@ -69,8 +114,28 @@ class GraphicalParticle(Particle, CachedPropertiesMixin):
         )
 
 
+class GraphicalArrayParticle(GraphicalParticle, ArrayParticle):
+    pass
+
+
 class GraphicalEngine2D(Engine):
-    def __init__(self, graphical_options: Dict[str, Any] = None, *args, **kwargs):
+    particle_type = GraphicalParticle
+
+    def __init__(
+        self,
+        graphical_options: Dict[str, Any] = None,
+        *args,
+        frames_per_second: Number = 60,
+        frame_buffer_size: int = 3,
+        density_threshold: Optional[int] = 200_000,
+        **kwargs,
+    ):
+        # With frames_per_second, the physics runs in its own thread and the window is drawn at this rate from the
+        # last published frame. Without it, a frame is drawn after each turn.
+        self.frames_per_second = frames_per_second
+        self.frames = FrameRingBuffer(frame_buffer_size)
+        # Above this number of particles in the window, a density map is drawn instead of the particles
+        self.density_threshold = density_threshold
         pygame.init()
         self._event_listeners: Dict[int, Union[Callable, Dict[int, Tuple[Callable, Tuple]]]] = {
             pygame.QUIT: self.quit,
@@ -84,6 +149,7 @@ class GraphicalEngine2D(Engine):
                 pygame.K_SPACE: (self.reset_camera, ()),
                 pygame.K_t: (self.toggle_trajectories_drawing, ()),
                 pygame.K_r: (self.rotate_camera, ()),
+                pygame.K_i: (self.toggle_overlay, ()),
             },
         }
         self.particles: List[GraphicalParticle]
@@ -91,11 +157,24 @@ class GraphicalEngine2D(Engine):
         self._represented_dimensions_generator = self._build_represented_dimensions_generator()
         self.background_color = (0, 0, 0)
         self.draw_trajectories = True
+        self.show_overlay = False
+        self._font = None
+        self._drawn_key = None
+        self._drawn_particles: List[GraphicalParticle] = []
+        self._colored_particles = None
+        self._colors = np.empty((0, 3), dtype=np.uint8)
+        self._sizes_key = None
+        self._sizes = np.empty(0, dtype=int)
+        self._sprites: Dict[Tuple[int, int, int, int], pygame.Surface] = {}
+        self._disc_offsets: Dict[int, Tuple[List[int], List[int]]] = {}
+        self._index_key = None
+        self._index: Optional[GridIndex] = None
+        self._palette: Optional[np.ndarray] = None
         self.options = GraphicalOptions(
             **(graphical_options if graphical_options else {}),
         )
         self._window = pygame.display.set_mode(self.options.size)
-        super().__init__(*args, particle_type=GraphicalParticle, particle_kwargs={"options": self.options}, **kwargs)
+        super().__init__(*args, particle_type=self.particle_type, particle_kwargs={"options": self.options}, **kwargs)
         self.options.represented_dimensions = next(self._represented_dimensions_generator)
 
     def detect_dimensions_number(self):
@@ -105,17 +184,81 @@ class GraphicalEngine2D(Engine):
             )
         return max([len(p.position) for p in self.particles])
 
+    def run(self, max_turns: int = None, max_seconds: Number = None) -> int:
+        if self.frames_per_second is None:
+            return super().run(max_turns, max_seconds)
+        return self.run_decoupled(partial(super().run, max_turns, max_seconds))
+
+    def run_multicore(self, core_nbr: int, max_turns: int = None, max_seconds: Number = None) -> int:
+        if self.frames_per_second is None:
+            return super().run_multicore(core_nbr, max_turns, max_seconds)
+        return self.run_decoupled(partial(super().run_multicore, core_nbr, max_turns, max_seconds))
+
+    def run_distributed(
+        self,
+        worker_nbr: int,
+        max_turns: int = None,
+        max_seconds: Number = None,
+        address: Tuple[str, int] = ("127.0.0.1", 0),
+        spawn_workers: bool = True,
+        theta: float = 0.0,
+    ) -> int:
+        run_physics = partial(
+            super().run_distributed, worker_nbr, max_turns, max_seconds, address, spawn_workers, theta
+        )
+        if self.frames_per_second is None:
+            return run_physics()
+        return self.run_decoupled(run_physics)
+
+    def run_decoupled(self, run_physics: Callable[[], int]) -> int:
+        outcome = {}
+
+        def run_physics_thread():
+            try:
+                outcome["turns"] = run_physics()
+            except BaseException as e:
+                outcome["error"] = e
+
+        physics = Thread(target=run_physics_thread, name="physics", daemon=True)
+        physics.start()
+        # Events are handled at the render rate, so the window stays responsive however long a turn takes
+        clock = pygame.time.Clock()
+        drawn = None
+        while physics.is_alive():
+            snapshot = self.frames.latest()
+            if snapshot is not None and (snapshot is not drawn or self._must_erase):
+                self.render(partial(self.draw_snapshot, snapshot))
+                drawn = snapshot
+            else:
+                self.handle_events()
+            clock.tick(self.frames_per_second)
+        physics.join()
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["turns"]
+
     def run_custom_engine_features(self):
+        if self.frames_per_second is not None:
+            self.frames.publish(self.take_snapshot())
+        else:
+            self.render(self.update_particles)
+
+    def render(self, draw_particles: Callable[[], None]):
         if self._must_erase:
             self.erase_particles()
         self._must_erase = not self.draw_trajectories
-        self.update_particles()
+        draw_particles()
+        if self.show_overlay:
+            self.draw_overlay()
+        self.handle_events()
+        pygame.display.flip()
+
+    def handle_events(self):
         for event in pygame.event.get():
             if event.type == pygame.KEYDOWN:
                 self.dispatch_keydown(event)
             elif event.type == pygame.QUIT:
                 self.quit()
-        pygame.display.flip()
 
     def dispatch_keydown(self, event):
         function, parameters = self._event_listeners[pygame.KEYDOWN].get(event.key, (None, None))
@@ -141,6 +284,27 @@ class GraphicalEngine2D(Engine):
     def toggle_trajectories_drawing(self):
         self.draw_trajectories = not self.draw_trajectories
 
+    def toggle_overlay(self):
+        self.show_overlay = not self.show_overlay
+        if self.show_overlay and not self.instrumentation.enabled:
+            self.instrumentation = Instrumentation()
+        self._must_erase = True
+
+    def draw_overlay(self):
+        record = self.instrumentation.last_record
+        if record is None:
+            return
+        if self._font is None:
+            self._font = pygame.font.SysFont("monospace", 14)
+        lines = [f"turn {record['turn']}"]
+        lines += [f"{name:<16} {seconds * 1000:9.3f} ms" for name, seconds in record["timings"].items()]
+        lines += [f"{name:<16} {value:>12}" for name, value in record["counters"].items()]
+        line_height = self._font.get_linesize()
+        # The background is filled so that the text stays readable when trajectories are drawn
+        pygame.draw.rect(self._window, self.background_color, (0, 0, 260, line_height * len(lines) + 10))
+        for i, line in enumerate(lines):
+            self._window.blit(self._font.render(line, True, (255, 255, 255)), (5, 5 + i * line_height))
+
     def rotate_camera(self):
         self.options.represented_dimensions = next(self._represented_dimensions_generator)
         self._must_erase = True
@@ -150,16 +314,201 @@ class GraphicalEngine2D(Engine):
             for represented_dimensions in combinations(range(self.detect_dimensions_number()), 2):
                 yield represented_dimensions
 
+    def get_drawn_state(self) -> Tuple[List[GraphicalParticle], np.ndarray, np.ndarray]:
+        # The particle list is kept between frames, as long as no particle is removed or replaced
+        if self._drawn_key != (id(self.particles), len(self.particles)):
+            self._drawn_key = (id(self.particles), len(self.particles))
+            self._drawn_particles = list(self.particles)
+        particles = self._drawn_particles
+        masses = np.array([particle.mass for particle in particles], dtype=float)
+        positions = np.array([particle.position for particle in particles], dtype=float).reshape(len(particles), -1)
+        return particles, masses, positions
+
+    def get_colors(self, particles: List[GraphicalParticle]) -> np.ndarray:
+        if particles is not self._colored_particles:
+            self._colored_particles = particles
+            self._colors = np.array([particle.get_or_create("color") for particle in particles], dtype=np.uint8)
+            self._colors = self._colors.reshape(len(particles), 3)
+        return self._colors
+
+    def get_sizes(self, masses: np.ndarray) -> np.ndarray:
+        # Sizes only depend on the masses and the zoom, which rarely change from a frame to another
+        if (
+            self._sizes_key is None
+            or self._sizes_key[0] != self.options.zoom_level
+            or not np.array_equal(self._sizes_key[1], masses)
+        ):
+            self._sizes_key = (self.options.zoom_level, masses.copy())
+            self._sizes = self.options.compute_sizes(masses)
+        return self._sizes
+
+    def take_snapshot(self) -> Snapshot:
+        # The arrays are copied since the physics thread keeps on updating them while the frame is drawn
+        particles, masses, positions = self.get_drawn_state()
+        return Snapshot(self.turn, particles, masses.copy(), positions.copy())
+
+    def get_index(self, snapshot: Snapshot) -> GridIndex:
+        # The index is kept while the same snapshot is drawn, e.g. when the view moves faster than the physics
+        key = (snapshot, self.options.represented_dimensions)
+        if self._index_key is None or self._index_key[0] is not snapshot or self._index_key[1] != key[1]:
+            self._index = GridIndex(snapshot.positions[:, list(self.options.represented_dimensions)])
+            self._index_key = key
+        return self._index
+
+    def get_snapshot_colors(self, snapshot: Snapshot) -> np.ndarray:
+        return self.get_colors(snapshot.particles)
+
+    def draw_snapshot(self, snapshot: Snapshot):
+        if not len(snapshot.masses):
+            return
+        index = self.get_index(snapshot)
+        lower, upper = self.options.get_viewport()
+        if self.density_threshold is not None and index.count(lower, upper) > self.density_threshold:
+            self.draw_density(index.density(lower, upper, self._window.get_size()))
+            return
+        sizes = self.get_sizes(snapshot.masses)
+        # Only the particles whose disc may overlap the window are drawn
+        margin = (int(sizes.max()) + 1) * self.options.zoom_level
+        visible = index.query(lower - margin, upper + margin)
+        xs, ys = self.options.project(snapshot.positions[visible])
+        self.draw_points(xs, ys, sizes[visible], self.get_snapshot_colors(snapshot)[visible])
+
+    def draw_density(self, density: np.ndarray):
+        if self._palette is None:
+            self._palette = map_colors(self._window, build_heat_palette(self.background_color))
+        levels = np.log1p(density)
+        levels *= 255 / max(levels.max(), 1e-12)
+        pixels = pygame.surfarray.pixels2d(self._window)
+        pixels[...] = self._palette[np.ceil(levels).astype(np.uint8)]
+        del pixels
+
     def update_particles(self):
-        particle: GraphicalParticle
-        for particle in self.particles:
-            pygame.draw.circle(
-                self._window,
-                particle.get_or_create("color"),
-                [int(i) for i in particle.get_updated("graphical_position")],
-                particle.get_updated("size"),
-                particle.get_updated("size"),
+        self.draw_snapshot(Snapshot(self.turn, *self.get_drawn_state()))
+
+    def draw_points(self, xs: np.ndarray, ys: np.ndarray, sizes: np.ndarray, colors: np.ndarray):
+        width, height = self._window.get_size()
+        on_screen = (xs + sizes >= 0) & (xs - sizes < width) & (ys + sizes >= 0) & (ys - sizes < height)
+        stamped = on_screen & (sizes <= STAMPED_MAX_SIZE)
+        if stamped.any():
+            pixels = pygame.surfarray.pixels2d(self._window)
+            mapped_colors = map_colors(self._window, colors[stamped])
+            stamped_xs, stamped_ys, stamped_sizes = xs[stamped], ys[stamped], sizes[stamped]
+            for size in np.unique(stamped_sizes).tolist():
+                selected = stamped_sizes == size
+                selected_xs, selected_ys, selected_colors = (
+                    stamped_xs[selected],
+                    stamped_ys[selected],
+                    mapped_colors[selected],
+                )
+                # One vectorized write by pixel of the disc, for all the particles of this size
+                for dx, dy in zip(*self.get_disc_offsets(size)):
+                    x, y = selected_xs + dx, selected_ys + dy
+                    inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+                    pixels[x[inside], y[inside]] = selected_colors[inside]
+            del pixels
+        # The other ones are blitted in one call from sprites cached by color and size
+        discs = np.flatnonzero(on_screen & (sizes > STAMPED_MAX_SIZE))
+        if len(discs):
+            self._window.blits(
+                [
+                    (self.get_sprite(*color, size), (x - size, y - size))
+                    for color, size, x, y in zip(
+                        colors[discs].tolist(), sizes[discs].tolist(), xs[discs].tolist(), ys[discs].tolist()
+                    )
+                ],
+                doreturn=False,
             )
 
+    def get_disc_offsets(self, size: int) -> Tuple[List[int], List[int]]:
+        # Offsets of the pixels pygame.draw.circle fills, so that stamped and blitted particles look the same
+        offsets = self._disc_offsets.get(size)
+        if offsets is None:
+            disc = pygame.Surface((2 * size + 1, 2 * size + 1))
+            pygame.draw.circle(disc, (255, 255, 255), (size, size), size, size)
+            dxs, dys = np.nonzero(pygame.surfarray.array2d(disc))
+            offsets = (dxs - size).tolist() or [0], (dys - size).tolist() or [0]
+            self._disc_offsets[size] = offsets
+        return offsets
+
+    def get_sprite(self, red: int, green: int, blue: int, size: int) -> pygame.Surface:
+        key = (red, green, blue, size)
+        sprite = self._sprites.get(key)
+        if sprite is None:
+            sprite = pygame.Surface((2 * size + 1, 2 * size + 1))
+            sprite.fill(self.background_color)
+            pygame.draw.circle(sprite, (red, green, blue), (size, size), size, size)
+            # Particle colors are never as dark as the background, which can then be the transparent color
+            sprite.set_colorkey(self.background_color)
+            self._sprites[key] = sprite
+        return sprite
+
     def erase_particles(self):
         self._window.fill(self.background_color)
+
+
+class GraphicalArrayEngine2D(GraphicalEngine2D, ArrayEngine):
+    particle_type = GraphicalArrayParticle
+
+    def get_drawn_state(self) -> Tuple[List[GraphicalArrayParticle], np.ndarray, np.ndarray]:
+        particles, masses, positions, _ = self.get_state()
+        return particles, masses, positions
+
+
+class GraphicalReplay2D(GraphicalEngine2D):
+    # Plays a file written by TrajectoryRecorder: no force is computed, frames are read from the memory-mapped file
+    def __init__(self, path: str, graphical_options: Dict[str, Any] = None, seek_step: int = 100):
+        self.reader = TrajectoryReader(path)
+        self.frame_index = 0
+        self.playing = True
+        self._color_table = np.empty((0, 3), dtype=np.uint8)
+        self._snapshot: Optional[Snapshot] = None
+        super().__init__(graphical_options, particle_number=0, frames_per_second=None)
+        self._event_listeners[pygame.KEYDOWN].update(
+            {
+                pygame.K_p: (self.toggle_playing, ()),
+                pygame.K_COMMA: (self.seek, (-1,)),
+                pygame.K_PERIOD: (self.seek, (1,)),
+                pygame.K_PAGEUP: (self.seek, (-seek_step,)),
+                pygame.K_PAGEDOWN: (self.seek, (seek_step,)),
+                pygame.K_HOME: (self.seek, (-len(self.reader),)),
+                pygame.K_END: (self.seek, (len(self.reader),)),
+            }
+        )
+
+    def detect_dimensions_number(self):
+        return self.reader.dimension_nbr
+
+    def run(self, max_turns: int = None, max_seconds: Number = None) -> int:
+        start = time()
+        i = 0
+        while self.must_continue(i, start, max_turns, max_seconds):
+            self.run_custom_engine_features()
+            if self.playing and self.frame_index < len(self.reader) - 1:
+                self.frame_index += 1
+            i += 1
+        return i
+
+    def toggle_playing(self):
+        self.playing = not self.playing
+
+    def seek(self, frame_shift: int):
+        self.frame_index = min(max(self.frame_index + frame_shift, 0), max(len(self.reader) - 1, 0))
+        self._must_erase = True
+
+    def update_particles(self):
+        if not len(self.reader):
+            return
+        frame = self.reader[self.frame_index]
+        if self._snapshot is None or self._snapshot.turn != frame.turn:
+            # Without recorded masses, particles are drawn as if they weighed 28, i.e. with a size of 2 at zoom 1
+            masses = np.full(len(frame.ids), 28.0) if frame.masses is None else frame.masses
+            self._snapshot = Snapshot(frame.turn, frame.ids, masses, frame.positions)
+        self.draw_snapshot(self._snapshot)
+
+    def get_snapshot_colors(self, snapshot: Snapshot) -> np.ndarray:
+        ids = snapshot.particles
+        if len(ids) and ids.max() >= len(self._color_table):
+            # Colors are indexed by particle id, new ids get random colors as GraphicalParticle does
+            new_colors = np.random.randint(50, 256, size=(int(ids.max()) + 1 - len(self._color_table), 3))
+            self._color_table = np.concatenate([self._color_table, new_colors.astype(np.uint8)])
+        return self._color_table[ids]
@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+from typing import NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+from newchanic.laws import Gravity
+from newchanic.utils import Number
+
+
+class InitialConditions(NamedTuple):
+    # Arrays of the particles, given to the engines in one call instead of through per index callables
+    masses: np.ndarray
+    positions: np.ndarray
+    velocities: np.ndarray
+
+    def shifted(self, offset: Sequence[Number], velocity: Sequence[Number]) -> InitialConditions:
+        return InitialConditions(self.masses, self.positions + offset, self.velocities + velocity)
+
+
+def concatenate(*conditions: InitialConditions) -> InitialConditions:
+    return InitialConditions(*(np.concatenate(arrays) for arrays in zip(*conditions)))
+
+
+def from_callables(particle_nbr: int, get_mass, get_position, get_velocity) -> InitialConditions:
+    # The per index API of the engines
+    masses = np.array([get_mass(i) for i in range(particle_nbr)], dtype=float)
+    # Without any particle there is no dimension, as for the objects engine
+    shape = (particle_nbr, -1 if particle_nbr else 0)
+    positions = np.array([get_position(i) for i in range(particle_nbr)], dtype=float).reshape(shape)
+    velocities = np.array([get_velocity(i) for i in range(particle_nbr)], dtype=float).reshape(shape)
+    return InitialConditions(masses, positions, velocities)
+
+
+def random_directions(rng: np.random.Generator, particle_nbr: int, dimension_nbr: int = 3) -> np.ndarray:
+    # Normalized gaussian vectors are uniformly distributed on the sphere
+    directions = rng.standard_normal((particle_nbr, dimension_nbr))
+    norms = np.linalg.norm(directions, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return directions / norms
+
+
+def to_center_of_mass_frame(conditions: InitialConditions) -> InitialConditions:
+    masses = conditions.masses
+    total_mass = masses.sum()
+    return InitialConditions(
+        masses,
+        conditions.positions - masses @ conditions.positions / total_mass,
+        conditions.velocities - masses @ conditions.velocities / total_mass,
+    )
+
+
+def uniform_box(
+    particle_nbr: int,
+    lower_corner: Sequence[Number] = (-1000, -500, -500),
+    upper_corner: Sequence[Number] = (1000, 500, 500),
+    mass_range: Tuple[Number, Number] = (10, 100),
+    seed: int = None,
+) -> InitialConditions:
+    # Particles at rest, the default universe of the engines
+    rng = np.random.default_rng(seed)
+    lower_corner, upper_corner = np.asarray(lower_corner, dtype=float), np.asarray(upper_corner, dtype=float)
+    return InitialConditions(
+        rng.uniform(*mass_range, particle_nbr),
+        rng.uniform(lower_corner, upper_corner, (particle_nbr, len(lower_corner))),
+        np.zeros((particle_nbr, len(lower_corner))),
+    )
+
+
+def plummer_sphere(
+    particle_nbr: int,
+    total_mass: Number = 10000,
+    scale_radius: Number = 100,
+    g: Number = Gravity.g,
+    max_radius: Number = 20,
+    seed: int = None,
+) -> InitialConditions:
+    # Plummer model in virial equilibrium, sampled as in Aarseth, Hénon & Wielen (1974). Radiuses are cut at
+    # max_radius scale radiuses so that a few particles do not start far away from the others.
+    rng = np.random.default_rng(seed)
+    max_fraction = max_radius ** 3 / (1 + max_radius ** 2) ** 1.5
+    # Fraction of the mass inside the radius, 1 - uniform never gives a null radius
+    fractions = (1 - rng.uniform(0, 1, particle_nbr)) * max_fraction
+    radiuses = scale_radius / np.sqrt(fractions ** (-2 / 3) - 1)
+    positions = random_directions(rng, particle_nbr) * radiuses[:, np.newaxis]
+    # Speeds relative to the escape speed follow q² (1 - q²)^3.5, whose maximum is below 0.1, by rejection
+    ratios = np.empty(particle_nbr)
+    pending = np.arange(particle_nbr)
+    while len(pending):
+        candidates = rng.uniform(0, 1, len(pending))
+        accepted = rng.uniform(0, 0.1, len(pending)) < candidates ** 2 * (1 - candidates ** 2) ** 3.5
+        ratios[pending[accepted]] = candidates[accepted]
+        pending = pending[~accepted]
+    escape_speeds = np.sqrt(2 * g * total_mass) * (radiuses ** 2 + scale_radius ** 2) ** -0.25
+    velocities = random_directions(rng, particle_nbr) * (ratios * escape_speeds)[:, np.newaxis]
+    return to_center_of_mass_frame(
+        InitialConditions(np.full(particle_nbr, total_mass / particle_nbr), positions, velocities)
+    )
+
+
+def rotating_disk(
+    particle_nbr: int,
+    radius: Number = 1000,
+    inner_radius: Number = 50,
+    central_mass: Number = 100000,
+    disk_mass: Number = 10000,
+    thickness: Number = 10,
+    g: Number = Gravity.g,
+    dimension_nbr: int = 3,
+    seed: int = None,
+) -> InitialConditions:
+    # A central body, then particles uniformly spread over an annulus of the xy plane on circular orbits around the
+    # mass closer to the center than them
+    assert dimension_nbr in (2, 3), "dimension_nbr must be 2 or 3"
+    assert particle_nbr >= 1, "The disk needs at least its central body"
+    rng = np.random.default_rng(seed)
+    disk_nbr = particle_nbr - 1
+    radiuses = np.sqrt(rng.uniform(inner_radius ** 2, radius ** 2, disk_nbr))
+    angles = rng.uniform(0, 2 * np.pi, disk_nbr)
+    masses = np.full(disk_nbr, disk_mass / max(disk_nbr, 1))
+    enclosed_masses = central_mass + np.argsort(np.argsort(radiuses)) * masses
+    speeds = np.sqrt(g * enclosed_masses / radiuses)
+    positions = np.zeros((particle_nbr, dimension_nbr))
+    velocities = np.zeros((particle_nbr, dimension_nbr))
+    positions[1:, 0], positions[1:, 1] = radiuses * np.cos(angles), radiuses * np.sin(angles)
+    velocities[1:, 0], velocities[1:, 1] = -speeds * np.sin(angles), speeds * np.cos(angles)
+    if dimension_nbr == 3:
+        positions[1:, 2] = rng.normal(0, thickness, disk_nbr)
+    return to_center_of_mass_frame(InitialConditions(np.concatenate(([central_mass], masses)), positions, velocities))
+
+
+def colliding_clusters(
+    particle_nbr: int,
+    separation: Number = 1000,
+    relative_speed: Number = 1,
+    impact_parameter: Number = 100,
+    total_mass: Number = 10000,
+    scale_radius: Number = 100,
+    g: Number = Gravity.g,
+    seed: int = None,
+) -> InitialConditions:
+    # Two Plummer spheres of half the particles and half the mass each, heading to each other along x
+    rng = np.random.default_rng(seed)
+    first_nbr = particle_nbr // 2
+    clusters = [
+        plummer_sphere(nbr, total_mass / 2, scale_radius, g, seed=rng.integers(2 ** 32))
+        for nbr in (first_nbr, particle_nbr - first_nbr)
+    ]
+    half_offset = np.array([separation, impact_parameter, 0]) / 2
+    half_velocity = np.array([relative_speed / 2, 0, 0])
+    return concatenate(
+        clusters[0].shifted(-half_offset, half_velocity), clusters[1].shifted(half_offset, -half_velocity)
+    )
+
+
+GENERATORS = {
+    "uniform": uniform_box,
+    "plummer": plummer_sphere,
+    "disk": rotating_disk,
+    "clusters": colliding_clusters,
+}
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import csv
+import json
+from time import perf_counter
+from typing import Dict, Any, List, Iterable, Optional
+
+from newchanic.utils import Number
+
+
+class Sink:
+    def write(self, record: Dict[str, Any]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemorySink(Sink):
+    def __init__(self):
+        self.records: List[Dict[str, Any]] = []
+
+    def write(self, record: Dict[str, Any]):
+        self.records.append(record)
+
+
+class JsonLinesSink(Sink):
+    def __init__(self, path: str):
+        self._file = open(path, "w")
+
+    def write(self, record: Dict[str, Any]):
+        self._file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+class CsvSink(Sink):
+    # One row by measure, since the phases and counters may change from a turn to another
+    def __init__(self, path: str):
+        self._file = open(path, "w", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(("turn", "kind", "name", "value"))
+
+    def write(self, record: Dict[str, Any]):
+        for kind in ("timings", "counters"):
+            for name, value in record[kind].items():
+                self._writer.writerow((record["turn"], kind, name, value))
+
+    def close(self):
+        self._file.close()
+
+
+class Phase:
+    __slots__ = ("instrumentation", "name", "start")
+
+    def __init__(self, instrumentation: Instrumentation, name: str):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        timings = self.instrumentation.timings
+        timings[self.name] = timings.get(self.name, 0) + perf_counter() - self.start
+
+
+class Instrumentation:
+    enabled = True
+
+    def __init__(self, sinks: Iterable[Sink] = ()):
+        self.sinks = list(sinks)
+        self.turn = 0
+        self.timings: Dict[str, float] = {}
+        self.counters: Dict[str, Number] = {}
+        self.last_record: Optional[Dict[str, Any]] = None
+
+    def phase(self, name: str) -> Phase:
+        return Phase(self, name)
+
+    def count(self, name: str, value: Number = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def end_turn(self):
+        self.last_record = {"turn": self.turn, "timings": self.timings, "counters": self.counters}
+        for sink in self.sinks:
+            sink.write(self.last_record)
+        self.turn += 1
+        self.timings = {}
+        self.counters = {}
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+class NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class NullInstrumentation:
+    # Used when instrumentation is disabled: every call is a no-op and nothing is allocated
+    enabled = False
+    last_record = None
+    _phase = NullPhase()
+
+    def phase(self, name: str) -> NullPhase:
+        return self._phase
+
+    def count(self, name: str, value: Number = 1):
+        pass
+
+    def end_turn(self):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
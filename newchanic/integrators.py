@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+from typing import Optional
+
+import numpy as np
+
+from newchanic.utils import Number
+
+
+class Integrator:
+    # Advances the store of an ArrayEngine by dt, from the accelerations given by engine.compute_accelerations
+    def __init__(self, dt: Number = 1.0):
+        assert dt > 0, "dt must be > 0"
+        self.dt = dt
+
+    def step(self, engine):
+        raise NotImplementedError
+
+
+class EulerIntegrator(Integrator):
+    # Semi-implicit Euler, the historical scheme of the engines when dt = 1
+    def step(self, engine):
+        store = engine.store
+        accelerations = engine.compute_accelerations()
+        with engine.instrumentation.phase("integration"):
+            accelerations *= self.dt
+            store.velocities += accelerations
+            store.positions += store.velocities * self.dt
+
+
+class LeapfrogIntegrator(Integrator):
+    # Kick-drift-kick leapfrog, i.e. velocity Verlet: symplectic and time reversible, so the energy error stays bounded.
+    # The accelerations computed at the end of a turn are reused at the beginning of the next one.
+    def __init__(self, dt: Number = 1.0):
+        super().__init__(dt)
+        self._accelerations: Optional[np.ndarray] = None
+        self._masses: Optional[np.ndarray] = None
+        self._positions: Optional[np.ndarray] = None
+
+    def get_accelerations(self, engine) -> np.ndarray:
+        # The cache is dropped when particles have been removed, merged or moved by a law since the last turn
+        store = engine.store
+        if (
+            self._accelerations is None
+            or self._positions.shape != store.positions.shape
+            or not np.array_equal(self._masses, store.masses)
+            or not np.array_equal(self._positions, store.positions)
+        ):
+            self._accelerations = engine.compute_accelerations()
+        return self._accelerations
+
+    def remember(self, engine, accelerations: np.ndarray):
+        self._masses = engine.store.masses.copy()
+        self._positions = engine.store.positions.copy()
+        self._accelerations = accelerations
+
+    def step(self, engine):
+        store = engine.store
+        half_dt = self.dt / 2
+        accelerations = self.get_accelerations(engine)
+        with engine.instrumentation.phase("integration"):
+            store.velocities += accelerations * half_dt
+            store.positions += store.velocities * self.dt
+        accelerations = engine.compute_accelerations()
+        with engine.instrumentation.phase("integration"):
+            store.velocities += accelerations * half_dt
+        self.remember(engine, accelerations)
+
+
+class BlockTimestepIntegrator(LeapfrogIntegrator):
+    # Hierarchical block timesteps: a particle of level l is stepped with dt / 2**l, where the level is chosen at the
+    # beginning of every turn so that dt / 2**l <= eta * sqrt(length / |a|). Only the particles at the end of their
+    # own step get new accelerations, so particles far from close encounters cost a single evaluation by turn.
+    def __init__(self, dt: Number = 1.0, max_level: int = 8, eta: Number = 0.05, length: Number = 1.0):
+        assert max_level >= 0, "max_level must be >= 0"
+        super().__init__(dt)
+        self.max_level = max_level
+        self.eta = eta
+        self.length = length
+
+    def compute_levels(self, accelerations: np.ndarray) -> np.ndarray:
+        norms = np.sqrt(np.einsum("ij,ij->i", accelerations, accelerations))
+        with np.errstate(divide="ignore"):
+            timesteps = self.eta * np.sqrt(self.length / norms)
+            levels = np.ceil(np.log2(self.dt / timesteps))
+        return np.clip(levels, 0, self.max_level).astype(int)
+
+    def step(self, engine):
+        store = engine.store
+        accelerations = self.get_accelerations(engine).copy()
+        levels = self.compute_levels(accelerations)
+        finest_level = int(levels.max(initial=0))
+        substep_nbr = 2 ** finest_level
+        substep = self.dt / substep_nbr
+        # Substeps between two kicks of each particle, and their half timesteps
+        periods = 2 ** (finest_level - levels)
+        half_dts = (self.dt / 2 ** levels / 2)[:, np.newaxis]
+        # Every particle starts its step together with the turn
+        kicked = np.ones(len(levels), dtype=bool)
+        for i in range(substep_nbr):
+            with engine.instrumentation.phase("integration"):
+                store.velocities[kicked] += accelerations[kicked] * half_dts[kicked]
+                store.positions += store.velocities * substep
+            # Particles ending their step are kicked with the accelerations at their new positions, then start their
+            # next step with the same accelerations
+            ending = np.flatnonzero((i + 1) % periods == 0)
+            if not len(ending):
+                kicked[:] = False
+                continue
+            accelerations[ending] = engine.compute_accelerations(ending)
+            with engine.instrumentation.phase("integration"):
+                store.velocities[ending] += accelerations[ending] * half_dts[ending]
+            kicked[:] = False
+            kicked[ending] = True
+        self.remember(engine, accelerations)
+
+
+def compute_energy(masses: np.ndarray, positions: np.ndarray, velocities: np.ndarray, g: Number) -> float:
+    # Kinetic plus gravitational potential energy, used to measure the error of the integrators
+    kinetic = 0.5 * np.einsum("i,ij,ij->", masses, velocities, velocities)
+    potential = 0.0
+    for i in range(len(positions) - 1):
+        distances = np.linalg.norm(positions[i + 1 :] - positions[i], axis=1)
+        potential -= g * masses[i] * np.sum(masses[i + 1 :] / distances)
+    return float(kinetic + potential)
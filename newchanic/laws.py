@@ -1,31 +1,67 @@
-from typing import List, Dict, Set
+from __future__ import annotations
 
-from newchanic.engine import Engine
-from newchanic.physics import ForceGenerator, ReadOnlyParticle, ArbitraryLaw, Particle
-from newchanic.utils import Number, compute_multi_dimensional_distance
+from typing import List, Dict, Set, TYPE_CHECKING
+
+import numpy as np
+
+from newchanic.physics import ForceGenerator, ReadOnlyParticle, ArbitraryLaw, Particle, PairGeometry
+from newchanic.utils import Number
+
+if TYPE_CHECKING:
+    from newchanic.engine import Engine
+
+
+def compute_gravity_block_forces(
+    g: Number, masses: np.ndarray, positions: np.ndarray, other_masses: np.ndarray, other_positions: np.ndarray
+) -> np.ndarray:
+    deltas = other_positions[np.newaxis] - positions[:, np.newaxis]
+    squared_distances = np.einsum("ijk,ijk->ij", deltas, deltas)
+    # Coincident particles, including a particle with itself, do not produce any force
+    squared_distances[squared_distances == 0] = np.inf
+    weights = other_masses / (squared_distances * np.sqrt(squared_distances))
+    return g * masses[:, np.newaxis] * np.einsum("ij,ijk->ik", weights, deltas)
 
 
 class Gravity(ForceGenerator):
     g = 0.005
 
     def compute_force(self, particle: ReadOnlyParticle, other_particle: ReadOnlyParticle) -> List[Number]:
-        distance = compute_multi_dimensional_distance(particle.position, other_particle.position)
-        force = self.g * particle.mass * other_particle.mass / distance ** 2
-        vector_force = []
-        for p1_dimensional_position, p2_dimensional_position in zip(particle.position, other_particle.position):
-            vector_force.append((p1_dimensional_position - p2_dimensional_position) * force / distance)
-        return vector_force
+        geometry = PairGeometry.between(particle, other_particle)
+        return self.compute_force_from_geometry(particle, other_particle, geometry)
+
+    def compute_force_from_geometry(
+        self, particle: ReadOnlyParticle, other_particle: ReadOnlyParticle, geometry: PairGeometry
+    ) -> List[Number]:
+        inverse_distance = geometry.inverse_distance
+        # Norm of the force divided by the distance, so that it only has to be multiplied by the delta
+        force = self.g * particle.mass * other_particle.mass * inverse_distance * inverse_distance * inverse_distance
+        return [dimensional_delta * force for dimensional_delta in geometry.delta]
+
+    def compute_block_forces(
+        self, masses: np.ndarray, positions: np.ndarray, other_masses: np.ndarray, other_positions: np.ndarray
+    ) -> np.ndarray:
+        return compute_gravity_block_forces(self.g, masses, positions, other_masses, other_positions)
 
 
 class Merge(ArbitraryLaw):
     umd = 3
 
+    @property
+    def interaction_radius(self) -> Number:
+        return self.umd
+
     def apply(self, particle: Particle, other_particle: Particle, engine: Engine) -> Dict[str, Set[Particle]]:
+        geometry = PairGeometry.between(particle, other_particle)
+        return self.apply_with_geometry(particle, other_particle, engine, geometry)
+
+    def apply_with_geometry(
+        self, particle: Particle, other_particle: Particle, engine: Engine, geometry: PairGeometry
+    ) -> Dict[str, Set[Particle]]:
         if particle.mass > other_particle.mass:
             particle, other_particle = other_particle, particle
         if (
             other_particle not in engine.features["remove"].particles_to_remove
-            and compute_multi_dimensional_distance(particle.position, other_particle.position) < self.umd
+            and geometry.distance < self.umd
             # < other_particle.compute_size() + particle.compute_size()
         ):
             total_mass = particle.mass + other_particle.mass
@@ -42,6 +78,7 @@ class Merge(ArbitraryLaw):
                 ],
             )
             particles_to_remove = {particle}
+            engine.instrumentation.count("merges")
         else:
             particles_to_remove = {}
 
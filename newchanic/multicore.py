@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+from multiprocessing import Process, Barrier
+from multiprocessing.shared_memory import SharedMemory
+from threading import BrokenBarrierError
+from typing import Dict, Tuple, Optional
+
+import numpy as np
+
+from newchanic.physics import ForceGenerator, ArrayParticle, ParticleStore, compute_total_force, uses_block_forces
+from newchanic.solvers import DirectSolver, compute_block_accelerations
+
+# Indexes of the control array shared between the engine and its workers
+PARTICLE_NBR, STOP_FLAG = 0, 1
+
+
+class SharedParticleState:
+    def __init__(
+        self, capacity: int, dimension_nbr: int, names: Dict[str, str] = None, dtype: np.dtype = np.float64
+    ):
+        # Created by the engine when names is None, attached by the workers otherwise
+        shapes = {
+            "masses": ((capacity,), dtype),
+            "positions": ((capacity, dimension_nbr), dtype),
+            "velocities": ((capacity, dimension_nbr), dtype),
+            "accelerations": ((capacity, dimension_nbr), dtype),
+            "control": ((2,), np.int64),
+        }
+        self._memories: Dict[str, SharedMemory] = {}
+        for field, (shape, dtype) in shapes.items():
+            if names is None:
+                size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                memory = SharedMemory(create=True, size=size)
+            else:
+                memory = SharedMemory(name=names[field])
+            self._memories[field] = memory
+            setattr(self, field, np.ndarray(shape, dtype=dtype, buffer=memory.buf))
+        self.masses: np.ndarray
+        self.positions: np.ndarray
+        self.velocities: np.ndarray
+        self.accelerations: np.ndarray
+        self.control: np.ndarray
+        if names is None:
+            self.control[:] = 0
+
+    @property
+    def names(self) -> Dict[str, str]:
+        return {field: memory.name for field, memory in self._memories.items()}
+
+    def close(self):
+        # Arrays must be released before their buffer can be closed
+        for field in self._memories:
+            setattr(self, field, None)
+        for memory in self._memories.values():
+            memory.close()
+
+    def unlink(self):
+        for memory in self._memories.values():
+            memory.unlink()
+
+
+def split_range(item_nbr: int, index: int, slice_nbr: int) -> Tuple[int, int]:
+    return item_nbr * index // slice_nbr, item_nbr * (index + 1) // slice_nbr
+
+
+def compute_target_accelerations(
+    masses: np.ndarray,
+    positions: np.ndarray,
+    velocities: np.ndarray,
+    start: int,
+    stop: int,
+    solver: Optional[DirectSolver],
+    solved_force_generators: Tuple[ForceGenerator, ...],
+    pairwise_force_generators: Tuple[ForceGenerator, ...],
+) -> np.ndarray:
+    # Accelerations of the particles start to stop caused by all the particles, shared by every kind of worker
+    accelerations = np.zeros((stop - start, positions.shape[1]))
+    for force_generator in solved_force_generators:
+        accelerations += solver.compute_accelerations(force_generator, masses, positions, start, stop)
+    batch_force_generators = tuple(filter(uses_block_forces, pairwise_force_generators))
+    if batch_force_generators:
+        accelerations += compute_block_accelerations(batch_force_generators, masses, positions, np.arange(start, stop))
+    pairwise_force_generators = tuple(f for f in pairwise_force_generators if f not in batch_force_generators)
+    if pairwise_force_generators:
+        # Force generators see read only views over the arrays
+        store = ParticleStore(masses, positions, velocities, dtype=positions.dtype)
+        # Particles without mass are removed particles waiting for the compaction of the store, they do not interact
+        particles = [ArrayParticle.view(store, index) for index in np.flatnonzero(masses).tolist()]
+        for particle_1 in particles:
+            if not start <= particle_1.index < stop:
+                continue
+            acceleration = accelerations[particle_1.index - start]
+            for particle_2 in particles:
+                if particle_1 is not particle_2:
+                    total_force = compute_total_force(particle_1, particle_2, pairwise_force_generators)
+                    if total_force is not None:
+                        acceleration -= np.asarray(total_force) / particle_1.mass
+    return accelerations
+
+
+def compute_accelerations_slice(
+    state: SharedParticleState,
+    start: int,
+    stop: int,
+    solver: Optional[DirectSolver],
+    solved_force_generators: Tuple[ForceGenerator, ...],
+    pairwise_force_generators: Tuple[ForceGenerator, ...],
+) -> np.ndarray:
+    particle_nbr = int(state.control[PARTICLE_NBR])
+    return compute_target_accelerations(
+        state.masses[:particle_nbr],
+        state.positions[:particle_nbr],
+        state.velocities[:particle_nbr],
+        start,
+        stop,
+        solver,
+        solved_force_generators,
+        pairwise_force_generators,
+    )
+
+
+def run_worker(
+    names: Dict[str, str],
+    capacity: int,
+    dimension_nbr: int,
+    worker_index: int,
+    worker_nbr: int,
+    barrier: Barrier,
+    solver: Optional[DirectSolver],
+    solved_force_generators: Tuple[ForceGenerator, ...],
+    pairwise_force_generators: Tuple[ForceGenerator, ...],
+    dtype: np.dtype,
+):
+    state = SharedParticleState(capacity, dimension_nbr, names, dtype)
+    try:
+        while True:
+            barrier.wait()
+            if state.control[STOP_FLAG]:
+                break
+            start, stop = split_range(int(state.control[PARTICLE_NBR]), worker_index, worker_nbr)
+            # Each worker only writes its own slice of the accelerations
+            state.accelerations[start:stop] = compute_accelerations_slice(
+                state, start, stop, solver, solved_force_generators, pairwise_force_generators
+            )
+            barrier.wait()
+    except BrokenBarrierError:
+        pass
+    except BaseException:
+        barrier.abort()
+        raise
+    finally:
+        state.close()
+
+
+class WorkerPool:
+    def __init__(
+        self,
+        worker_nbr: int,
+        capacity: int,
+        dimension_nbr: int,
+        solver: Optional[DirectSolver],
+        solved_force_generators: Tuple[ForceGenerator, ...],
+        pairwise_force_generators: Tuple[ForceGenerator, ...],
+        dtype: np.dtype = np.float64,
+    ):
+        assert worker_nbr > 0, "worker_nbr must be > 0"
+        self.capacity = capacity
+        self.solved_force_generators = solved_force_generators
+        # Workers exchange the particles with the precision of the engine's store
+        self.state = SharedParticleState(capacity, dimension_nbr, dtype=dtype)
+        # Workers live as long as the pool and are synchronized twice per turn: once to start, once when done
+        self.barrier = Barrier(worker_nbr + 1)
+        self.workers = [
+            Process(
+                target=run_worker,
+                args=(
+                    self.state.names,
+                    capacity,
+                    dimension_nbr,
+                    index,
+                    worker_nbr,
+                    self.barrier,
+                    solver,
+                    solved_force_generators,
+                    pairwise_force_generators,
+                    dtype,
+                ),
+                daemon=True,
+            )
+            for index in range(worker_nbr)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def compute_accelerations(self, particle_nbr: int) -> np.ndarray:
+        # Masses and positions of the particle_nbr first particles must have been written in state beforehand
+        assert particle_nbr <= self.capacity, "The pool is too small for this number of particles"
+        self.state.control[PARTICLE_NBR] = particle_nbr
+        self.barrier.wait()
+        self.barrier.wait()
+        return self.state.accelerations[:particle_nbr]
+
+    def close(self):
+        self.state.control[STOP_FLAG] = 1
+        try:
+            self.barrier.wait()
+        except BrokenBarrierError:
+            pass
+        for worker in self.workers:
+            worker.join()
+        self.state.close()
+        self.state.unlink()
+
+    def __enter__(self) -> WorkerPool:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,27 +1,39 @@
 from __future__ import annotations
 
-from typing import List, Dict, Set
+from math import sqrt
+from typing import List, Dict, Set, Iterable, Optional, Tuple, Any, Union
 
-from utils import Number
+import numpy as np
+
+from newchanic.utils import Number, overrides_batch_method
 
 
 class DelayedUpdateMixin:
     # todo : move to utils
+    __slots__ = ("_next_values",)
+
     def __init__(self):
-        self._next_values = {}
+        # Most particles never have a pending update, the dict is only created for the ones which do
+        self._next_values: Optional[Dict[str, Any]] = None
 
     def delay_update(self, field: str, value):
+        if self._next_values is None:
+            self._next_values = {}
         self._next_values[field] = value
 
+    def get_pending_updates(self) -> Dict[str, Any]:
+        return dict(self._next_values or {})
+
     def update(self):
-        for field, value in self._next_values.items():
-            try:
+        if self._next_values:
+            for field, value in self._next_values.items():
                 setattr(self, field, value)
-            except AttributeError as e:
-                raise e
+            self._next_values = None
 
 
 class ReadOnlyParticle:
+    __slots__ = ()
+
     @property
     def mass(self) -> Number:
         raise NotImplementedError
@@ -32,12 +44,19 @@ class ReadOnlyParticle:
 
 
 class Particle(DelayedUpdateMixin, ReadOnlyParticle):
+    # The next position is computed into a second buffer, swapped with the current one by update
+    __slots__ = ("_mass", "_position", "_velocity", "_next_position", "_moved", "id")
+
     def __init__(self, mass: Number, position: List[Number], velocity: List[Number], *args, **kwargs):
         assert len(position) == len(velocity)
         super().__init__()
         self._mass = mass
         self._position = position
         self._velocity = velocity
+        self._next_position: Optional[List[Number]] = None
+        self._moved = False
+        # Stable identifier given by the engine
+        self.id: Optional[int] = None
 
     @property
     def mass(self):
@@ -55,6 +74,14 @@ class Particle(DelayedUpdateMixin, ReadOnlyParticle):
         # todo : delayed update
         self._velocity[dimension] += dimensional_force / self._mass
 
+    def accelerate(self, acceleration: List[Number]):
+        for dimension, dimensional_acceleration in enumerate(acceleration):
+            self._velocity[dimension] += dimensional_acceleration
+
+    def receive_force(self, force: List[Number]):
+        for dimension, dimensional_force in enumerate(force):
+            self._receive_dimensional_force(dimensional_force, dimension)
+
     def apply_force(self, force: List[Number], other: Particle):
         assert len(force) == len(self._velocity)
         for dimension, dimensional_force in enumerate(force):
@@ -62,10 +89,26 @@ class Particle(DelayedUpdateMixin, ReadOnlyParticle):
             self._receive_dimensional_force(-dimensional_force, dimension)
 
     def run(self):
-        next_position = self._position.copy()
+        next_position = self._next_position
+        if next_position is None:
+            # Both buffers belong to the particle, so that the list given at creation is never written
+            self._position = list(self._position)
+            next_position = self._next_position = list(self._position)
         for i, (dimensional_position, dimensional_velocity) in enumerate(zip(self._position, self._velocity)):
             next_position[i] = dimensional_position + dimensional_velocity
-        self.delay_update("position", next_position)
+        self._moved = True
+
+    def get_pending_updates(self) -> Dict[str, Any]:
+        pending_updates = super().get_pending_updates()
+        if self._moved:
+            pending_updates.setdefault("position", list(self._next_position))
+        return pending_updates
+
+    def update(self):
+        if self._moved:
+            self._position, self._next_position = self._next_position, self._position
+            self._moved = False
+        super().update()
 
     def __repr__(self):
         velocity = [round(v, 3) for v in self._velocity]
@@ -73,11 +116,272 @@ class Particle(DelayedUpdateMixin, ReadOnlyParticle):
         return f"{self.__class__.__name__}(mass={round(self.mass, 3)}, velocity={velocity}, position={position})"
 
 
+class ParticleStore:
+    def __init__(
+        self,
+        masses: Iterable[Number],
+        positions: Iterable[List[Number]],
+        velocities: Iterable[List[Number]],
+        ids: Iterable[int] = None,
+        dtype: np.dtype = np.float64,
+    ):
+        # Precision of the stored values, the forces are always summed in double precision
+        self.dtype = np.dtype(dtype)
+        self.masses = np.asarray(masses, dtype=dtype)
+        positions = np.asarray(positions, dtype=dtype)
+        # An empty store keeps the dimension number of the given positions, if they have one
+        dimension_nbr = positions.shape[1] if positions.ndim == 2 else -1 if len(self.masses) else 0
+        self.positions = positions.reshape(len(self.masses), dimension_nbr)
+        self.velocities = np.asarray(velocities, dtype=dtype).reshape(self.positions.shape)
+        # Stable identifiers of the particles, their slot index only changes when the store is compacted
+        self.ids = np.arange(len(self.masses)) if ids is None else np.asarray(ids, dtype=np.int64)
+        self.alive = np.ones(len(self.masses), dtype=bool)
+        self.dead_nbr = 0
+        self.particles: List[ArrayParticle] = []
+        self._alive_particles: Optional[List[ArrayParticle]] = None
+
+    def __len__(self):
+        return len(self.masses)
+
+    def bind(self, masses: np.ndarray, positions: np.ndarray, velocities: np.ndarray):
+        # Moves the state into the given buffers, which may be larger than the store (e.g. shared memory)
+        particle_nbr = len(self)
+        masses[:particle_nbr] = self.masses
+        positions[:particle_nbr] = self.positions
+        velocities[:particle_nbr] = self.velocities
+        self.masses = masses[:particle_nbr]
+        self.positions = positions[:particle_nbr]
+        self.velocities = velocities[:particle_nbr]
+
+    def get_alive_particles(self) -> List[ArrayParticle]:
+        if not self.dead_nbr:
+            return self.particles
+        if self._alive_particles is None:
+            self._alive_particles = [particle for particle, alive in zip(self.particles, self.alive) if alive]
+        return self._alive_particles
+
+    def remove(self, particles: Iterable[ArrayParticle]):
+        # Removed particles are only flagged as dead, which costs the number of removed particles. Dead slots have no
+        # mass nor velocity, so that they neither attract nor move, until compact reclaims them.
+        indexes = [particle.index for particle in particles]
+        for particle in particles:
+            particle._next_values = None
+        indexes = np.array(indexes, dtype=int)[self.alive[indexes]]
+        self.alive[indexes] = False
+        self.masses[indexes] = 0
+        self.velocities[indexes] = 0
+        self.dead_nbr += len(indexes)
+        self._alive_particles = None
+
+    def compact(self):
+        kept = self.alive
+        kept_nbr = int(kept.sum())
+        # Dead particles keep their own copy of their slot, so that they can still be identified
+        for index in np.flatnonzero(~kept).tolist():
+            particle = self.particles[index]
+            particle.store = ParticleStore(
+                self.masses[index : index + 1].copy(),
+                self.positions[index : index + 1].copy(),
+                self.velocities[index : index + 1].copy(),
+                self.ids[index : index + 1].copy(),
+                self.dtype,
+            )
+            particle.index = 0
+        # Compaction is done in place so that the store keeps its underlying buffers
+        self.masses[:kept_nbr] = self.masses[kept]
+        self.positions[:kept_nbr] = self.positions[kept]
+        self.velocities[:kept_nbr] = self.velocities[kept]
+        self.masses = self.masses[:kept_nbr]
+        self.positions = self.positions[:kept_nbr]
+        self.velocities = self.velocities[:kept_nbr]
+        self.ids = self.ids[kept]
+        self.particles = [particle for particle, keep in zip(self.particles, kept) if keep]
+        for index, particle in enumerate(self.particles):
+            particle.index = index
+        self.alive = np.ones(kept_nbr, dtype=bool)
+        self.dead_nbr = 0
+        self._alive_particles = None
+
+
+class ArrayParticle(Particle):
+    # The state lives in the store, the slots of Particle holding it are left unused
+    __slots__ = ("store", "index")
+
+    def __init__(
+        self,
+        mass: Number,
+        position: List[Number],
+        velocity: List[Number],
+        *args,
+        store: ParticleStore,
+        index: int,
+        **kwargs,
+    ):
+        self.store = store
+        self.index = index
+        super().__init__(mass, position, velocity, *args, **kwargs)
+
+    @classmethod
+    def view(cls, store: ParticleStore, index: int) -> ArrayParticle:
+        # Builds a particle over an already filled store, without writing into it
+        particle = cls.__new__(cls)
+        DelayedUpdateMixin.__init__(particle)
+        particle.store = store
+        particle.index = index
+        particle._next_position = None
+        particle._moved = False
+        return particle
+
+    def run(self):
+        # Positions are views over the store, swapping buffers would write the next position into the current one
+        self.delay_update("_position", self._position + self._velocity)
+
+    @property
+    def id(self) -> int:
+        return int(self.store.ids[self.index])
+
+    @id.setter
+    def id(self, value: Optional[int]):
+        if value is not None:
+            self.store.ids[self.index] = value
+
+    @property
+    def _mass(self):
+        return self.store.masses[self.index]
+
+    @_mass.setter
+    def _mass(self, value: Number):
+        self.store.masses[self.index] = value
+
+    @property
+    def _position(self):
+        return self.store.positions[self.index]
+
+    @_position.setter
+    def _position(self, value: List[Number]):
+        self.store.positions[self.index] = value
+
+    @property
+    def _velocity(self):
+        return self.store.velocities[self.index]
+
+    @_velocity.setter
+    def _velocity(self, value: List[Number]):
+        self.store.velocities[self.index] = value
+
+
+class PairGeometry:
+    # Computed once by pair and shared by all the laws applied to it, delta goes from the second particle to the first
+    __slots__ = ("delta", "squared_distance", "distance", "inverse_distance")
+
+    def __init__(self, delta: List[Number], squared_distance: Number):
+        self.delta = delta
+        self.squared_distance = squared_distance
+        self.distance = sqrt(squared_distance)
+        # Coincident particles do not produce any force, as in the solvers
+        self.inverse_distance = 1 / self.distance if self.distance else 0.0
+
+    @classmethod
+    def between(cls, particle: ReadOnlyParticle, other_particle: ReadOnlyParticle) -> PairGeometry:
+        delta = [p1 - p2 for p1, p2 in zip(particle.position, other_particle.position)]
+        squared_distance = 0
+        for dimensional_delta in delta:
+            squared_distance += dimensional_delta * dimensional_delta
+        return cls(delta, squared_distance)
+
+
 class ForceGenerator:
+    # Short-range force generators, whose force is null beyond cutoff_radius, are only evaluated on neighbour pairs
+    cutoff_radius: Optional[Number] = None
+
     def compute_force(self, particle: ReadOnlyParticle, other_particle: ReadOnlyParticle) -> List[Number]:
         raise NotImplementedError
 
+    def compute_force_from_geometry(
+        self, particle: ReadOnlyParticle, other_particle: ReadOnlyParticle, geometry: PairGeometry
+    ) -> List[Number]:
+        # Used by the engines, generators which need the distance between the particles should override it
+        return self.compute_force(particle, other_particle)
+
+    def compute_block_forces(
+        self, masses: np.ndarray, positions: np.ndarray, other_masses: np.ndarray, other_positions: np.ndarray
+    ) -> np.ndarray:
+        # Optional batch protocol: the total force applied on each particle of the first block by all the particles
+        # of the second one. Coincident particles, e.g. a particle with itself, must not produce any force.
+        raise NotImplementedError
+
+
+# Whether the engines call the geometry entry point of a law, by type of law
+_geometry_users: Dict[type, bool] = {}
+
+
+def uses_geometry(law: Union[ForceGenerator, ArbitraryLaw]) -> bool:
+    # The geometry entry point is only used if it is overridden at least as deep as the per pair method, so that a
+    # subclass of Gravity or Merge overriding only compute_force or apply is still called through it
+    law_type = type(law)
+    if law_type not in _geometry_users:
+        if isinstance(law, ForceGenerator):
+            _geometry_users[law_type] = overrides_batch_method(
+                law, ForceGenerator, "compute_force_from_geometry", ("compute_force",)
+            )
+        else:
+            _geometry_users[law_type] = overrides_batch_method(law, ArbitraryLaw, "apply_with_geometry", ("apply",))
+    return _geometry_users[law_type]
+
+
+def compute_force(
+    force_generator: ForceGenerator,
+    particle: ReadOnlyParticle,
+    other_particle: ReadOnlyParticle,
+    geometry: PairGeometry,
+) -> List[Number]:
+    if uses_geometry(force_generator):
+        return force_generator.compute_force_from_geometry(particle, other_particle, geometry)
+    return force_generator.compute_force(particle, other_particle)
+
+
+def uses_block_forces(force_generator: ForceGenerator) -> bool:
+    return overrides_batch_method(
+        force_generator, ForceGenerator, "compute_block_forces", ("compute_force", "compute_force_from_geometry")
+    )
+
+
+def compute_total_force(
+    particle_1: ReadOnlyParticle,
+    particle_2: ReadOnlyParticle,
+    force_generators: Tuple[ForceGenerator, ...],
+    geometry: PairGeometry = None,
+) -> Optional[List[Number]]:
+    if geometry is None and force_generators:
+        geometry = PairGeometry.between(particle_1, particle_2)
+    total_force = None
+    for force_generator in force_generators:
+        force = compute_force(force_generator, particle_1, particle_2, geometry)
+        if total_force is None:
+            total_force = force
+            continue
+        for dimension, (dimensional_total_force, dimensional_force) in enumerate(zip(total_force, force)):
+            total_force[dimension] = dimensional_total_force + dimensional_force
+    return total_force
+
 
 class ArbitraryLaw:
+    # Laws which only act on particles closer than interaction_radius get their candidate pairs from a broad phase
+    interaction_radius: Optional[Number] = None
+
     def apply(self, particle: Particle, other_particle: Particle, engine) -> Dict[str, Set[Particle]]:
         raise NotImplementedError
+
+    def apply_with_geometry(
+        self, particle: Particle, other_particle: Particle, engine, geometry: PairGeometry
+    ) -> Dict[str, Set[Particle]]:
+        # Used by the engines, laws which need the distance between the particles should override it
+        return self.apply(particle, other_particle, engine)
+
+
+def apply_law(
+    law: ArbitraryLaw, particle: Particle, other_particle: Particle, engine, geometry: PairGeometry
+) -> Dict[str, Set[Particle]]:
+    if uses_geometry(law):
+        return law.apply_with_geometry(particle, other_particle, engine, geometry)
+    return law.apply(particle, other_particle, engine)
@@ -0,0 +1,470 @@
+from itertools import product
+from typing import List, Tuple, Dict
+
+import numpy as np
+
+from newchanic.laws import Gravity
+from newchanic.physics import ForceGenerator
+from newchanic.spatial import SpatialHash
+
+# Number of particle pairs evaluated at once by the vectorized kernels, bounds the size of temporary arrays
+DEFAULT_BLOCK_SIZE = 2 ** 20
+
+
+def compute_gravity_accelerations(
+    masses: np.ndarray,
+    positions: np.ndarray,
+    g: float,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    start: int = 0,
+    stop: int = None,
+) -> np.ndarray:
+    # Returns the accelerations of the particles start to stop, caused by all the particles
+    # They are computed by blocks of rows so that memory stays in O(block_size) instead of O(N²)
+    particle_nbr = len(positions)
+    stop = particle_nbr if stop is None else stop
+    accelerations = np.zeros((stop - start, positions.shape[1]))
+    if particle_nbr < 2:
+        return accelerations
+    # Centering reduces the cancellation error of the |a|² + |b|² - 2a.b expansion used below. It also converts
+    # positions stored in single precision, so that the pairs are always computed and summed in double precision.
+    positions = positions - positions.mean(axis=0, dtype=np.float64)
+    squared_norms = np.einsum("ij,ij->i", positions, positions)
+    rows_by_block = max(1, block_size // particle_nbr)
+    for block_start in range(start, stop, rows_by_block):
+        block_stop = min(block_start + rows_by_block, stop)
+        block = positions[block_start:block_stop]
+        weights = block @ positions.T
+        weights *= -2
+        weights += squared_norms[block_start:block_stop, np.newaxis]
+        weights += squared_norms
+        # Self interactions and coincident particles do not produce any force
+        weights[np.arange(block_stop - block_start), np.arange(block_start, block_stop)] = np.inf
+        weights[weights <= 0] = np.inf
+        # weights = m / d³, computed in place since this is where most of the time is spent
+        distances = np.sqrt(weights)
+        weights *= distances
+        np.divide(masses, weights, out=weights)
+        accelerations[block_start - start : block_stop - start] = (
+            weights @ positions - weights.sum(axis=1)[:, np.newaxis] * block
+        )
+    accelerations *= g
+    return accelerations
+
+
+def compute_accelerations_from_sources(
+    target_positions: np.ndarray, source_positions: np.ndarray, source_masses: np.ndarray
+) -> np.ndarray:
+    # Same |a|² + |b|² - 2a.b expansion as compute_gravity_accelerations, centered on the targets
+    origin = target_positions.mean(axis=0, dtype=np.float64)
+    target_positions = target_positions - origin
+    source_positions = source_positions - origin
+    weights = target_positions @ source_positions.T
+    weights *= -2
+    weights += np.einsum("ij,ij->i", target_positions, target_positions)[:, np.newaxis]
+    weights += np.einsum("ij,ij->i", source_positions, source_positions)
+    # Sources located on a target, including the target itself, do not produce any force
+    weights[weights <= 1e-12 * np.abs(weights).max()] = np.inf
+    distances = np.sqrt(weights)
+    weights *= distances
+    np.divide(source_masses, weights, out=weights)
+    return weights @ source_positions - weights.sum(axis=1)[:, np.newaxis] * target_positions
+
+
+def compute_block_accelerations(
+    force_generators: Tuple[ForceGenerator, ...],
+    masses: np.ndarray,
+    positions: np.ndarray,
+    targets: np.ndarray = None,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+) -> np.ndarray:
+    # Accelerations of the particles of index targets, or of all of them, from the batch protocol of the generators,
+    # which get blocks of about block_size pairs
+    targets = np.arange(len(positions)) if targets is None else targets
+    # Forces are computed and summed in double precision, whatever the precision of the store
+    masses, positions = np.asarray(masses, dtype=np.float64), np.asarray(positions, dtype=np.float64)
+    accelerations = np.zeros((len(targets), positions.shape[1]))
+    rows_by_block = max(1, block_size // max(len(positions), 1))
+    for block_start in range(0, len(targets), rows_by_block):
+        block = targets[block_start : block_start + rows_by_block]
+        for force_generator in force_generators:
+            accelerations[block_start : block_start + len(block)] += force_generator.compute_block_forces(
+                masses[block], positions[block], masses, positions
+            )
+    # Particles without mass, e.g. removed particles waiting for the compaction of the store, are not accelerated
+    target_masses = masses[targets, np.newaxis]
+    np.divide(accelerations, target_masses, out=accelerations, where=target_masses != 0)
+    return accelerations
+
+
+class ForceSolver:
+    def handles(self, force_generator: ForceGenerator) -> bool:
+        return isinstance(force_generator, Gravity)
+
+    def compute_accelerations(
+        self, force_generator: ForceGenerator, masses: np.ndarray, positions: np.ndarray
+    ) -> np.ndarray:
+        raise NotImplementedError
+
+    def compute_target_accelerations(
+        self, force_generator: ForceGenerator, masses: np.ndarray, positions: np.ndarray, targets: np.ndarray
+    ) -> np.ndarray:
+        # Accelerations of the particles of index targets only, solvers without a cheaper way compute them all
+        return self.compute_accelerations(force_generator, masses, positions)[targets]
+
+
+class DirectSolver(ForceSolver):
+    def __init__(self, block_size: int = DEFAULT_BLOCK_SIZE):
+        self.block_size = block_size
+
+    def compute_accelerations(
+        self, force_generator: Gravity, masses: np.ndarray, positions: np.ndarray, start: int = 0, stop: int = None
+    ) -> np.ndarray:
+        # start and stop restrict the computation to a slice of the particles, used to share it between workers
+        return compute_gravity_accelerations(masses, positions, force_generator.g, self.block_size, start, stop)
+
+    def compute_target_accelerations(
+        self, force_generator: Gravity, masses: np.ndarray, positions: np.ndarray, targets: np.ndarray
+    ) -> np.ndarray:
+        accelerations = np.zeros((len(targets), positions.shape[1]))
+        rows_by_block = max(1, self.block_size // max(len(positions), 1))
+        for block_start in range(0, len(targets), rows_by_block):
+            block = targets[block_start : block_start + rows_by_block]
+            accelerations[block_start : block_start + len(block)] = compute_accelerations_from_sources(
+                positions[block], positions, masses
+            )
+        accelerations *= force_generator.g
+        return accelerations
+
+
+class KDTree:
+    def __init__(self, masses: np.ndarray, positions: np.ndarray, leaf_size: int):
+        particle_nbr, dimension_nbr = positions.shape
+        # Particles are sorted so that every node owns the contiguous slice order[start:stop]
+        self.order = np.arange(particle_nbr)
+        starts: List[int] = []
+        stops: List[int] = []
+        sizes: List[float] = []
+        lower_corners: List[np.ndarray] = []
+        upper_corners: List[np.ndarray] = []
+        children: List[List[int]] = []
+        pending = [(0, particle_nbr, -1)]
+        while pending:
+            start, stop, parent = pending.pop()
+            node = len(starts)
+            if parent >= 0:
+                children[parent].append(node)
+            indices = self.order[start:stop]
+            node_positions = positions[indices]
+            lower_corner, upper_corner = node_positions.min(axis=0), node_positions.max(axis=0)
+            extents = upper_corner - lower_corner
+            starts.append(start)
+            stops.append(stop)
+            sizes.append(extents.max())
+            lower_corners.append(lower_corner)
+            upper_corners.append(upper_corner)
+            children.append([])
+            if stop - start > leaf_size:
+                # Cells are split at the median of their widest dimension, so any dimension count is supported
+                axis = extents.argmax()
+                middle = (stop - start) // 2
+                self.order[start:stop] = indices[np.argpartition(node_positions[:, axis], middle)]
+                pending.append((start + middle, stop, node))
+                pending.append((start, start + middle, node))
+        self.starts = np.array(starts)
+        self.stops = np.array(stops)
+        self.sizes = np.array(sizes)
+        self.centers = (np.array(lower_corners) + np.array(upper_corners)) / 2
+        self.half_extents = (np.array(upper_corners) - np.array(lower_corners)) / 2
+        self.is_leaf = np.array([not node_children for node_children in children])
+        self.left = np.array([node_children[0] if node_children else -1 for node_children in children])
+        self.right = np.array([node_children[1] if node_children else -1 for node_children in children])
+        cumulated_masses = np.concatenate(([0], np.cumsum(masses[self.order])))
+        cumulated_moments = np.concatenate(
+            (np.zeros((1, dimension_nbr)), np.cumsum(masses[self.order, np.newaxis] * positions[self.order], axis=0))
+        )
+        self.masses = cumulated_masses[self.stops] - cumulated_masses[self.starts]
+        moments = cumulated_moments[self.stops] - cumulated_moments[self.starts]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.centers_of_mass = np.where(
+                self.masses[:, np.newaxis] > 0,
+                moments / self.masses[:, np.newaxis],
+                positions[self.order[self.starts]],
+            )
+        # Opening radius of each node: its size plus the offset of its center of mass from its geometric center
+        self.offsets = np.linalg.norm(self.centers_of_mass - self.centers, axis=1)
+
+    def expand(self, nodes: np.ndarray):
+        # Returns, for each particle owned by the given nodes, the index of the node in nodes and the particle
+        counts = self.stops[nodes] - self.starts[nodes]
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.repeat(np.arange(len(nodes)), counts), self.order[np.repeat(self.starts[nodes], counts) + offsets]
+
+
+class BarnesHutSolver(ForceSolver):
+    def __init__(self, theta: float = 0.5, leaf_size: int = 32):
+        assert theta >= 0, "theta must be >= 0"
+        assert leaf_size > 0, "leaf_size must be > 0"
+        self.theta = theta
+        self.leaf_size = leaf_size
+
+    def compute_accelerations(self, force_generator: Gravity, masses: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        # The masses and moments of the nodes are cumulated sums, which need double precision
+        masses, positions = np.asarray(masses, dtype=np.float64), np.asarray(positions, dtype=np.float64)
+        accelerations = np.zeros_like(positions)
+        if len(positions) < 2:
+            return accelerations
+        tree = KDTree(masses, positions, self.leaf_size)
+        # The particles of a same leaf walk the tree as a group and share the same interaction list
+        groups = np.flatnonzero(tree.is_leaf)
+        monopoles, direct_leaves = self._build_interaction_lists(tree, groups)
+        monopole_bounds = np.searchsorted(monopoles[0], np.arange(len(groups) + 1))
+        expanded_leaves, direct_particles = tree.expand(direct_leaves[1])
+        direct_groups = direct_leaves[0][expanded_leaves]
+        direct_bounds = np.searchsorted(direct_groups, np.arange(len(groups) + 1))
+        for group, leaf in enumerate(groups):
+            nodes = monopoles[1][monopole_bounds[group] : monopole_bounds[group + 1]]
+            particles = direct_particles[direct_bounds[group] : direct_bounds[group + 1]]
+            targets = tree.order[tree.starts[leaf] : tree.stops[leaf]]
+            accelerations[targets] = compute_accelerations_from_sources(
+                positions[targets],
+                np.concatenate((tree.centers_of_mass[nodes], positions[particles])),
+                np.concatenate((tree.masses[nodes], masses[particles])),
+            )
+        accelerations *= force_generator.g
+        return accelerations
+
+    def _build_interaction_lists(self, tree: KDTree, groups: np.ndarray):
+        # Every group walks the tree at the same time: each iteration handles a frontier of (group, node) couples
+        group_indices = np.arange(len(groups))
+        nodes = np.zeros(len(groups), dtype=int)
+        monopoles, direct_leaves = [], []
+        while len(group_indices):
+            leaves = groups[group_indices]
+            gaps = np.abs(tree.centers_of_mass[nodes] - tree.centers[leaves]) - tree.half_extents[leaves]
+            np.maximum(gaps, 0, out=gaps)
+            squared_distances = np.einsum("ij,ij->i", gaps, gaps)
+            if self.theta > 0:
+                accepted = (tree.sizes[nodes] / self.theta + tree.offsets[nodes]) ** 2 < squared_distances
+            else:
+                accepted = np.zeros(len(nodes), dtype=bool)
+            monopoles.append((group_indices[accepted], nodes[accepted]))
+            opened_leaves = ~accepted & tree.is_leaf[nodes]
+            direct_leaves.append((group_indices[opened_leaves], nodes[opened_leaves]))
+            opened_inner = ~accepted & ~tree.is_leaf[nodes]
+            group_indices = np.concatenate((group_indices[opened_inner], group_indices[opened_inner]))
+            nodes = np.concatenate((tree.left[nodes[opened_inner]], tree.right[nodes[opened_inner]]))
+        return self._sort_by_group(monopoles), self._sort_by_group(direct_leaves)
+
+    @staticmethod
+    def _sort_by_group(couples: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+        group_indices = np.concatenate([couple[0] for couple in couples])
+        nodes = np.concatenate([couple[1] for couple in couples])
+        order = np.argsort(group_indices, kind="stable")
+        return group_indices[order], nodes[order]
+
+
+def erfc(x: np.ndarray) -> np.ndarray:
+    # Complementary error function of non negative values, with a relative error below 1.2e-7 (Numerical Recipes)
+    t = 1 / (1 + 0.5 * x)
+    polynomial = 0.17087277
+    for coefficient in (
+        -0.82215223,
+        1.48851587,
+        -1.13520398,
+        0.27886807,
+        -0.18628806,
+        0.09678418,
+        0.37409196,
+        1.00002368,
+        -1.26551223,
+    ):
+        polynomial = polynomial * t + coefficient
+    return t * np.exp(polynomial - x * x)
+
+
+def compute_short_range_fractions(distances: np.ndarray, split: float) -> np.ndarray:
+    # Fraction of the Newtonian force left to the pairs when the mesh gets the long range part of the force
+    ratios = distances / (2 * split)
+    return erfc(ratios) + 2 / np.sqrt(np.pi) * ratios * np.exp(-ratios * ratios)
+
+
+class ParticleMeshSolver(ForceSolver):
+    # Masses are deposited on the nodes of a mesh by cloud in cell, the accelerations of the nodes are computed with
+    # FFTs then interpolated back to the particles with the same weights, which costs O(N + G log G).
+    # Isolated boundaries convolve the masses with the Newtonian kernel on a mesh fitting the particles, zero padded
+    # to twice its size. Periodic boundaries solve Poisson's equation in the cube of side box_size starting at
+    # box_origin (3D only). With short_range, the mesh only gets the long range part of the force, split at
+    # split_cells cells, and the pairs closer than cutoff_splits splits get the rest directly (P³M).
+    def __init__(
+        self,
+        grid_size: int = 64,
+        boundary: str = "isolated",
+        box_size: float = None,
+        box_origin: Tuple[float, ...] = None,
+        short_range: bool = False,
+        split_cells: float = 1.25,
+        cutoff_splits: float = 4.5,
+    ):
+        assert grid_size >= 2, "grid_size must be >= 2"
+        assert boundary in ("isolated", "periodic"), "boundary must be isolated or periodic"
+        assert boundary == "isolated" or box_size, "Periodic boundaries need a box_size"
+        assert not short_range or 2 * split_cells * cutoff_splits < grid_size, "The cutoff must be below half the box"
+        self.grid_size = grid_size
+        self.boundary = boundary
+        self.box_size = box_size
+        self.box_origin = box_origin
+        self.short_range = short_range
+        self.split_cells = split_cells
+        self.cutoff_splits = cutoff_splits
+        # FFTs of the kernels or Green's functions, which only depend on the dimension number and the cell size
+        self._kernels: Dict[Tuple[int, float], np.ndarray] = {}
+
+    @property
+    def periodic(self) -> bool:
+        return self.boundary == "periodic"
+
+    def compute_accelerations(self, force_generator: Gravity, masses: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        masses, positions = np.asarray(masses, dtype=np.float64), np.asarray(positions, dtype=np.float64)
+        particle_nbr, dimension_nbr = positions.shape
+        if particle_nbr < 2:
+            return np.zeros_like(positions)
+        if self.periodic:
+            assert dimension_nbr == 3, "Periodic boundaries are only supported in 3D"
+            origin = np.zeros(3) if self.box_origin is None else np.asarray(self.box_origin, dtype=float)
+            cell_size = self.box_size / self.grid_size
+            positions = origin + np.mod(positions - origin, self.box_size)
+            coordinates = np.mod((positions - origin) / cell_size, self.grid_size)
+        else:
+            # The nodes of the mesh span the bounding box of the particles
+            lower = positions.min(axis=0)
+            cell_size = max(float((positions.max(axis=0) - lower).max()), 1e-12) / (self.grid_size - 1)
+            coordinates = (positions - lower) / cell_size
+        nodes, weights = self._get_cloud_in_cell_weights(coordinates)
+        shape = (self.grid_size,) * dimension_nbr
+        mesh = np.bincount(nodes.ravel(), (weights * masses).ravel(), self.grid_size ** dimension_nbr).reshape(shape)
+        if self.periodic:
+            node_accelerations = self._solve_periodic(mesh, cell_size)
+        else:
+            node_accelerations = self._solve_isolated(mesh, cell_size)
+        node_accelerations = node_accelerations.reshape(dimension_nbr, -1)
+        accelerations = np.zeros_like(positions)
+        for corner_nodes, corner_weights in zip(nodes, weights):
+            accelerations += node_accelerations[:, corner_nodes].T * corner_weights[:, np.newaxis]
+        if self.short_range:
+            accelerations += self._compute_short_range_accelerations(masses, positions, cell_size)
+        accelerations *= force_generator.g
+        return accelerations
+
+    def _get_cloud_in_cell_weights(self, coordinates: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Flat indexes of the 2^d nodes around every particle, and their weights
+        particle_nbr, dimension_nbr = coordinates.shape
+        bases = np.floor(coordinates).astype(np.int64)
+        if not self.periodic:
+            # The particles on the upper faces of the bounding box belong to the last cells
+            np.minimum(bases, self.grid_size - 2, out=bases)
+        fractions = coordinates - bases
+        shape = (self.grid_size,) * dimension_nbr
+        nodes = np.empty((2 ** dimension_nbr, particle_nbr), dtype=np.int64)
+        weights = np.empty((2 ** dimension_nbr, particle_nbr))
+        for index, corner in enumerate(product((0, 1), repeat=dimension_nbr)):
+            corner_nodes = bases + corner
+            if self.periodic:
+                corner_nodes %= self.grid_size
+            nodes[index] = np.ravel_multi_index(corner_nodes.T, shape)
+            weights[index] = np.prod(np.where(corner, fractions, 1 - fractions), axis=1)
+        return nodes, weights
+
+    def _solve_isolated(self, mesh: np.ndarray, cell_size: float) -> np.ndarray:
+        # The kernel only depends on the cell size through a 1 / h² factor, so it is computed once for h = 1
+        dimension_nbr = mesh.ndim
+        padded_shape = (2 * self.grid_size,) * dimension_nbr
+        kernels = self._kernels.get((dimension_nbr, 1.0))
+        if kernels is None:
+            kernels = self._kernels[(dimension_nbr, 1.0)] = self._build_isolated_kernels(padded_shape)
+        axes = tuple(range(dimension_nbr))
+        transformed_mesh = np.fft.rfftn(mesh, padded_shape, axes)
+        region = tuple(slice(0, self.grid_size) for _ in range(dimension_nbr))
+        return np.array(
+            [np.fft.irfftn(transformed_mesh * kernel, padded_shape, axes)[region] for kernel in kernels]
+        ) / cell_size ** 2
+
+    def _build_isolated_kernels(self, padded_shape: Tuple[int, ...]) -> np.ndarray:
+        # Acceleration caused by a unit mass at the origin, at every offset of the padded mesh, in cell units
+        # Offsets beyond half of the padded mesh are the negative ones, wrapped around by the FFT
+        axes = [np.fft.fftfreq(size, 1 / size) for size in padded_shape]
+        offsets = np.array(np.meshgrid(*axes, indexing="ij"))
+        distances = np.sqrt(np.einsum("i...,i...->...", offsets, offsets))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            magnitudes = np.where(distances > 0, 1 / distances ** 3, 0)
+        if self.short_range:
+            magnitudes *= 1 - compute_short_range_fractions(distances, self.split_cells)
+        return np.array([np.fft.rfftn(-offset * magnitudes) for offset in offsets])
+
+    def _solve_periodic(self, mesh: np.ndarray, cell_size: float) -> np.ndarray:
+        greens = self._kernels.get((3, cell_size))
+        if greens is None:
+            greens = self._kernels[(3, cell_size)] = self._build_periodic_greens(mesh.shape, cell_size)
+        transformed_mesh = np.fft.rfftn(mesh / cell_size ** 3)
+        return np.array([np.fft.irfftn(transformed_mesh * green, mesh.shape, (0, 1, 2)) for green in greens])
+
+    def _build_periodic_greens(self, shape: Tuple[int, ...], cell_size: float) -> np.ndarray:
+        # Fourier transforms of the accelerations caused by a unit density: -ik φ with φ = -4π ρ / k²
+        frequencies = [2 * np.pi * np.fft.fftfreq(size, cell_size) for size in shape[:-1]]
+        frequencies.append(2 * np.pi * np.fft.rfftfreq(shape[-1], cell_size))
+        wave_vectors = np.meshgrid(*frequencies, indexing="ij")
+        squared_norms = sum(wave_vector ** 2 for wave_vector in wave_vectors)
+        with np.errstate(divide="ignore"):
+            potentials = np.where(squared_norms > 0, -4 * np.pi / squared_norms, 0)
+        if self.short_range:
+            # The long range part is smooth enough for the cloud in cell assignment and interpolation to be
+            # deconvolved, which would amplify the noise of the small scales without the split
+            windows = np.prod([np.sinc(wave_vector * cell_size / (2 * np.pi)) ** 2 for wave_vector in wave_vectors], 0)
+            potentials *= np.exp(-squared_norms * (self.split_cells * cell_size) ** 2) / windows ** 2
+        return np.array([-1j * wave_vector * potentials for wave_vector in wave_vectors])
+
+    def _compute_short_range_accelerations(
+        self, masses: np.ndarray, positions: np.ndarray, cell_size: float
+    ) -> np.ndarray:
+        # Newtonian accelerations of Gravity between the close pairs, weighted by their short range fraction
+        particle_nbr = len(positions)
+        split = self.split_cells * cell_size
+        cutoff = self.cutoff_splits * split
+        indexes, extended_positions = np.arange(particle_nbr), positions
+        if self.periodic:
+            # Images of the particles close to the faces of the box are added, so that pairs across faces are found
+            indexes, extended_positions = self._add_periodic_images(positions, cutoff)
+        accelerations = np.zeros_like(positions)
+        for first, second in SpatialHash(cutoff).iter_candidate_pairs(extended_positions, cutoff):
+            # Pairs of images are dropped, a pair between a particle and an image only accelerates the particle
+            kept = (first < particle_nbr) | (second < particle_nbr)
+            first, second = first[kept], second[kept]
+            deltas = extended_positions[second] - extended_positions[first]
+            distances = np.sqrt(np.einsum("ij,ij->i", deltas, deltas))
+            # Coincident particles do not produce any force, as in Gravity
+            distances[distances == 0] = np.inf
+            deltas *= (compute_short_range_fractions(distances, split) / distances ** 3)[:, np.newaxis]
+            for targets, sources, sign in ((first, second, 1), (second, first, -1)):
+                originals = targets < particle_nbr
+                targets, weights = targets[originals], sign * masses[indexes[sources[originals]]]
+                for dimension in range(positions.shape[1]):
+                    accelerations[:, dimension] += np.bincount(
+                        targets, deltas[originals, dimension] * weights, particle_nbr
+                    )
+        return accelerations
+
+    def _add_periodic_images(self, positions: np.ndarray, cutoff: float) -> Tuple[np.ndarray, np.ndarray]:
+        origin = np.zeros(3) if self.box_origin is None else np.asarray(self.box_origin, dtype=float)
+        lower, upper = origin + cutoff, origin + self.box_size - cutoff
+        indexes, extended_positions = [np.arange(len(positions))], [positions]
+        for shift in product((-1, 0, 1), repeat=positions.shape[1]):
+            if not any(shift):
+                continue
+            shift = np.array(shift)
+            # A particle is shifted up along an axis when it is close to the lower face, and down near the upper one
+            near = np.all(
+                (shift == 0) | ((shift > 0) & (positions < lower)) | ((shift < 0) & (positions > upper)), axis=1
+            )
+            indexes.append(np.flatnonzero(near))
+            extended_positions.append(positions[near] + shift * self.box_size)
+        return np.concatenate(indexes), np.concatenate(extended_positions)
@@ -0,0 +1,167 @@
+from itertools import product
+from typing import Tuple, Optional, Iterator
+
+import numpy as np
+
+from newchanic.utils import Number
+
+
+class SpatialHash:
+    def __init__(self, cell_size: Number):
+        assert cell_size > 0, "cell_size must be > 0"
+        self.cell_size = cell_size
+
+    def candidate_pairs(self, positions: np.ndarray, radius: Number = None) -> Tuple[np.ndarray, np.ndarray]:
+        # Returns the indexes (i, j) of every unordered pair closer than cell_size, plus some farther ones unless
+        # radius is given, in which case only the pairs closer than radius are kept
+        chunks = list(self.iter_candidate_pairs(positions, radius))
+        if not chunks:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+        return np.concatenate([first for first, _ in chunks]), np.concatenate([second for _, second in chunks])
+
+    def iter_candidate_pairs(
+        self, positions: np.ndarray, radius: Number = None
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        # Same pairs as candidate_pairs, by chunks of one neighbour cell offset, to bound the memory of dense systems
+        particle_nbr, dimension_nbr = positions.shape
+        if particle_nbr < 2:
+            return
+        cells = np.floor(positions / self.cell_size).astype(np.int64)
+        # Cells are padded by one so that neighbours of the border cells still have a valid key
+        cells -= cells.min(axis=0) - 1
+        shape = cells.max(axis=0) + 2
+        assert np.prod(shape.astype(float)) < 2 ** 62, "Too many cells, cell_size is too small for this system"
+        keys = np.ravel_multi_index(cells.T, shape)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        cell_keys, cell_starts, cell_counts = np.unique(sorted_keys, return_index=True, return_counts=True)
+        for offset in self._half_neighbourhood(dimension_nbr):
+            neighbour_keys = np.ravel_multi_index((cells + offset).T, shape)
+            # Cells are looked up by particle: particle i of a cell is paired with every particle of the neighbour cell
+            found = np.searchsorted(cell_keys, neighbour_keys)
+            found[found == len(cell_keys)] = 0
+            exists = cell_keys[found] == neighbour_keys
+            particles = np.flatnonzero(exists)
+            counts = cell_counts[found[particles]]
+            starts = cell_starts[found[particles]]
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            first = np.repeat(particles, counts)
+            second = order[np.repeat(starts, counts) + offsets]
+            if not any(offset):
+                # Pairs inside a same cell are found twice and with themselves, only i < j is kept
+                kept = first < second
+                first, second = first[kept], second[kept]
+            if radius is not None:
+                deltas = positions[first] - positions[second]
+                close = np.einsum("ij,ij->i", deltas, deltas) < radius ** 2
+                first, second = first[close], second[close]
+            yield first, second
+
+    @staticmethod
+    def _half_neighbourhood(dimension_nbr: int):
+        # The cell itself plus half of its neighbours: an offset and its opposite would find the same pairs
+        for offset in product((-1, 0, 1), repeat=dimension_nbr):
+            if offset >= (0,) * dimension_nbr:
+                yield np.array(offset)
+
+
+class GridIndex:
+    # Uniform grid over 2D points, with the particle count of every cell and their summed-area table, so that the
+    # number of points in a box is known in constant time and a density map costs the number of pixels or cells
+    def __init__(self, points: np.ndarray, resolution: int = 1024):
+        assert len(points), "A grid index needs at least one point"
+        self.points = points
+        self.lower = points.min(axis=0).astype(float)
+        self.cell_size = max(float((points.max(axis=0) - self.lower).max()) / resolution, 1e-12)
+        cells = np.floor((points - self.lower) / self.cell_size).astype(np.int64)
+        self.shape = (int(cells[:, 0].max()) + 1, int(cells[:, 1].max()) + 1)
+        keys = cells[:, 0] * self.shape[1] + cells[:, 1]
+        self.order = np.argsort(keys)
+        self.counts = np.bincount(keys, minlength=self.shape[0] * self.shape[1]).reshape(self.shape)
+        self.starts = np.concatenate([[0], np.cumsum(self.counts.ravel())])
+        self.summed_counts = np.zeros((self.shape[0] + 1, self.shape[1] + 1), dtype=np.int64)
+        self.summed_counts[1:, 1:] = self.counts.cumsum(axis=0).cumsum(axis=1)
+
+    def _cell_range(self, lower: np.ndarray, upper: np.ndarray) -> Tuple[int, int, int, int]:
+        # Cells intersecting the box, as [x_start, x_stop) and [y_start, y_stop)
+        start = np.clip(np.floor((np.asarray(lower) - self.lower) / self.cell_size), 0, self.shape).astype(int)
+        stop = np.clip(np.floor((np.asarray(upper) - self.lower) / self.cell_size) + 1, 0, self.shape).astype(int)
+        return start[0], stop[0], start[1], stop[1]
+
+    def count(self, lower: np.ndarray, upper: np.ndarray) -> int:
+        # Number of points in the cells intersecting the box, an upper bound of the number of points in the box
+        x_start, x_stop, y_start, y_stop = self._cell_range(lower, upper)
+        if x_start >= x_stop or y_start >= y_stop:
+            return 0
+        summed = self.summed_counts
+        return int(
+            summed[x_stop, y_stop] - summed[x_start, y_stop] - summed[x_stop, y_start] + summed[x_start, y_start]
+        )
+
+    def query(self, lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+        # Indexes of the points in the cells intersecting the box, some of them may be out of the box
+        x_start, x_stop, y_start, y_stop = self._cell_range(lower, upper)
+        if x_start >= x_stop or y_start >= y_stop:
+            return np.empty(0, dtype=np.int64)
+        # Cells of a same column are contiguous in the order
+        return np.concatenate(
+            [
+                self.order[self.starts[x * self.shape[1] + y_start] : self.starts[x * self.shape[1] + y_stop]]
+                for x in range(x_start, x_stop)
+            ]
+        )
+
+    def density(self, lower: np.ndarray, upper: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+        # Points by pixel of a shape[0] x shape[1] image of the box
+        lower, upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+        pixel_size = (upper - lower) / shape
+        if pixel_size.max() <= self.cell_size:
+            # Cells are larger than pixels: every pixel takes its share of the count of the cell under its center
+            density = np.ones(shape) * (pixel_size.prod() / self.cell_size ** 2)
+            cells = []
+            for axis in range(2):
+                centers = lower[axis] + (np.arange(shape[axis]) + 0.5) * pixel_size[axis]
+                axis_cells = np.floor((centers - self.lower[axis]) / self.cell_size).astype(int)
+                outside = (axis_cells < 0) | (axis_cells >= self.shape[axis])
+                density[outside if axis == 0 else (slice(None), outside)] = 0
+                cells.append(np.clip(axis_cells, 0, self.shape[axis] - 1))
+            return density * self.counts[cells[0][:, None], cells[1]]
+        # Pixels are larger than cells: the counts of the non empty cells are added to the pixel of their center
+        cells = np.flatnonzero(self.counts)
+        centers = (np.stack(np.unravel_index(cells, self.shape), axis=1) + 0.5) * self.cell_size + self.lower
+        pixels = np.floor((centers - lower) / pixel_size).astype(int)
+        inside = np.all((pixels >= 0) & (pixels < shape), axis=1)
+        keys = pixels[inside, 0] * shape[1] + pixels[inside, 1]
+        weights = self.counts.ravel()[cells[inside]]
+        return np.bincount(keys, weights=weights, minlength=shape[0] * shape[1]).reshape(shape)
+
+
+class NeighbourList:
+    # Verlet list: the pairs closer than cutoff + skin, which contain every pair closer than cutoff as long as no
+    # particle has moved by more than skin / 2 since they have been found
+    def __init__(self, cutoff: Number, skin: Number):
+        assert cutoff > 0, "cutoff must be > 0"
+        assert skin >= 0, "skin must be >= 0"
+        self.cutoff = cutoff
+        self.skin = skin
+        self.rebuilds = 0
+        self._positions: Optional[np.ndarray] = None
+        self._pairs: Tuple[np.ndarray, np.ndarray] = (np.empty(0, dtype=int), np.empty(0, dtype=int))
+
+    def invalidate(self):
+        self._positions = None
+
+    def must_rebuild(self, positions: np.ndarray) -> bool:
+        if self._positions is None or self._positions.shape != positions.shape:
+            return True
+        displacements = positions - self._positions
+        return bool(np.einsum("ij,ij->i", displacements, displacements).max(initial=0) > (self.skin / 2) ** 2)
+
+    def get_pairs(self, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Candidate pairs (i, j), some of them may be farther than cutoff
+        if self.must_rebuild(positions):
+            radius = self.cutoff + self.skin
+            self._pairs = SpatialHash(radius).candidate_pairs(positions, radius)
+            self._positions = positions.copy()
+            self.rebuilds += 1
+        return self._pairs
@@ -0,0 +1,334 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import hashlib
+import socket
+import struct
+from argparse import ArgumentParser
+from threading import Thread, Lock
+from time import monotonic
+from typing import NamedTuple, Optional, Set, Tuple, Iterator
+
+import numpy as np
+
+from newchanic.engine import Engine, Feature
+from newchanic.trajectory import Frame, ID_DTYPE
+from newchanic.utils import Number
+
+# Sent by raw TCP clients when they connect, WebSocket clients start with an HTTP upgrade request instead
+MAGIC = b"NWCSTR01"
+# Size of every message on raw TCP connections, WebSocket connections get one binary message by frame
+MESSAGE_SIZE = struct.Struct("<I")
+# kind, dimension number, itemsize of the deltas, reserved, turn, kept, removed and added particle numbers, resolution
+FRAME_HEADER = struct.Struct("<BBBBIIIId")
+KEYFRAME, DELTA = 1, 2
+QUANTIZED_DTYPE = np.dtype("<i4")
+DELTA_DTYPES = {dtype.itemsize: dtype for dtype in map(np.dtype, ("<i1", "<i2", "<i4", "<i8"))}
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class QuantizedState(NamedTuple):
+    # Particles sorted by id, with their positions in units of the resolution of the stream
+    turn: int
+    ids: np.ndarray
+    positions: np.ndarray
+
+
+def quantize(turn: int, ids: np.ndarray, positions: np.ndarray, resolution: Number) -> QuantizedState:
+    order = np.argsort(ids, kind="stable")
+    quantized = np.rint(positions[order] / resolution)
+    # Positions farther than 2^31 resolutions from the origin are clipped
+    bounds = np.iinfo(QUANTIZED_DTYPE)
+    np.clip(quantized, bounds.min, bounds.max, out=quantized)
+    return QuantizedState(turn, ids[order].astype(ID_DTYPE), quantized.astype(QUANTIZED_DTYPE))
+
+
+def encode_frame(state: QuantizedState, previous: Optional[QuantizedState], resolution: Number) -> bytes:
+    # A keyframe holds all the particles. A delta frame holds the ids of the particles removed since the previous
+    # frame, the moves of the others in the smallest integer type fitting them, then the particles added since.
+    # Deltas are taken between quantized positions, so that the rounding errors never add up on the client side.
+    dimension_nbr = state.positions.shape[1]
+    if previous is None:
+        header = FRAME_HEADER.pack(KEYFRAME, dimension_nbr, 0, 0, state.turn, 0, 0, len(state.ids), resolution)
+        return b"".join((header, state.ids.tobytes(), state.positions.tobytes()))
+    kept_previous = np.isin(previous.ids, state.ids, assume_unique=True)
+    kept = np.isin(state.ids, previous.ids, assume_unique=True)
+    removed_ids = previous.ids[~kept_previous]
+    # Both states are sorted by id, so the kept particles are in the same order in both
+    deltas = state.positions[kept].astype(np.int64) - previous.positions[kept_previous]
+    largest = int(np.abs(deltas).max(initial=0))
+    delta_dtype = next(dtype for dtype in DELTA_DTYPES.values() if largest <= np.iinfo(dtype).max)
+    added = ~kept
+    header = FRAME_HEADER.pack(
+        DELTA,
+        dimension_nbr,
+        delta_dtype.itemsize,
+        0,
+        state.turn,
+        int(kept.sum()),
+        len(removed_ids),
+        int(added.sum()),
+        resolution,
+    )
+    return b"".join(
+        (
+            header,
+            removed_ids.tobytes(),
+            deltas.astype(delta_dtype).tobytes(),
+            state.ids[added].tobytes(),
+            state.positions[added].tobytes(),
+        )
+    )
+
+
+class StreamDecoder:
+    # Rebuilds the frames of a stream from its messages, which must be decoded in order from a keyframe
+    def __init__(self):
+        self.state: Optional[QuantizedState] = None
+
+    def decode(self, message: bytes) -> Frame:
+        kind, dimension_nbr, delta_size, _, turn, kept_nbr, removed_nbr, added_nbr, resolution = (
+            FRAME_HEADER.unpack_from(message)
+        )
+        offset = FRAME_HEADER.size
+
+        def read(dtype: np.dtype, count: int) -> np.ndarray:
+            nonlocal offset
+            values = np.frombuffer(message, dtype, count, offset)
+            offset += values.nbytes
+            return values
+
+        if kind == KEYFRAME:
+            ids, positions = np.empty(0, dtype=ID_DTYPE), np.empty((0, dimension_nbr), dtype=np.int64)
+        elif kind == DELTA:
+            assert self.state is not None, "A delta frame needs a previous keyframe"
+            removed_ids = read(ID_DTYPE, removed_nbr)
+            kept = ~np.isin(self.state.ids, removed_ids, assume_unique=True)
+            ids = self.state.ids[kept]
+            deltas = read(DELTA_DTYPES[delta_size], kept_nbr * dimension_nbr).reshape(kept_nbr, dimension_nbr)
+            positions = self.state.positions[kept] + deltas
+        else:
+            raise ValueError(f"Unknown frame kind {kind}")
+        added_ids = read(ID_DTYPE, added_nbr)
+        added_positions = read(QUANTIZED_DTYPE, added_nbr * dimension_nbr).reshape(added_nbr, dimension_nbr)
+        ids = np.concatenate((ids, added_ids))
+        positions = np.concatenate((positions, added_positions.astype(np.int64)))
+        order = np.argsort(ids, kind="stable")
+        self.state = QuantizedState(turn, ids[order], positions[order])
+        return Frame(turn, self.state.ids, self.state.positions * resolution, None, None)
+
+
+class StreamClient:
+    __slots__ = ("writer", "websocket", "wake_up", "previous", "sent_frames", "last_sent")
+
+    def __init__(self, writer: asyncio.StreamWriter, websocket: bool):
+        self.writer = writer
+        self.websocket = websocket
+        self.wake_up = asyncio.Event()
+        # Last state sent to this client, its next delta frame is computed from it
+        self.previous: Optional[QuantizedState] = None
+        self.sent_frames = 0
+        self.last_sent = -float("inf")
+
+
+def wrap_websocket_message(message: bytes) -> bytes:
+    # Single unmasked binary frame, as sent by servers
+    size = len(message)
+    if size < 126:
+        header = struct.pack("!BB", 0x82, size)
+    elif size < 2 ** 16:
+        header = struct.pack("!BBH", 0x82, 126, size)
+    else:
+        header = struct.pack("!BBQ", 0x82, 127, size)
+    return header + message
+
+
+class StreamingServer(Feature[None]):
+    # Publishes the positions of the particles to any number of TCP or WebSocket clients. The server runs an asyncio
+    # loop in its own thread, the engine only hands it a copy of the state at every feature step, which replaces the
+    # one not sent yet. Every client gets the latest state at most max_fps times by second, as a delta from the last
+    # frame it received and a keyframe every keyframe_every frames: slow clients skip frames instead of delaying the
+    # physics or the other clients.
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        resolution: Number = 0.01,
+        max_fps: Number = 30,
+        keyframe_every: int = 100,
+    ):
+        assert resolution > 0, "resolution must be > 0"
+        assert keyframe_every >= 1, "keyframe_every must be >= 1"
+        self.resolution = resolution
+        self.min_interval = 1 / max_fps if max_fps else 0
+        self.keyframe_every = keyframe_every
+        self.client_nbr = 0
+        self.sent_bytes = 0
+        self._clients: Set[StreamClient] = set()
+        self._tasks: Set[asyncio.Future] = set()
+        self._latest: Optional[QuantizedState] = None
+        self._pending: Optional[Tuple[int, np.ndarray, np.ndarray]] = None
+        self._pending_lock = Lock()
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._loop.run_forever, name="streaming-server", daemon=True)
+        self._thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(self._start(host, port), self._loop).result()
+        self.address: Tuple[str, int] = self._server.sockets[0].getsockname()[:2]
+
+    async def _start(self, host: str, port: int) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self._serve, host, port)
+
+    def __call__(self, engine: Engine):
+        if not self.client_nbr:
+            return
+        particles, _, positions, _ = engine.get_state()
+        ids = np.fromiter((particle.id for particle in particles), dtype=np.int64, count=len(particles))
+        # The positions are copied here, the engine keeps on modifying its arrays while they are sent
+        with self._pending_lock:
+            scheduled = self._pending is not None
+            self._pending = (engine.turn, ids, np.array(positions, dtype=np.float64))
+        if not scheduled:
+            self._loop.call_soon_threadsafe(self._publish)
+
+    def _publish(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, None
+        self._latest = quantize(*pending, self.resolution)
+        for client in self._clients:
+            client.wake_up.set()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        client = None
+        try:
+            client = StreamClient(writer, await self._handshake(reader, writer))
+            self._clients.add(client)
+            self.client_nbr = len(self._clients)
+            if self._latest is not None:
+                client.wake_up.set()
+            await self._send_frames(client, asyncio.ensure_future(self._discard(reader)))
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            if client is not None:
+                self._clients.discard(client)
+                self.client_nbr = len(self._clients)
+            writer.close()
+            self._tasks.discard(task)
+
+    @staticmethod
+    async def _handshake(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        start = await reader.readexactly(4)
+        if start == MAGIC[:4]:
+            if await reader.readexactly(len(MAGIC) - 4) != MAGIC[4:]:
+                raise ValueError("Unknown protocol")
+            return False
+        if start != b"GET ":
+            raise ValueError("Unknown protocol")
+        request = (start + await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+        headers = dict(
+            (name.strip().lower(), value.strip())
+            for name, _, value in (line.partition(":") for line in request.split("\r\n")[1:])
+        )
+        key = headers.get("sec-websocket-key")
+        if key is None:
+            raise ValueError("Not a WebSocket upgrade request")
+        accept = base64.b64encode(hashlib.sha1(key.encode() + WEBSOCKET_GUID).digest()).decode()
+        writer.write(
+            (
+                "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+            ).encode()
+        )
+        await writer.drain()
+        return True
+
+    @staticmethod
+    async def _discard(reader: asyncio.StreamReader):
+        # Clients are not expected to send anything more, this only detects when they disconnect
+        while await reader.read(2 ** 16):
+            pass
+
+    async def _send_frames(self, client: StreamClient, disconnection: asyncio.Future):
+        waking_up = asyncio.ensure_future(client.wake_up.wait())
+        try:
+            while not disconnection.done():
+                await asyncio.wait((waking_up, disconnection), return_when=asyncio.FIRST_COMPLETED)
+                if disconnection.done():
+                    break
+                # States published while the client waits for its next slot are skipped, it gets the latest one
+                delay = client.last_sent + self.min_interval - monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                client.wake_up.clear()
+                state = self._latest
+                previous = None if client.sent_frames % self.keyframe_every == 0 else client.previous
+                message = encode_frame(state, previous, self.resolution)
+                if client.websocket:
+                    message = wrap_websocket_message(message)
+                else:
+                    message = MESSAGE_SIZE.pack(len(message)) + message
+                client.writer.write(message)
+                # Only this client waits for its socket to accept the frame
+                await client.writer.drain()
+                client.previous, client.last_sent = state, monotonic()
+                client.sent_frames += 1
+                self.sent_bytes += len(message)
+                waking_up = asyncio.ensure_future(client.wake_up.wait())
+        finally:
+            waking_up.cancel()
+            disconnection.cancel()
+            await asyncio.gather(waking_up, disconnection, return_exceptions=True)
+
+    async def _stop(self):
+        self._server.close()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def close(self):
+        if self._thread.is_alive():
+            asyncio.run_coroutine_threadsafe(self._stop(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+
+    def __enter__(self) -> StreamingServer:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def iter_stream(host: str, port: int, timeout: Number = None) -> Iterator[Frame]:
+    # Blocking raw TCP client, connected at once, yielding the frames until the server closes the connection
+    connection = socket.create_connection((host, port), timeout)
+    connection.sendall(MAGIC)
+    return iter_frames(connection)
+
+
+def iter_frames(connection: socket.socket) -> Iterator[Frame]:
+    decoder = StreamDecoder()
+    with connection, connection.makefile("rb") as stream:
+        while True:
+            size = stream.read(MESSAGE_SIZE.size)
+            if len(size) < MESSAGE_SIZE.size:
+                return
+            yield decoder.decode(stream.read(*MESSAGE_SIZE.unpack(size)))
+
+
+def main():
+    parser = ArgumentParser(prog="newchanic.streaming", description="Print the frames streamed by a run")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    arguments = parser.parse_args()
+    for frame in iter_stream(arguments.host, arguments.port):
+        center = frame.positions.mean(axis=0) if len(frame.ids) else []
+        print(f"turn {frame.turn}: {len(frame.ids)} particles, center {np.round(center, 3).tolist()}")
+
+
+if __name__ == "__main__":
+    main()
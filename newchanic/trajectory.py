@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import struct
+from queue import Queue
+from threading import Thread
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from newchanic.engine import Engine, Feature
+
+MAGIC = b"NWCTRJ01"
+# magic, dimension number, flags, dtype of the recorded values (e.g. "<f4")
+FILE_HEADER = struct.Struct("<8sII4s")
+# kind, turn, particle number, reserved
+CHUNK_HEADER = struct.Struct("<IIII")
+FRAME, REMOVAL = 1, 2
+WITH_MASSES, WITH_VELOCITIES = 1, 2
+ID_DTYPE = np.dtype("<u4")
+
+
+class Frame(NamedTuple):
+    turn: int
+    ids: np.ndarray
+    positions: np.ndarray
+    masses: Optional[np.ndarray]
+    velocities: Optional[np.ndarray]
+
+
+class TrajectoryRecorder(Feature[None]):
+    # Records the particles at every feature step, i.e. once by turn before the pending updates are applied.
+    # It must be registered after the "remove" feature so that it can record the removals of the turn.
+    def __init__(
+        self,
+        path: str,
+        record_masses: bool = False,
+        record_velocities: bool = False,
+        dtype: np.dtype = np.float32,
+        every: int = 1,
+        queue_size: int = 64,
+    ):
+        assert every >= 1, "every must be >= 1"
+        self.path = path
+        self.flags = WITH_MASSES * record_masses | WITH_VELOCITIES * record_velocities
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.every = every
+        self._header_written = False
+        # The queue is bounded so that a disk slower than the physics blocks the engine instead of filling the memory
+        self._queue: Queue = Queue(queue_size)
+        self._error: Optional[BaseException] = None
+        self._writer = Thread(target=self._write_chunks, name="trajectory-writer", daemon=True)
+        self._writer.start()
+
+    def __call__(self, engine: Engine):
+        if self._error is not None:
+            raise self._error
+        if not self._header_written:
+            dimension_nbr = engine.get_state()[2].shape[1]
+            self._queue.put(FILE_HEADER.pack(MAGIC, dimension_nbr, self.flags, self.dtype.str.encode()))
+            self._header_written = True
+        removed = engine.features["remove"].last_removed
+        if removed:
+            ids = np.array([particle.id for particle in removed], dtype=ID_DTYPE)
+            self._queue.put(CHUNK_HEADER.pack(REMOVAL, engine.turn, len(ids), 0) + ids.tobytes())
+        if engine.turn % self.every == 0:
+            self._record_frame(engine)
+
+    def _record_frame(self, engine: Engine):
+        particles, masses, positions, velocities = engine.get_state()
+        ids = np.fromiter((particle.id for particle in particles), dtype=ID_DTYPE, count=len(particles))
+        # The bytes are copied here, so that the engine can keep on modifying its arrays while they are written
+        chunks = [CHUNK_HEADER.pack(FRAME, engine.turn, len(particles), 0), ids.tobytes()]
+        chunks.append(positions.astype(self.dtype, copy=False).tobytes())
+        if self.flags & WITH_MASSES:
+            chunks.append(masses.astype(self.dtype, copy=False).tobytes())
+        if self.flags & WITH_VELOCITIES:
+            chunks.append(velocities.astype(self.dtype, copy=False).tobytes())
+        self._queue.put(b"".join(chunks))
+
+    def _write_chunks(self):
+        try:
+            with open(self.path, "wb", buffering=2 ** 20) as file:
+                while True:
+                    chunk = self._queue.get()
+                    if chunk is None:
+                        break
+                    file.write(chunk)
+        except BaseException as e:
+            self._error = e
+            # Keeps on consuming so that the engine is never blocked on a full queue
+            while self._queue.get() is not None:
+                pass
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self) -> TrajectoryRecorder:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TrajectoryReader:
+    def __init__(self, path: str):
+        # The file is memory-mapped: frames are read from the page cache only when they are accessed
+        self._data = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, self.dimension_nbr, self.flags, dtype = FILE_HEADER.unpack_from(self._data, 0)
+        assert magic == MAGIC, f"{path} is not a trajectory file"
+        self.dtype = np.dtype(dtype.rstrip(b"\0").decode())
+        self.has_masses = bool(self.flags & WITH_MASSES)
+        self.has_velocities = bool(self.flags & WITH_VELOCITIES)
+        # (turn, offset of the payload, particle number) of every frame
+        self._frames: List[Tuple[int, int, int]] = []
+        self.removals: Dict[int, np.ndarray] = {}
+        self._index(len(self._data))
+        self.turns = np.array([turn for turn, _, _ in self._frames], dtype=int)
+
+    def _index(self, size: int):
+        frame_size = self.dimension_nbr * (1 + self.has_velocities) + self.has_masses
+        offset = FILE_HEADER.size
+        while offset + CHUNK_HEADER.size <= size:
+            kind, turn, count, _ = CHUNK_HEADER.unpack_from(self._data, offset)
+            offset += CHUNK_HEADER.size
+            if kind == FRAME:
+                payload_size = count * (ID_DTYPE.itemsize + frame_size * self.dtype.itemsize)
+            elif kind == REMOVAL:
+                payload_size = count * ID_DTYPE.itemsize
+            else:
+                raise ValueError(f"Unknown chunk kind {kind} at offset {offset - CHUNK_HEADER.size}")
+            if offset + payload_size > size:
+                # Last chunk of a recording which has been interrupted
+                break
+            if kind == FRAME:
+                self._frames.append((turn, offset, count))
+            else:
+                self.removals[turn] = self._read(offset, ID_DTYPE, count)
+            offset += payload_size
+
+    def _read(self, offset: int, dtype: np.dtype, count: int) -> np.ndarray:
+        return self._data[offset : offset + count * dtype.itemsize].view(dtype)
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def __getitem__(self, index: int) -> Frame:
+        turn, offset, count = self._frames[index]
+        ids = self._read(offset, ID_DTYPE, count)
+        offset += ids.nbytes
+        positions = self._read(offset, self.dtype, count * self.dimension_nbr).reshape(count, self.dimension_nbr)
+        offset += positions.nbytes
+        masses = velocities = None
+        if self.has_masses:
+            masses = self._read(offset, self.dtype, count)
+            offset += masses.nbytes
+        if self.has_velocities:
+            velocities = self._read(offset, self.dtype, count * self.dimension_nbr).reshape(count, self.dimension_nbr)
+        return Frame(turn, ids, positions, masses, velocities)
+
+    def seek(self, turn: int) -> int:
+        # Index of the last frame recorded at or before turn
+        return max(int(np.searchsorted(self.turns, turn, side="right")) - 1, 0)
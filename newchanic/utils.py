@@ -1,7 +1,7 @@
 from itertools import cycle
 from math import sqrt
 from random import random
-from typing import Union, TypeVar, List
+from typing import Union, TypeVar, List, Sequence, Iterator, Tuple
 
 Number = Union[int, float]
 
@@ -11,14 +11,46 @@ def dist(delta_x, delta_y):
 
 
 def compute_multi_dimensional_distance(position_1, position_2):
-    first = dist(position_1[0] - position_2[0], position_2[1] - position_1[1])
-    for p1, p2 in zip(position_1[2:], position_2[2:]):
-        first = dist(first, p1 - p2)
-    return first
+    # A single square root of the summed squares, instead of one hypotenuse by additional dimension
+    squared_distance = 0
+    for p1, p2 in zip(position_1, position_2):
+        delta = p1 - p2
+        squared_distance += delta * delta
+    return sqrt(squared_distance)
 
 
 T = TypeVar("T")
 
+# Number of particles per tile in iter_unique_pairs, small enough for a pair of tiles to stay in cache
+DEFAULT_TILE_SIZE = 64
+
+
+def iter_unique_pairs(items: Sequence[T], tile_size: int = DEFAULT_TILE_SIZE) -> Iterator[Tuple[T, T]]:
+    # Every unordered pair is yielded exactly once, tile against tile, so that the items of two tiles are reused
+    # tile_size times while they are hot instead of streaming the whole sequence for each item
+    assert tile_size > 0, "tile_size must be > 0"
+    for tile_1_start in range(0, len(items), tile_size):
+        tile_1 = items[tile_1_start : tile_1_start + tile_size]
+        for i, item_1 in enumerate(tile_1):
+            for item_2 in tile_1[i + 1 :]:
+                yield item_1, item_2
+        for tile_2_start in range(tile_1_start + tile_size, len(items), tile_size):
+            tile_2 = items[tile_2_start : tile_2_start + tile_size]
+            for item_1 in tile_1:
+                for item_2 in tile_2:
+                    yield item_1, item_2
+
+
+def overrides_batch_method(obj, base: type, batch_method: str, pair_methods: Tuple[str, ...]) -> bool:
+    # The batch method of obj is used only if it is overridden by a class at least as derived as the ones overriding
+    # the per pair methods, so that a subclass changing the per pair behaviour of a law shipping a batch
+    # implementation is not silently bypassed
+    def get_owner(name: str) -> type:
+        return next(cls for cls in type(obj).__mro__ if name in cls.__dict__)
+
+    batch_owner = get_owner(batch_method)
+    return batch_owner is not base and all(issubclass(batch_owner, get_owner(name)) for name in pair_methods)
+
 
 def split_into_lists(items: List[T], nbr: int) -> List[List[T]]:
     assert nbr > 0, "nbr must be > 0"
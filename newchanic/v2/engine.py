@@ -1,5 +1,14 @@
 from collections.abc import Sequence
 from itertools import zip_longest
+from time import time
+from typing import Optional
+
+import numpy as np
+
+from newchanic.laws import compute_gravity_block_forces
+from newchanic.solvers import ForceSolver, compute_block_accelerations
+from newchanic.utils import iter_unique_pairs, DEFAULT_TILE_SIZE, overrides_batch_method
+from newchanic.v2.utils import compute_multi_dimensional_distance
 
 
 class DelayedUpdateMixin:
@@ -16,26 +25,35 @@ class DelayedUpdateMixin:
             self.__dict__[key] = value
 
 
+# Value of the next buffer of a field which has no pending update
+UNSET = object()
+
+
 class Particle:
+    # Same semantic as DelayedUpdateMixin, with two slots by field instead of dicts: reads get the current value at
+    # slot speed, writes go to the next buffer until update is called
+    FIELDS = ("MASS", "_position", "position", "_speed")
+    __slots__ = FIELDS + tuple(f"_next_{field}" for field in FIELDS)
     MASS: float
     _position: list[float]
-    _speed: list[float]
     position: Sequence[float]
+    _speed: list[float]
 
     def __init__(self):
-        super().__init__()
-        super().__setattr__("manager", DelayedUpdateMixin())
-        self.MASS = 0
-        self._position = []
-        self.position = self._position
-        self._speed = []
-        self.update()
-
-    def __getattr__(self, item):
-        return getattr(super().__getattribute__("manager"), item)
+        position = []
+        for field, value in zip(self.FIELDS, (0, position, position, [])):
+            object.__setattr__(self, field, value)
+            object.__setattr__(self, f"_next_{field}", UNSET)
 
     def __setattr__(self, key, value):
-        setattr(super().__getattribute__("manager"), key, value)
+        object.__setattr__(self, f"_next_{key}", value)
+
+    def update(self):
+        for field, next_field in BUFFERS:
+            value = next_field.__get__(self)
+            if value is not UNSET:
+                field.__set__(self, value)
+                next_field.__set__(self, UNSET)
 
     def receive_force(self, force: list[float]) -> None:
         pass
@@ -44,45 +62,107 @@ class Particle:
         return id(self)
 
 
+# (current, next) slot descriptors of every field of Particle
+BUFFERS = tuple((Particle.__dict__[field], Particle.__dict__[f"_next_{field}"]) for field in Particle.FIELDS)
+
+
 class Law:
     def compute_force_intensity_from_interaction_between(self, particle_0: Particle, particle_1: Particle) -> float:
         raise NotImplementedError
 
+    def compute_block_forces(
+        self, masses: np.ndarray, positions: np.ndarray, other_masses: np.ndarray, other_positions: np.ndarray
+    ) -> np.ndarray:
+        # Optional batch protocol, same as physics.ForceGenerator.compute_block_forces
+        raise NotImplementedError
+
+
+def uses_block_forces(law: Law) -> bool:
+    return overrides_batch_method(
+        law, Law, "compute_block_forces", ("compute_force_intensity_from_interaction_between",)
+    )
+
+
+class Gravity(Law):
+    g = 0.005
+
+    def compute_force_intensity_from_interaction_between(self, particle_0: Particle, particle_1: Particle) -> float:
+        distance = compute_multi_dimensional_distance(particle_0.position, particle_1.position)
+        return self.g * particle_0.MASS * particle_1.MASS / distance**3
+
+    def compute_block_forces(
+        self, masses: np.ndarray, positions: np.ndarray, other_masses: np.ndarray, other_positions: np.ndarray
+    ) -> np.ndarray:
+        return compute_gravity_block_forces(self.g, masses, positions, other_masses, other_positions)
+
 
 class Engine:
     particles: list[Particle]
     laws: list[Law]
-    _already_computed_interactions: set[frozenset[Particle]]
+    solver: Optional[ForceSolver]
+    tile_size: int
 
     def __init__(self):
         self.particles = []
         self.laws = []
-        self._already_computed_interactions = set()
-
-    def run(self):
-        while True:
-            for particle_0 in self.particles:
-                for particle_1 in self.particles:
-                    if particle_0 is particle_1:
-                        continue
-                    total_force: list[float] = []
-                    for law in self.laws:
-
-                        force_intensity = law.compute_force_intensity_from_interaction_between(particle_0, particle_1)
-
-                        force_vector = []
-                        for p0_dim_pos, p1_dim_pos in zip_longest(particle_0.position, particle_1.position):
-                            if p0_dim_pos is None or p1_dim_pos is None:
-                                force_vector.append(0.0)
-                            else:
-                                force_vector.append((p0_dim_pos - p1_dim_pos) * force_intensity)
-
-                        for i, dimensional_force in enumerate(force_vector):
-                            if i >= len(total_force):
-                                total_force.append(0)
-                            total_force[i] += dimensional_force
-
-                    particle_1.receive_force(total_force)
+        self.solver = None
+        self.tile_size = DEFAULT_TILE_SIZE
+
+    def is_solved(self, law: Law) -> bool:
+        # The solver computes the force of Gravity, subclasses changing its pairwise or block force are not solved
+        return (
+            self.solver is not None
+            and isinstance(law, Gravity)
+            and uses_block_forces(law)
+            and type(law).compute_block_forces is Gravity.compute_block_forces
+        )
+
+    def is_batched(self, law: Law) -> bool:
+        return not self.is_solved(law) and uses_block_forces(law)
+
+    def apply_solver(self):
+        # Laws implementing the batch protocol are evaluated by blocks along with the solved ones
+        solved_laws = [law for law in self.laws if self.is_solved(law)]
+        batched_laws = tuple(law for law in self.laws if self.is_batched(law))
+        if not (solved_laws or batched_laws) or not self.particles:
+            return
+        masses = np.array([particle.MASS for particle in self.particles], dtype=float)
+        positions = np.array([particle.position for particle in self.particles], dtype=float)
+        accelerations = sum(self.solver.compute_accelerations(law, masses, positions) for law in solved_laws)
+        if batched_laws:
+            accelerations = accelerations + compute_block_accelerations(batched_laws, masses, positions)
+        for particle, force in zip(self.particles, (accelerations * masses[:, np.newaxis]).tolist()):
+            particle.receive_force(force)
+
+    def run(self, max_turns: Optional[int] = None, max_seconds: Optional[float] = None) -> int:
+        start = time()
+        turn_number = 0
+        while (max_turns is None or turn_number < max_turns) and (max_seconds is None or time() - start < max_seconds):
+            self.apply_solver()
+            pairwise_laws = [law for law in self.laws if not self.is_solved(law) and not self.is_batched(law)]
+            # Each unordered pair is processed once, the opposite force is given to the other particle
+            for particle_0, particle_1 in iter_unique_pairs(self.particles if pairwise_laws else [], self.tile_size):
+                total_force: list[float] = []
+                for law in pairwise_laws:
+
+                    force_intensity = law.compute_force_intensity_from_interaction_between(particle_0, particle_1)
+
+                    force_vector = []
+                    for p0_dim_pos, p1_dim_pos in zip_longest(particle_0.position, particle_1.position):
+                        if p0_dim_pos is None or p1_dim_pos is None:
+                            force_vector.append(0.0)
+                        else:
+                            force_vector.append((p0_dim_pos - p1_dim_pos) * force_intensity)
+
+                    for i, dimensional_force in enumerate(force_vector):
+                        if i >= len(total_force):
+                            total_force.append(0)
+                        total_force[i] += dimensional_force
+
+                particle_1.receive_force(total_force)
+                particle_0.receive_force([-dimensional_force for dimensional_force in total_force])
 
             for particle in self.particles:
                 particle.update()
+            turn_number += 1
+        return turn_number
@@ -7,8 +7,9 @@ def dist(delta_x: float, delta_y: float) -> float:
 
 
 def compute_multi_dimensional_distance(position_1: Sequence[float], position_2: Sequence[float]) -> float:
-    # todo : make work with unidimensional positions
-    first = dist(position_1[0] - position_2[0], position_2[1] - position_1[1])
-    for p1, p2 in zip(position_1[2:], position_2[2:]):
-        first = dist(first, p1 - p2)
-    return first
+    # A single square root of the summed squares, which also works with unidimensional positions
+    squared_distance = 0.0
+    for p1, p2 in zip(position_1, position_2):
+        delta = p1 - p2
+        squared_distance += delta * delta
+    return sqrt(squared_distance)
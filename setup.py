@@ -25,5 +25,5 @@ setup(
     ],
     packages=["newchanic"],
     include_package_data=True,
-    install_requires=["pygame"],
+    install_requires=["pygame", "numpy"],
 )
@@ -0,0 +1,50 @@
+from random import seed, random
+
+from newchanic.array_engine import ArrayEngine
+from newchanic.engine import Engine
+from newchanic.laws import Gravity, Merge
+from newchanic.physics import ForceGenerator
+
+
+class OneTurnEngine(Engine):
+    def run_custom_engine_features(self):
+        self._keep_running = False
+
+
+class OneTurnArrayEngine(ArrayEngine):
+    def run_custom_engine_features(self):
+        self._keep_running = False
+
+
+class PairwiseGravity(ForceGenerator):
+    # Gravity computed pair by pair, which the solvers do not take over
+    def compute_force(self, particle, other_particle):
+        return Gravity().compute_force(particle, other_particle)
+
+
+def build_merging_pairs_engine(engine_type):
+    # Five pairs of approaching particles, each merging during the second turn
+    return engine_type(
+        particle_number=10,
+        get_mass=lambda i: 10.0 + i,
+        get_position=lambda i: [(i // 2) * 100.0 + 4 * (i % 2), 0.0, 0.0],
+        get_velocity=lambda i: [-1.5 * (i % 2), 0.1 * i, 0.0],
+        force_generators=(Gravity(),),
+        arbitrary_laws=(Merge(),),
+    )
+
+
+def build_random_engine(engine_type, force_generator):
+    # 25 particles at random in a box of 20, the same ones at every call
+    seed(0)
+    positions = [[random() * 20, random() * 20, random() * 20] for _ in range(25)]
+    return engine_type(
+        particle_number=25,
+        get_mass=lambda i: 10 + i,
+        get_position=lambda i: list(positions[i]),
+        force_generators=(force_generator,),
+    )
+
+
+def get_sorted_state(engine):
+    return sorted((float(particle.mass), *particle.position, *particle._velocity) for particle in engine.particles)
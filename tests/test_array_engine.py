@@ -0,0 +1,85 @@
+from random import seed
+
+import numpy as np
+
+from newchanic.solvers import compute_gravity_accelerations
+from newchanic.laws import Gravity, Merge
+
+from helpers import OneTurnArrayEngine, PairwiseGravity
+
+
+def test_gravity_accelerations_match_pairwise_sum():
+    rng = np.random.default_rng(0)
+    masses = rng.uniform(10, 100, 50)
+    positions = rng.uniform(-500, 500, (50, 3))
+    expected = np.zeros_like(positions)
+    for i in range(50):
+        for j in range(50):
+            if i != j:
+                delta = positions[j] - positions[i]
+                expected[i] += Gravity.g * masses[j] * delta / np.linalg.norm(delta) ** 3
+    accelerations = compute_gravity_accelerations(masses, positions, Gravity.g, block_size=64)
+    assert np.allclose(accelerations, expected, rtol=1e-9, atol=0)
+
+
+def test_vectorized_and_pairwise_force_generators_agree():
+    seed(1)
+    vectorized = OneTurnArrayEngine(particle_number=30, force_generators=(Gravity(),))
+    seed(1)
+    pairwise = OneTurnArrayEngine(particle_number=30, force_generators=(PairwiseGravity(),))
+    vectorized.run()
+    pairwise.run()
+    assert np.allclose(vectorized.store.velocities, pairwise.store.velocities)
+    assert np.allclose(vectorized.store.positions, pairwise.store.positions)
+
+
+def test_merge_removes_particles_from_store():
+    positions = [[0, 0, 0], [1, 0, 0], [100, 0, 0]]
+    engine = OneTurnArrayEngine(
+        particle_number=3,
+        get_mass=lambda i: 10 * (i + 1),
+        get_position=lambda i: positions[i],
+        arbitrary_laws=(Merge(),),
+    )
+    engine.run()
+    assert len(engine.store) == len(engine.particles) == 2
+    assert sorted(engine.store.masses) == [30, 30]
+    assert [particle.index for particle in engine.store.particles] == [0, 1]
+
+
+def build_merging_engine(compaction_threshold):
+    # Five pairs of close particles, each merging during the first turn
+    return OneTurnArrayEngine(
+        particle_number=10,
+        get_mass=lambda i: 10.0 + i,
+        get_position=lambda i: [(i // 2) * 100.0 + i % 2, 0.0, 0.0],
+        force_generators=(Gravity(),),
+        arbitrary_laws=(Merge(),),
+        compaction_threshold=compaction_threshold,
+    )
+
+
+def test_removed_particles_are_tombstoned_until_compaction():
+    tombstoned, compacted = build_merging_engine(0.6), build_merging_engine(0.25)
+    tombstoned.run()
+    compacted.run()
+    assert len(tombstoned.store) == 10 and tombstoned.store.dead_nbr == 5
+    assert len(compacted.store) == 5 and compacted.store.dead_nbr == 0
+    assert not tombstoned.store.masses[~tombstoned.store.alive].any()
+    states = []
+    for engine in (tombstoned, compacted):
+        particles, masses, positions, velocities = engine.get_state()
+        assert len(particles) == len(engine.particles) == 5
+        states.append(({particle.id for particle in particles}, masses, positions, velocities))
+    assert states[0][0] == states[1][0] < set(range(10))
+    for expected, actual in zip(states[0][1:], states[1][1:]):
+        assert np.allclose(expected, actual)
+    # Removed particles keep their id after the compaction
+    removed = compacted.features["remove"].last_removed
+    assert {particle.id for particle in removed} == set(range(10)) - states[1][0]
+    # Dead particles neither move nor attract the others
+    for engine in (tombstoned, compacted):
+        engine._keep_running = True
+        engine.run()
+    for expected, actual in zip(tombstoned.get_state()[1:], compacted.get_state()[1:]):
+        assert np.allclose(expected, actual)
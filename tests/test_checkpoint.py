@@ -0,0 +1,103 @@
+import json
+
+import numpy as np
+import pytest
+
+from newchanic.array_engine import ArrayEngine
+from newchanic.checkpoint import AutoCheckpoint, save_checkpoint, load_checkpoint
+from newchanic.engine import Engine
+from newchanic.laws import Gravity, Merge
+
+
+def build_engine(engine_type):
+    return engine_type(
+        particle_number=12,
+        get_mass=lambda i: 10.0 + i,
+        get_position=lambda i: [(i // 2) * 50.0 + 4 * (i % 2), 10.0 * (i // 2 % 3), 0.0],
+        get_velocity=lambda i: [-1.5 * (i % 2), 0.0, 0.1 * i],
+        force_generators=(Gravity(),),
+        arbitrary_laws=(Merge(),),
+    )
+
+
+def get_state(engine):
+    _, masses, positions, velocities = engine.get_state()
+    order = np.argsort(masses)
+    return masses[order], positions[order], velocities[order]
+
+
+@pytest.mark.parametrize("engine_type", [Engine, ArrayEngine])
+def test_resumed_run_matches_uninterrupted_run(engine_type, tmp_path):
+    path = str(tmp_path / "engine.npz")
+    engine = build_engine(engine_type)
+    engine.features["checkpoint"] = AutoCheckpoint(path, every=2)
+    # The checkpoint is saved during the second turn, while the merges of that turn are pending
+    engine.run(max_turns=2)
+    engine.features.pop("checkpoint")
+    engine.run(max_turns=3)
+
+    resumed = build_engine(engine_type)
+    load_checkpoint(resumed, path)
+    assert resumed.turn == 2
+    resumed.run(max_turns=3)
+    assert resumed.turn == engine.turn == 5
+    for expected, actual in zip(get_state(engine), get_state(resumed)):
+        assert np.allclose(expected, actual, rtol=1e-12)
+
+
+def test_law_parameters_and_pending_updates_are_restored(tmp_path):
+    path = str(tmp_path / "engine.npz")
+    engine = build_engine(ArrayEngine)
+    engine.force_generators[0].g = 1.5
+    particle = engine.store.particles[3]
+    particle.delay_update("_mass", 99.0)
+    save_checkpoint(engine, path)
+
+    restored = build_engine(ArrayEngine)
+    load_checkpoint(restored, path)
+    assert restored.force_generators[0].g == 1.5
+    assert restored.store.particles[3]._next_values == {"_mass": 99.0}
+    assert np.array_equal(restored.store.positions, engine.store.positions)
+
+    other = ArrayEngine(particle_number=2, force_generators=(Gravity(),))
+    with pytest.raises(ValueError):
+        load_checkpoint(other, path)
+
+
+def test_pending_positions_are_stored_as_arrays(tmp_path):
+    path = str(tmp_path / "engine.npz")
+    engine = build_engine(Engine)
+    particles = list(engine.particles)
+    for particle in particles:
+        particle.run()
+    particles[0].delay_update("_mass", 99.0)
+    save_checkpoint(engine, path, in_turn=True)
+    with np.load(path) as data:
+        assert len(data["pending_positions"]) == len(data["pending_positions_indexes"]) == 12
+        assert [field for _, field, _ in json.loads(str(data["metadata"]))["pending"]] == ["_mass"]
+
+    restored = build_engine(Engine)
+    load_checkpoint(restored, path)
+    engine.apply_updates()
+    for expected, actual in zip(get_state(engine), get_state(restored)):
+        assert np.array_equal(expected, actual)
+
+
+@pytest.mark.parametrize("engine_type", [Engine, ArrayEngine])
+def test_pending_removals_are_restored(engine_type, tmp_path):
+    path = str(tmp_path / "engine.npz")
+    engine = build_engine(engine_type)
+    particles = engine.get_state()[0]
+    for particle in particles:
+        particle.run()
+    engine.features["remove"].particles_to_remove = {particles[2], particles[5]}
+    save_checkpoint(engine, path, in_turn=True)
+
+    restored = build_engine(engine_type)
+    load_checkpoint(restored, path)
+    assert {particle.id for particle in restored.features["remove"].particles_to_remove} == {
+        particles[2].id,
+        particles[5].id,
+    }
+    restored.features["remove"](restored)
+    assert len(restored.get_state()[0]) == 10
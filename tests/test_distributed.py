@@ -0,0 +1,100 @@
+import socket
+from multiprocessing import Process
+
+import numpy as np
+import pytest
+
+from newchanic.array_engine import ArrayEngine
+from newchanic.distributed import DistributedPool, partition, main
+from newchanic.engine import Engine
+from newchanic.laws import Gravity
+from newchanic.physics import ForceGenerator
+from newchanic.solvers import DirectSolver
+
+from helpers import PairwiseGravity, build_random_engine, get_sorted_state
+
+
+class FailingForceGenerator(ForceGenerator):
+    def compute_force(self, particle, other_particle):
+        raise ValueError("Failing force generator")
+
+
+class FirstTurnFailingGravity(PairwiseGravity):
+    # Every worker has its own copy, which fails on its first turn only
+    failed = False
+
+    def compute_force(self, particle, other_particle):
+        if not self.failed:
+            self.failed = True
+            raise ValueError("First turn failure")
+        return super().compute_force(particle, other_particle)
+
+
+@pytest.mark.parametrize("domain_nbr", [1, 3, 4])
+def test_partition_splits_the_particles_in_balanced_domains(domain_nbr):
+    positions = np.random.default_rng(0).uniform(-10, 10, (101, 3))
+    domains = partition(positions, domain_nbr)
+    assert len(domains) == domain_nbr
+    assert sorted(np.concatenate(domains).tolist()) == list(range(101))
+    assert max(map(len, domains)) - min(map(len, domains)) <= 1
+
+
+@pytest.mark.parametrize("engine_type", [Engine, ArrayEngine])
+@pytest.mark.parametrize("force_generator", [Gravity(), PairwiseGravity()])
+def test_run_distributed_matches_run(engine_type, force_generator):
+    single_node = build_random_engine(engine_type, force_generator)
+    distributed = build_random_engine(engine_type, force_generator)
+    assert single_node.run(max_turns=2) == distributed.run_distributed(3, max_turns=2) == 2
+    assert np.allclose(get_sorted_state(single_node), get_sorted_state(distributed))
+
+
+def test_far_domains_are_sent_as_monopoles():
+    rng = np.random.default_rng(1)
+    positions = np.concatenate([rng.normal(center, 10, (300, 3)) for center in (0, 1000, 2000, 3000)])
+    masses = rng.uniform(10, 100, len(positions))
+    accelerations, bytes_sent = [], []
+    for theta in (0, 0.5):
+        with DistributedPool(4, len(positions), 3, DirectSolver(), (Gravity(),), (), theta=theta) as pool:
+            pool.state.masses[:] = masses
+            pool.state.positions[:] = positions
+            accelerations.append(pool.compute_accelerations(len(positions)).copy())
+            bytes_sent.append(pool.bytes_sent)
+    exact = DirectSolver().compute_accelerations(Gravity(), masses, positions)
+    assert np.allclose(accelerations[0], exact)
+    errors = np.linalg.norm(accelerations[1] - exact, axis=1) / np.linalg.norm(exact, axis=1)
+    assert errors.max() < 1e-2
+    assert bytes_sent[1] < bytes_sent[0] / 3
+
+
+def test_workers_may_be_started_separately():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    worker = Process(target=main, args=(["127.0.0.1", str(port), "--timeout", "10"],), daemon=True)
+    worker.start()
+    single_node = build_random_engine(ArrayEngine, Gravity())
+    distributed = build_random_engine(ArrayEngine, Gravity())
+    single_node.run(max_turns=2)
+    distributed.run_distributed(1, max_turns=2, address=("127.0.0.1", port), spawn_workers=False)
+    worker.join(5)
+    assert worker.exitcode == 0
+    assert np.allclose(get_sorted_state(single_node), get_sorted_state(distributed))
+
+
+def test_worker_errors_are_raised_by_the_engine():
+    engine = build_random_engine(ArrayEngine, FailingForceGenerator())
+    with pytest.raises(RuntimeError, match="Failing force generator"):
+        engine.run_distributed(2, max_turns=1)
+
+
+def test_pools_can_be_reused_after_worker_errors():
+    rng = np.random.default_rng(2)
+    positions, masses = rng.uniform(-10, 10, (40, 3)), rng.uniform(10, 100, 40)
+    with DistributedPool(3, len(positions), 3, None, (), (FirstTurnFailingGravity(),)) as pool:
+        pool.state.masses[:] = masses
+        pool.state.positions[:] = positions
+        with pytest.raises(RuntimeError, match="3 of 3 workers failed") as error:
+            pool.compute_accelerations(len(positions))
+        assert str(error.value).count("ValueError: First turn failure") == 3
+        accelerations = pool.compute_accelerations(len(positions))
+        assert np.allclose(accelerations, DirectSolver().compute_accelerations(Gravity(), masses, positions))
@@ -0,0 +1,68 @@
+from random import seed, random
+
+import numpy as np
+import pytest
+
+from newchanic.array_engine import ArrayEngine
+from newchanic.engine import Engine
+from newchanic.laws import Gravity, Merge
+from newchanic.utils import iter_unique_pairs
+
+from helpers import OneTurnArrayEngine, OneTurnEngine
+
+
+class CountingGravity(Gravity):
+    def __init__(self):
+        self.calls = 0
+
+    def compute_force(self, particle, other_particle):
+        self.calls += 1
+        return super().compute_force(particle, other_particle)
+
+
+@pytest.mark.parametrize("tile_size", [1, 3, 64])
+def test_iter_unique_pairs_visits_every_pair_once(tile_size):
+    pairs = list(iter_unique_pairs(list(range(10)), tile_size))
+    assert len(pairs) == 45
+    assert {frozenset(pair) for pair in pairs} == {frozenset((i, j)) for i in range(10) for j in range(i + 1, 10)}
+
+
+def test_each_pair_is_evaluated_once_per_turn():
+    gravity = CountingGravity()
+    OneTurnEngine(particle_number=20, force_generators=(gravity,), tile_size=6).run()
+    assert gravity.calls == 20 * 19 / 2
+
+
+def test_object_and_array_engines_agree():
+    seed(0)
+    positions = [[random() * 100, random() * 100, random() * 100] for _ in range(15)]
+    kwargs = dict(
+        particle_number=15,
+        get_mass=lambda i: 10 + i,
+        get_position=lambda i: list(positions[i]),
+        get_velocity=lambda i: [0.0, 0.1 * i, 0.0],
+        force_generators=(Gravity(),),
+    )
+    engine = OneTurnEngine(**kwargs)
+    array_engine = OneTurnArrayEngine(**kwargs)
+    engine.run()
+    array_engine.run()
+    for particle in engine.particles:
+        index = int(particle.mass - 10)
+        assert np.allclose(particle.position, array_engine.store.positions[index])
+        assert np.allclose(particle._velocity, array_engine.store.velocities[index])
+
+
+@pytest.mark.parametrize("engine_type", [Engine, ArrayEngine])
+def test_run_stops_after_max_turns(engine_type):
+    engine = engine_type(particle_number=10, force_generators=(Gravity(),))
+    assert engine.run(max_turns=3) == 3
+    assert engine.run(max_turns=0) == 0
+
+
+@pytest.mark.parametrize("engine_type", [Engine, ArrayEngine])
+def test_engines_without_particles(engine_type):
+    engine = engine_type(particle_number=0, force_generators=(Gravity(),), arbitrary_laws=(Merge(),))
+    assert engine.run(max_turns=2) == 2
+    particles, masses, positions, velocities = engine.get_state()
+    assert not particles and masses.shape == (0,) and positions.shape == velocities.shape == (0, 0)
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+from newchanic.array_engine import ArrayEngine
+from newchanic.ensemble import Ensemble
+from newchanic.initial_conditions import plummer_sphere, uniform_box, InitialConditions
+from newchanic.instrumentation import Instrumentation
+from newchanic.integrators import EulerIntegrator, LeapfrogIntegrator, BlockTimestepIntegrator
+from newchanic.laws import Gravity, Merge
+
+
+def build_gravity(g):
+    gravity = Gravity()
+    gravity.g = g
+    return gravity
+
+
+def build_merge(umd):
+    merge = Merge()
+    merge.umd = umd
+    return merge
+
+
+@pytest.mark.parametrize("integrator_type", [EulerIntegrator, LeapfrogIntegrator])
+def test_members_evolve_as_engines(integrator_type):
+    # Members of different sizes are padded with dead particles, which must not change anything
+    members = [plummer_sphere(n, total_mass=1000, scale_radius=10, seed=n) for n in (20, 35, 50)]
+    g = [0.005, 0.01, 0.02]
+    ensemble = Ensemble(members, g=g, integrator=integrator_type(0.5))
+    assert ensemble.run(max_turns=20) == 20
+    for member, member_g, result in zip(members, g, ensemble.get_results()):
+        engine = ArrayEngine(
+            initial_conditions=member, force_generators=(build_gravity(member_g),), integrator=integrator_type(0.5)
+        )
+        engine.run(max_turns=20)
+        assert result.turns == 20 and not result.stopped
+        assert np.allclose(result.positions, engine.store.positions, rtol=0, atol=1e-9)
+        assert np.allclose(result.velocities, engine.store.velocities, rtol=0, atol=1e-9)
+
+
+def test_merges_conserve_mass_and_momentum():
+    members = [uniform_box(40, (-60, -60, -60), (60, 60, 60), seed=seed) for seed in range(6)]
+    umd = np.linspace(10, 30, 6)
+    instrumentation = Instrumentation()
+    ensemble = Ensemble(members, umd=umd, instrumentation=instrumentation)
+    merges = 0
+    for _ in range(30):
+        ensemble.run(max_turns=1)
+        merges += instrumentation.last_record["counters"].get("merges", 0)
+    results = ensemble.get_results()
+    assert merges == sum(len(member.masses) - len(result.masses) for member, result in zip(members, results)) > 0
+    # Slots dead in every member are dropped once the dead particles are more than a quarter of the store
+    assert ensemble.store.dead_nbr <= 0.25 * len(ensemble.store)
+    assert ensemble.store.positions.shape[1] == max(len(result.masses) for result in results)
+    for member, result in zip(members, results):
+        assert result.masses.sum() == pytest.approx(member.masses.sum())
+        assert np.allclose(result.masses @ result.velocities, member.masses @ member.velocities, atol=1e-6)
+
+
+def test_merges_of_isolated_pairs_are_the_ones_of_the_engine():
+    positions = np.array([[0, 0, 0], [2, 0, 0], [500, 0, 0], [500, 1, 0], [-500, 0, 0]], dtype=float)
+    member = InitialConditions(
+        np.array([10.0, 20.0, 30.0, 40.0, 5.0]), positions, np.array([[1.0, 0, 0]] + [[0, 0, 0]] * 3 + [[0, 1, 0]])
+    )
+    ensemble = Ensemble([member, member], umd=[3, 0.5])
+    ensemble.run(max_turns=5)
+    for result, umd in zip(ensemble.get_results(), (3, 0.5)):
+        engine = ArrayEngine(
+            initial_conditions=member, force_generators=(Gravity(),), arbitrary_laws=(build_merge(umd),)
+        )
+        engine.run(max_turns=5)
+        _, masses, positions, velocities = engine.get_state()
+        order = np.argsort(result.masses)
+        engine_order = np.argsort(masses)
+        assert np.array_equal(result.masses[order], masses[engine_order])
+        assert np.allclose(result.positions[order], positions[engine_order])
+        assert np.allclose(result.velocities[order], velocities[engine_order])
+
+
+def test_stopped_members_are_frozen():
+    members = [plummer_sphere(30, total_mass=1000, scale_radius=10, seed=seed) for seed in range(4)]
+    g = [0.005, 0.01, 0.02, 0.04]
+    stopped_at = {}
+
+    def stop_condition(ensemble):
+        # Members stop after a number of turns depending on their index
+        stopped = (ensemble.store.members + 1) * 5 <= ensemble.turn
+        stopped_at.update({int(member): ensemble.turn for member in ensemble.store.members[stopped]})
+        return stopped
+
+    ensemble = Ensemble(members, g=g, stop_condition=stop_condition)
+    # The run ends with its last member
+    assert ensemble.run(max_turns=100) == 20
+    assert stopped_at == {0: 5, 1: 10, 2: 15, 3: 20} and not len(ensemble.store.members)
+    for member, member_g, result in zip(members, g, ensemble.get_results()):
+        assert result.stopped
+        engine = ArrayEngine(initial_conditions=member, force_generators=(build_gravity(member_g),))
+        engine.run(max_turns=result.turns)
+        assert np.allclose(result.positions, engine.store.positions, rtol=0, atol=1e-9)
+
+
+def test_block_timesteps_are_refused():
+    with pytest.raises(AssertionError):
+        Ensemble([uniform_box(10, seed=0)], integrator=BlockTimestepIntegrator())
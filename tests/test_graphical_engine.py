@@ -0,0 +1,120 @@
+import time
+
+import numpy as np
+import pygame
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def headless_display(monkeypatch):
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+
+
+@pytest.mark.parametrize("engine_name", ["GraphicalEngine2D", "GraphicalArrayEngine2D"])
+def test_batched_rendering_matches_circle_drawing(engine_name):
+    from newchanic import graphical_engine
+
+    # Masses giving sizes from 0 to 12, i.e. both stamped and blitted particles, some of them out of the window
+    engine = getattr(graphical_engine, engine_name)(
+        graphical_options={"window_size": (400, 200)},
+        particle_number=26,
+        get_mass=lambda i: 7 * (i // 2) ** 2 + 1,
+        get_position=lambda i: [i * 30.0 - 380, (i % 2) * 60.0 - 30, 0.0],
+    )
+    engine.erase_particles()
+    engine.update_particles()
+    expected = pygame.Surface(engine.options.size)
+    expected.fill(engine.background_color)
+    for particle in engine.particles:
+        size = particle.compute_size()
+        position = [int(i) for i in particle.compute_graphical_position()]
+        if size == 0:
+            expected.set_at(position, particle.get_or_create("color"))
+        pygame.draw.circle(expected, particle.get_or_create("color"), position, size, size)
+    assert np.array_equal(pygame.surfarray.array3d(engine._window), pygame.surfarray.array3d(expected))
+
+
+def test_sizes_are_only_recomputed_when_masses_or_zoom_change():
+    from newchanic.graphical_engine import GraphicalArrayEngine2D
+
+    engine = GraphicalArrayEngine2D(graphical_options={"window_size": (100, 100)}, particle_number=5)
+    sizes = engine.get_sizes(engine.store.masses)
+    assert engine.get_sizes(engine.store.masses) is sizes
+    engine.zoom(2)
+    assert engine.get_sizes(engine.store.masses) is not sizes
+    sizes = engine.get_sizes(engine.store.masses)
+    engine.store.masses[0] *= 10
+    assert engine.get_sizes(engine.store.masses)[0] > sizes[0]
+
+
+def test_frame_ring_buffer_keeps_the_last_frames():
+    from newchanic.frame_buffer import FrameRingBuffer
+
+    frames = FrameRingBuffer(capacity=2)
+    assert frames.latest() is None
+    for turn in range(5):
+        frames.publish(turn)
+    assert len(frames) == 2 and frames.latest() == 4 and frames.published == 5
+
+
+def test_rendering_does_not_wait_for_the_physics():
+    from newchanic.graphical_engine import GraphicalArrayEngine2D
+
+    class SlowEngine(GraphicalArrayEngine2D):
+        handled_events = 0
+
+        def compute_accelerations(self, targets=None):
+            time.sleep(0.2)
+            return super().compute_accelerations(targets)
+
+        def handle_events(self):
+            self.handled_events += 1
+            super().handle_events()
+
+    engine = SlowEngine(graphical_options={"window_size": (100, 100)}, particle_number=5, frames_per_second=100)
+    assert engine.run(max_turns=2) == 2
+    assert engine.frames.published == 2
+    # The render loop kept on handling events while the turns were computed
+    assert engine.handled_events > 10
+
+
+def test_off_screen_particles_are_culled_and_crowded_views_become_density_maps():
+    from newchanic.graphical_engine import GraphicalArrayEngine2D
+
+    drawn = []
+
+    class RecordingEngine(GraphicalArrayEngine2D):
+        def draw_points(self, xs, ys, sizes, colors):
+            drawn.append(len(xs))
+            super().draw_points(xs, ys, sizes, colors)
+
+    engine = RecordingEngine(
+        graphical_options={"window_size": (200, 100)},
+        particle_number=400,
+        get_position=lambda i: [(i % 20) * 50.0 - 500, (i // 20) * 50.0 - 500, 0.0],
+        density_threshold=100,
+    )
+    engine.update_particles()
+    # The 4 x 2 particles of the window plus a few ones of the border cells of the index
+    assert 8 <= drawn[-1] < 60
+    engine.zoom(10)
+    engine.erase_particles()
+    engine.update_particles()
+    assert len(drawn) == 1
+    pixels = pygame.surfarray.array3d(engine._window)
+    assert pixels.any(axis=2).sum() > 0
+
+
+def test_distributed_runs_are_rendered():
+    from newchanic.graphical_engine import GraphicalEngine2D
+
+    class CountingEngine(GraphicalEngine2D):
+        handled_events = 0
+
+        def handle_events(self):
+            self.handled_events += 1
+            super().handle_events()
+
+    engine = CountingEngine(graphical_options={"window_size": (100, 100)}, particle_number=5, frames_per_second=100)
+    assert engine.run_distributed(2, max_turns=3) == 3
+    assert engine.frames.published == 3 and engine.handled_events > 0
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from newchanic.__main__ import build_engine, parse_arguments
+from newchanic.array_engine import ArrayEngine
+from newchanic.engine import Engine
+from newchanic.initial_conditions import (
+    GENERATORS,
+    plummer_sphere,
+    rotating_disk,
+    colliding_clusters,
+    uniform_box,
+)
+from newchanic.integrators import compute_energy
+from newchanic.laws import Gravity
+
+
+@pytest.mark.parametrize("engine_type", [Engine, ArrayEngine])
+def test_engines_are_built_from_initial_conditions(engine_type):
+    conditions = uniform_box(50, seed=0)
+    engine = engine_type(initial_conditions=conditions, force_generators=(Gravity(),))
+    particles, masses, positions, velocities = engine.get_state()
+    assert [particle.id for particle in particles] == list(range(50))
+    for expected, actual in zip(conditions, (masses, positions, velocities)):
+        assert np.array_equal(expected, actual)
+
+
+@pytest.mark.parametrize("generator", GENERATORS.values())
+def test_generators_are_seeded(generator):
+    first, second, other = generator(100, seed=1), generator(100, seed=1), generator(100, seed=2)
+    assert all(np.array_equal(a, b) for a, b in zip(first, second))
+    assert not np.array_equal(first.positions, other.positions)
+    assert first.masses.shape == (100,) and first.positions.shape == first.velocities.shape == (100, 3)
+
+
+def test_plummer_sphere_is_in_virial_equilibrium():
+    masses, positions, velocities = plummer_sphere(2000, total_mass=1000, scale_radius=10, seed=0)
+    assert np.allclose(masses @ positions, 0) and np.allclose(masses @ velocities, 0)
+    kinetic = compute_energy(masses, positions, velocities, 0)
+    potential = compute_energy(masses, positions, velocities, Gravity.g) - kinetic
+    assert kinetic / -potential == pytest.approx(0.5, abs=0.05)
+    # Half of the mass is within 1.305 scale radiuses
+    assert np.median(np.linalg.norm(positions, axis=1)) == pytest.approx(13.05, rel=0.1)
+
+
+def test_rotating_disk_particles_are_on_circular_orbits():
+    masses, positions, velocities = rotating_disk(500, central_mass=1e6, disk_mass=1, dimension_nbr=2, seed=0)
+    radiuses = np.linalg.norm(positions[1:] - positions[0], axis=1)
+    speeds = np.linalg.norm(velocities[1:] - velocities[0], axis=1)
+    assert np.allclose(speeds, np.sqrt(Gravity.g * 1e6 / radiuses), rtol=1e-3)
+    assert np.allclose(np.einsum("ij,ij->i", positions[1:] - positions[0], velocities[1:] - velocities[0]), 0)
+
+
+def test_colliding_clusters_head_to_each_other():
+    conditions = colliding_clusters(201, separation=1000, relative_speed=2, impact_parameter=0, seed=0)
+    centers = [np.average(conditions.positions[part], axis=0) for part in (slice(None, 100), slice(100, None))]
+    speeds = [np.average(conditions.velocities[part], axis=0) for part in (slice(None, 100), slice(100, None))]
+    assert np.allclose(centers[1] - centers[0], [1000, 0, 0])
+    assert np.allclose(speeds[0] - speeds[1], [2, 0, 0])
+
+
+def test_command_line_initial_conditions():
+    engine = build_engine(parse_arguments(["--particles", "30", "--initial-conditions", "plummer", "--seed", "3"]))
+    assert np.array_equal(engine.store.positions, plummer_sphere(30, seed=3).positions)
@@ -0,0 +1,53 @@
+import csv
+import json
+
+import pytest
+
+from newchanic.array_engine import ArrayEngine
+from newchanic.engine import Engine
+from newchanic.instrumentation import Instrumentation, MemorySink, CsvSink, JsonLinesSink, NULL_INSTRUMENTATION
+from newchanic.laws import Gravity, Merge
+
+
+@pytest.mark.parametrize("engine_type", [Engine, ArrayEngine])
+def test_turn_phases_and_counters_are_recorded(engine_type):
+    sink = MemorySink()
+    engine = engine_type(
+        particle_number=10,
+        get_position=lambda i: [(i // 2) * 100.0 + i % 2, 0, 0],
+        force_generators=(Gravity(),),
+        arbitrary_laws=(Merge(),),
+        instrumentation=Instrumentation([sink]),
+    )
+    assert engine.run(max_turns=2) == 2
+    assert [record["turn"] for record in sink.records] == [0, 1]
+    first = sink.records[0]
+    assert {"solver", "local_laws", "features", "update", "custom_features"} <= set(first["timings"])
+    assert first["counters"]["merges"] == first["counters"]["removed_particles"] == 5
+    assert first["counters"]["local_pairs"] >= first["counters"]["merges"]
+
+
+def test_multicore_counts_ipc_bytes():
+    sink = MemorySink()
+    engine = ArrayEngine(particle_number=10, force_generators=(Gravity(),), instrumentation=Instrumentation([sink]))
+    engine.run_multicore(2, max_turns=1)
+    assert sink.records[0]["counters"]["ipc_bytes"] == 10 * 3 * 8
+    assert "workers" in sink.records[0]["timings"]
+
+
+def test_engine_is_not_instrumented_by_default():
+    assert Engine(particle_number=2).instrumentation is NULL_INSTRUMENTATION
+
+
+def test_file_sinks(tmp_path):
+    csv_path, json_path = tmp_path / "profile.csv", tmp_path / "profile.jsonl"
+    instrumentation = Instrumentation([CsvSink(str(csv_path)), JsonLinesSink(str(json_path))])
+    with instrumentation.phase("pairs"):
+        instrumentation.count("pairs", 3)
+    instrumentation.end_turn()
+    instrumentation.close()
+    with open(csv_path) as file:
+        rows = list(csv.DictReader(file))
+    assert [(row["kind"], row["name"]) for row in rows] == [("timings", "pairs"), ("counters", "pairs")]
+    with open(json_path) as file:
+        assert json.loads(file.readline())["counters"] == {"pairs": 3}
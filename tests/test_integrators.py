@@ -0,0 +1,71 @@
+import numpy as np
+
+from newchanic.array_engine import ArrayEngine
+from newchanic.instrumentation import Instrumentation
+from newchanic.integrators import (
+    EulerIntegrator,
+    LeapfrogIntegrator,
+    BlockTimestepIntegrator,
+    Integrator,
+    compute_energy,
+)
+from newchanic.laws import Gravity
+from newchanic.solvers import DirectSolver
+
+
+def build_binary_engine(integrator: Integrator) -> ArrayEngine:
+    # An eccentric binary in close encounters, and distant light particles which barely feel any force
+    rng = np.random.default_rng(0)
+    masses = [100.0, 100.0] + [1.0] * 30
+    positions = [[-5.0, 0.0], [5.0, 0.0]] + (rng.uniform(-2000, 2000, (30, 2)) + [3000, 0]).tolist()
+    speed = 0.4 * np.sqrt(Gravity.g * 100 / 20)
+    velocities = [[0.0, -speed], [0.0, speed]] + [[0.0, 0.0]] * 30
+    return ArrayEngine(
+        particle_number=len(masses),
+        force_generators=(Gravity(),),
+        get_mass=lambda i: masses[i],
+        get_position=lambda i: positions[i],
+        get_velocity=lambda i: velocities[i],
+        integrator=integrator,
+        instrumentation=Instrumentation(),
+    )
+
+
+def run(integrator: Integrator, duration: float):
+    # Returns the largest relative energy error over the run and the number of computed accelerations
+    engine = build_binary_engine(integrator)
+    store = engine.store
+    initial_energy = compute_energy(store.masses, store.positions, store.velocities, Gravity.g)
+    error, force_evaluations = 0.0, 0
+    for _ in range(round(duration / integrator.dt)):
+        engine.run(max_turns=1)
+        force_evaluations += engine.instrumentation.last_record["counters"]["force_evaluations"]
+        energy = compute_energy(store.masses, store.positions, store.velocities, Gravity.g)
+        error = max(error, abs(energy - initial_energy) / abs(initial_energy))
+    return error, force_evaluations
+
+
+def test_euler_with_unit_timestep_is_the_default_scheme():
+    engines = [build_binary_engine(EulerIntegrator(1)), build_binary_engine(None)]
+    accelerations = DirectSolver().compute_accelerations(Gravity(), engines[0].store.masses, engines[0].store.positions)
+    expected_velocities = engines[0].store.velocities + accelerations
+    expected_positions = engines[0].store.positions + expected_velocities
+    for engine in engines:
+        engine.run(max_turns=1)
+        assert np.allclose(engine.store.velocities, expected_velocities)
+        assert np.allclose(engine.store.positions, expected_positions)
+
+
+def test_leapfrog_conserves_energy_better_than_euler():
+    euler_error, _ = run(EulerIntegrator(0.25), 100)
+    leapfrog_error, _ = run(LeapfrogIntegrator(0.25), 100)
+    assert leapfrog_error < euler_error / 3
+    # The accelerations of the end of a turn are reused by the next one: a single evaluation by turn
+    assert run(LeapfrogIntegrator(1), 10)[1] == 32 * 11
+
+
+def test_block_timesteps_need_fewer_force_evaluations():
+    leapfrog_error, leapfrog_evaluations = run(LeapfrogIntegrator(0.1), 100)
+    block_error, block_evaluations = run(BlockTimestepIntegrator(4, max_level=10, eta=0.01), 100)
+    assert block_error < leapfrog_error
+    assert block_evaluations < leapfrog_evaluations / 4
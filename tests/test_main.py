@@ -0,0 +1,14 @@
+import subprocess
+import sys
+
+from newchanic.__main__ import main
+
+
+def test_headless_run(capsys):
+    main(["--particles", "20", "--laws", "gravity", "merge", "--turns", "3", "--seed", "1"])
+    assert capsys.readouterr().out.startswith("3 turns in")
+
+
+def test_headless_run_does_not_import_pygame():
+    code = "import sys; from newchanic.__main__ import main; main(['--turns', '1']); assert 'pygame' not in sys.modules"
+    subprocess.run([sys.executable, "-c", code], check=True, capture_output=True)
@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+
+from newchanic.array_engine import ArrayEngine
+from newchanic.engine import Engine
+from newchanic.laws import Gravity
+
+from helpers import PairwiseGravity, build_random_engine, get_sorted_state
+
+
+@pytest.mark.parametrize("engine_type", [Engine, ArrayEngine])
+@pytest.mark.parametrize("force_generator", [Gravity(), PairwiseGravity()])
+def test_run_multicore_matches_run(engine_type, force_generator):
+    single_core = build_random_engine(engine_type, force_generator)
+    multicore = build_random_engine(engine_type, force_generator)
+    assert single_core.run(max_turns=2) == multicore.run_multicore(3, max_turns=2) == 2
+    assert np.allclose(get_sorted_state(single_core), get_sorted_state(multicore))
@@ -0,0 +1,52 @@
+import numpy as np
+
+from newchanic.engine import Engine
+from newchanic.laws import Gravity, Merge
+from newchanic.physics import Particle, PairGeometry
+from newchanic.utils import compute_multi_dimensional_distance
+
+
+def test_particle_position_is_updated_once_run():
+    position = [0.0, 1.0]
+    particle = Particle(1, position, [1.0, 2.0])
+    assert not hasattr(particle, "__dict__")
+    for turn in range(1, 4):
+        particle.run()
+        assert particle.get_pending_updates() == {"position": [turn, 1.0 + 2 * turn]}
+        assert particle.position == [turn - 1, 1.0 + 2 * (turn - 1)]
+        particle.update()
+        assert particle.position == [turn, 1.0 + 2 * turn]
+        assert particle.get_pending_updates() == {}
+    # The list given at creation is never used as a buffer
+    assert position == [0.0, 1.0]
+
+
+def test_delayed_updates_are_applied_by_update():
+    particle = Particle(1, [0.0], [0.0])
+    assert particle._next_values is None
+    particle.delay_update("_mass", 3)
+    assert particle.mass == 1
+    particle.update()
+    assert particle.mass == 3 and particle._next_values is None
+
+
+def test_pair_geometry_matches_numpy():
+    position_1, position_2 = [1.0, -2.0, 3.5, 0.25], [-4.0, 0.5, 1.0, 2.0]
+    geometry = PairGeometry.between(Particle(1, position_1, [0.0] * 4), Particle(1, position_2, [0.0] * 4))
+    distance = np.linalg.norm(np.subtract(position_1, position_2))
+    assert np.allclose(geometry.delta, np.subtract(position_1, position_2))
+    assert np.isclose(geometry.distance, distance) and np.isclose(geometry.inverse_distance, 1 / distance)
+    assert np.isclose(compute_multi_dimensional_distance(position_1, position_2), distance)
+    assert np.isclose(compute_multi_dimensional_distance([1.0], [-2.0]), 3)
+
+
+def test_pair_geometry_is_computed_once_for_all_the_laws(monkeypatch):
+    class GlobalMerge(Merge):
+        interaction_radius = None
+
+    built = []
+    between = PairGeometry.between.__func__
+    monkeypatch.setattr(PairGeometry, "between", classmethod(lambda cls, *args: built.append(1) or between(cls, *args)))
+    engine = Engine(particle_number=12, force_generators=(Gravity(), Gravity()), arbitrary_laws=(GlobalMerge(),))
+    engine.run(max_turns=1)
+    assert len(built) == 12 * 11 // 2
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from newchanic.array_engine import ArrayEngine
+from newchanic.initial_conditions import plummer_sphere
+from newchanic.instrumentation import Instrumentation
+from newchanic.laws import Gravity
+from newchanic.solvers import BarnesHutSolver
+
+from helpers import PairwiseGravity
+
+
+def assert_close_positions(expected, actual):
+    # Single precision rounds the positions to about 1e-7 of the size of the system
+    assert np.abs(expected - actual).max() < 1e-5 * np.abs(expected).max()
+
+
+def build_engine(dtype, force_generator=Gravity(), **kwargs):
+    return ArrayEngine(
+        initial_conditions=plummer_sphere(60, total_mass=1000, scale_radius=10, seed=0),
+        force_generators=(force_generator,),
+        dtype=dtype,
+        instrumentation=Instrumentation(),
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize(
+    "force_generator, solver", [(Gravity(), None), (Gravity(), BarnesHutSolver(0)), (PairwiseGravity(), None)]
+)
+def test_single_precision_forces_are_summed_in_double_precision(force_generator, solver):
+    double, single = build_engine(np.float64, force_generator), build_engine(np.float32, force_generator)
+    if solver is not None:
+        double.solver = single.solver = solver
+    assert single.store.positions.dtype == single.store.velocities.dtype == np.float32
+    accelerations = [engine.compute_accelerations() for engine in (double, single)]
+    assert accelerations[1].dtype == np.float64
+    # Only the rounding of the stored positions remains
+    errors = np.linalg.norm(accelerations[1] - accelerations[0], axis=1) / np.linalg.norm(accelerations[0], axis=1)
+    assert errors.max() < 1e-5
+    double.run(max_turns=5)
+    single.run(max_turns=5)
+    assert_close_positions(double.store.positions, single.store.positions)
+
+
+@pytest.mark.parametrize("parallel_method", ["run_multicore", "run_distributed"])
+def test_workers_exchange_single_precision_values(parallel_method):
+    exchanged_bytes = []
+    for dtype in (np.float64, np.float32):
+        single_node, parallel = build_engine(dtype), build_engine(dtype)
+        single_node.run(max_turns=2)
+        getattr(parallel, parallel_method)(2, max_turns=2)
+        assert parallel.store.positions.dtype == dtype
+        assert_close_positions(single_node.store.positions, parallel.store.positions)
+        exchanged_bytes.append(parallel.instrumentation.last_record["counters"]["ipc_bytes"])
+    assert exchanged_bytes[1] * 2 == exchanged_bytes[0]
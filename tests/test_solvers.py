@@ -0,0 +1,224 @@
+from random import seed, random
+
+import numpy as np
+import pytest
+
+from newchanic.array_engine import ArrayEngine
+from newchanic.engine import Engine
+from newchanic.laws import Gravity, Merge
+from newchanic.physics import Particle, uses_block_forces
+from newchanic.solvers import (
+    BarnesHutSolver,
+    DirectSolver,
+    ForceSolver,
+    ParticleMeshSolver,
+    compute_block_accelerations,
+    erfc,
+)
+from newchanic.v2 import engine as v2
+
+
+def clustered_system(particle_nbr: int, dimension_nbr: int):
+    rng = np.random.default_rng(42)
+    masses = rng.uniform(10, 100, particle_nbr)
+    positions = np.concatenate(
+        (
+            rng.normal(0, 50, (particle_nbr // 2, dimension_nbr)),
+            rng.normal(300, 80, (particle_nbr - particle_nbr // 2, dimension_nbr)),
+        )
+    )
+    return masses, positions
+
+
+@pytest.mark.parametrize("dimension_nbr", [2, 3, 4])
+def test_barnes_hut_matches_direct_summation(dimension_nbr):
+    masses, positions = clustered_system(2000, dimension_nbr)
+    exact = DirectSolver().compute_accelerations(Gravity(), masses, positions)
+    approximated = BarnesHutSolver(theta=0.5).compute_accelerations(Gravity(), masses, positions)
+    # The error of every particle stays below 1% of the median acceleration
+    errors = np.linalg.norm(approximated - exact, axis=1) / np.median(np.linalg.norm(exact, axis=1))
+    assert errors.max() < 1e-2
+
+
+def test_barnes_hut_without_opening_angle_is_exact():
+    masses, positions = clustered_system(500, 3)
+    exact = DirectSolver().compute_accelerations(Gravity(), masses, positions)
+    approximated = BarnesHutSolver(theta=0, leaf_size=4).compute_accelerations(Gravity(), masses, positions)
+    assert np.allclose(approximated, exact, rtol=1e-9, atol=0)
+
+
+def get_relative_errors(approximated, exact):
+    return np.linalg.norm(approximated - exact, axis=1) / np.linalg.norm(exact, axis=1)
+
+
+@pytest.mark.parametrize("dimension_nbr", [2, 3])
+def test_particle_mesh_matches_direct_summation(dimension_nbr):
+    rng = np.random.default_rng(0)
+    masses, positions = rng.uniform(10, 100, 2000), rng.uniform(-500, 500, (2000, dimension_nbr))
+    exact = DirectSolver().compute_accelerations(Gravity(), masses, positions)
+    mesh = ParticleMeshSolver(64).compute_accelerations(Gravity(), masses, positions)
+    p3m = ParticleMeshSolver(32, short_range=True).compute_accelerations(Gravity(), masses, positions)
+    # The mesh alone misses the forces below a few cells, which dominate in 2D, the short range correction restores them
+    if dimension_nbr == 3:
+        assert np.median(get_relative_errors(mesh, exact)) < 0.01
+    assert np.median(get_relative_errors(p3m, exact)) < 0.01
+    assert np.percentile(get_relative_errors(p3m, exact), 99) < 0.05
+
+
+@pytest.mark.parametrize("short_range", [False, True])
+def test_periodic_particle_mesh_attracts_through_the_faces(short_range):
+    solver = ParticleMeshSolver(32, "periodic", box_size=1000, box_origin=(-500, -500, -500), short_range=short_range)
+    masses = np.array([10.0, 10.0])
+    close = solver.compute_accelerations(Gravity(), masses, np.array([[-480.0, 0, 0], [400.0, 0, 0]]))
+    across = solver.compute_accelerations(Gravity(), masses, np.array([[-480.0, 0, 0], [480.0, 0, 0]]))
+    # The second particle is 120 away through the lower face in the first case, 40 in the second one
+    assert close[0, 0] < 0 and across[0, 0] < 0 and abs(across[0, 0]) > abs(close[0, 0])
+    assert np.allclose(close[0], -close[1]) and np.allclose(across[0], -across[1])
+    if short_range:
+        assert across[0, 0] == pytest.approx(-Gravity.g * 10 / 40 ** 2, rel=0.02)
+    # A regular lattice filling the box is at equilibrium
+    axis = np.arange(4) * 250 - 375.0
+    lattice = np.array(np.meshgrid(axis, axis, axis)).reshape(3, -1).T
+    assert np.abs(solver.compute_accelerations(Gravity(), np.ones(len(lattice)), lattice)).max() < 1e-12
+
+
+def test_erfc_approximation():
+    values = np.array([0, 0.1, 0.5, 1, 2, 4])
+    expected = [1, 0.8875370839817152, 0.4795001221869535, 0.15729920705028513, 0.004677734981047266, 1.541725790e-8]
+    assert np.allclose(erfc(values), expected, rtol=1.2e-7, atol=0)
+
+
+def test_solver_is_selected_per_engine():
+    class OneTurnArrayEngine(ArrayEngine):
+        def run_custom_engine_features(self):
+            self._keep_running = False
+
+    seed(3)
+    direct = OneTurnArrayEngine(particle_number=200, force_generators=(Gravity(),))
+    seed(3)
+    tree = OneTurnArrayEngine(particle_number=200, force_generators=(Gravity(),), solver=BarnesHutSolver(theta=0))
+    assert len(direct.solved_force_generators) == len(tree.solved_force_generators) == 1
+    assert not tree.pairwise_force_generators
+    direct.run()
+    tree.run()
+    assert np.allclose(direct.store.velocities, tree.store.velocities)
+
+
+class SoftenedGravity(Gravity):
+    # Only overrides the per pair method, the batch implementation of Gravity must not be used for it
+    def compute_force_from_geometry(self, particle, other_particle, geometry):
+        return super().compute_force_from_geometry(particle, other_particle, geometry)
+
+
+def test_gravity_block_forces_match_pair_forces():
+    masses, positions = clustered_system(60, 3)
+    particles = [Particle(mass, position, [0.0] * 3) for mass, position in zip(masses, positions.tolist())]
+    expected = np.zeros_like(positions)
+    for i, particle in enumerate(particles):
+        for other_particle in particles:
+            if other_particle is not particle:
+                # compute_force gives the force applied on its second particle
+                expected[i] += Gravity().compute_force(other_particle, particle)
+    forces = Gravity().compute_block_forces(masses[10:30], positions[10:30], masses, positions)
+    assert np.allclose(forces, expected[10:30], rtol=1e-9, atol=0)
+    assert uses_block_forces(Gravity()) and not uses_block_forces(SoftenedGravity())
+    accelerations = compute_block_accelerations((Gravity(),), masses, positions, block_size=100)
+    assert np.allclose(accelerations, expected / masses[:, np.newaxis])
+
+
+class NoSolver(ForceSolver):
+    def handles(self, force_generator):
+        return False
+
+
+@pytest.mark.parametrize("engine_type", [Engine, ArrayEngine])
+def test_engines_use_the_batch_protocol_when_implemented(engine_type):
+    def run(force_generator):
+        seed(5)
+        engine = engine_type(particle_number=40, force_generators=(force_generator,), solver=NoSolver())
+        engine.run(max_turns=3)
+        return engine
+
+    batch, pairwise = run(Gravity()), run(SoftenedGravity())
+    assert len(batch.batch_force_generators) == 1 and not batch.pairwise_force_generators
+    assert len(pairwise.pairwise_force_generators) == 1 and not pairwise.batch_force_generators
+    assert np.allclose(sorted(batch.get_state()[2].tolist()), sorted(pairwise.get_state()[2].tolist()))
+
+
+class ZeroGravity(Gravity):
+    # Laws written before the geometry entry points only override compute_force or apply
+    def compute_force(self, particle, other_particle):
+        return [0.0] * len(particle.position)
+
+
+class NoMerge(Merge):
+    def apply(self, particle, other_particle, engine):
+        return {"remove": set()}
+
+
+@pytest.mark.parametrize("engine_type", [Engine, ArrayEngine])
+def test_engines_respect_per_pair_overrides(engine_type):
+    seed(0)
+    engine = engine_type(
+        particle_number=30,
+        get_position=lambda _: [random() * 10, random() * 10, random() * 10],
+        force_generators=(ZeroGravity(),),
+        arbitrary_laws=(NoMerge(),),
+        solver=NoSolver(),
+    )
+    assert engine.pairwise_force_generators and not engine.batch_force_generators
+    engine.run(max_turns=3)
+    _, _, _, velocities = engine.get_state()
+    assert len(velocities) == 30 and not np.any(velocities)
+
+
+def test_v2_engine_uses_the_batch_protocol_when_implemented():
+    class PairwiseGravity(v2.Gravity):
+        def compute_force_intensity_from_interaction_between(self, particle_0, particle_1):
+            return super().compute_force_intensity_from_interaction_between(particle_0, particle_1)
+
+    class RecordingParticle(v2.Particle):
+        __slots__ = ("forces",)
+
+        def receive_force(self, force):
+            self.forces.append(force)
+
+    def run(law):
+        engine = v2.Engine()
+        engine.laws = [law]
+        for mass, position in zip(*clustered_system(30, 3)):
+            particle = RecordingParticle()
+            object.__setattr__(particle, "forces", [])
+            object.__setattr__(particle, "MASS", mass)
+            object.__setattr__(particle, "position", position.tolist())
+            engine.particles.append(particle)
+        engine.run(max_turns=1)
+        return np.array([np.sum(particle.forces, axis=0) for particle in engine.particles])
+
+    assert v2.uses_block_forces(v2.Gravity()) and not v2.uses_block_forces(PairwiseGravity())
+    assert np.allclose(run(v2.Gravity()), run(PairwiseGravity()))
+
+
+def test_v2_solver_does_not_replace_overridden_gravity():
+    class ZeroGravityV2(v2.Gravity):
+        def compute_force_intensity_from_interaction_between(self, particle_0, particle_1):
+            return 0.0
+
+    class RecordingParticle(v2.Particle):
+        __slots__ = ("forces",)
+
+        def receive_force(self, force):
+            self.forces.append(force)
+
+    engine = v2.Engine()
+    engine.solver = DirectSolver()
+    engine.laws = [ZeroGravityV2()]
+    assert engine.is_solved(v2.Gravity()) and not engine.is_solved(ZeroGravityV2())
+    for mass, position in zip(*clustered_system(20, 3)):
+        particle = RecordingParticle()
+        object.__setattr__(particle, "forces", [])
+        object.__setattr__(particle, "MASS", mass)
+        object.__setattr__(particle, "position", position.tolist())
+        engine.particles.append(particle)
+    engine.run(max_turns=1)
+    assert not np.any([particle.forces for particle in engine.particles])
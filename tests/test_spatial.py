@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+
+from newchanic.array_engine import ArrayEngine
+from newchanic.engine import Engine
+from newchanic.laws import Merge, Gravity
+from newchanic.physics import ForceGenerator
+from newchanic.solvers import DirectSolver
+from newchanic.spatial import SpatialHash, GridIndex, NeighbourList
+
+
+class CountingMerge(Merge):
+    def __init__(self):
+        self.calls = 0
+
+    def apply(self, particle, other_particle, engine):
+        self.calls += 1
+        return super().apply(particle, other_particle, engine)
+
+
+@pytest.mark.parametrize("dimension_nbr", [1, 2, 3])
+def test_candidate_pairs_match_brute_force(dimension_nbr):
+    positions = np.random.default_rng(0).uniform(-50, 50, (400, dimension_nbr))
+    first, second = SpatialHash(4).candidate_pairs(positions, radius=4)
+    found = {frozenset(pair) for pair in zip(first.tolist(), second.tolist())}
+    assert len(found) == len(first)
+    distances = np.linalg.norm(positions[:, np.newaxis] - positions[np.newaxis], axis=2)
+    expected = {frozenset((i, j)) for i, j in zip(*np.nonzero(distances < 4)) if i < j}
+    assert found == expected
+
+
+def test_merge_is_only_applied_to_close_pairs():
+    class OneTurnArrayEngine(ArrayEngine):
+        def run_custom_engine_features(self):
+            self._keep_running = False
+
+    merge = CountingMerge()
+    positions = [[0, 0, 0], [2, 0, 0], [50, 0, 0], [100, 0, 0], [200, 0, 0]]
+    engine = OneTurnArrayEngine(
+        particle_number=5, get_position=lambda i: positions[i], get_mass=lambda i: 10 + i, arbitrary_laws=(merge,)
+    )
+    engine.run()
+    assert merge.calls == 1
+    assert len(engine.particles) == 4
+
+
+def test_grid_index_queries_and_counts():
+    points = np.random.default_rng(0).uniform(-100, 100, size=(5000, 2))
+    index = GridIndex(points, resolution=64)
+    lower, upper = np.array([-30.0, 10.0]), np.array([25.0, 60.0])
+    inside = set(np.flatnonzero(np.all((points >= lower) & (points <= upper), axis=1)).tolist())
+    found = index.query(lower, upper)
+    assert inside <= set(found.tolist())
+    assert len(found) == len(set(found.tolist())) == index.count(lower, upper)
+    assert index.count(np.array([200.0, 200.0]), np.array([300.0, 300.0])) == 0
+
+
+@pytest.mark.parametrize("scale", [0.1, 1, 10])
+def test_grid_index_density_sums_to_the_point_count(scale):
+    points = np.random.default_rng(1).normal(size=(20000, 2)) * 50
+    index = GridIndex(points, resolution=256)
+    lower, upper = np.array([-400.0, -300.0]) * scale, np.array([400.0, 300.0]) * scale
+    density = index.density(lower, upper, (160, 120))
+    assert density.shape == (160, 120)
+    exact = np.all((points >= lower) & (points < upper), axis=1).sum()
+    assert density.sum() == pytest.approx(exact, rel=0.05)
+
+
+class SoftRepulsion(ForceGenerator):
+    cutoff_radius = 5.0
+
+    def __init__(self):
+        self.calls = 0
+
+    def compute_force(self, particle, other_particle):
+        self.calls += 1
+        delta = np.asarray(particle.position) - np.asarray(other_particle.position)
+        distance = np.linalg.norm(delta)
+        if distance >= 5.0:
+            return [0.0] * len(delta)
+        return (delta * (5.0 - distance) / distance).tolist()
+
+
+class GlobalSoftRepulsion(SoftRepulsion):
+    cutoff_radius = None
+
+
+def test_neighbour_list_is_rebuilt_once_a_particle_moved_by_half_the_skin():
+    positions = np.random.default_rng(0).uniform(-50, 50, (300, 2))
+    neighbour_list = NeighbourList(cutoff=4, skin=2)
+    first, second = neighbour_list.get_pairs(positions)
+    distances = np.linalg.norm(positions[first] - positions[second], axis=1)
+    assert distances.max() < 6 and neighbour_list.rebuilds == 1
+    positions[0, 0] += 0.9
+    neighbour_list.get_pairs(positions)
+    assert neighbour_list.rebuilds == 1
+    positions[0, 0] += 0.2
+    neighbour_list.get_pairs(positions)
+    assert neighbour_list.rebuilds == 2
+    neighbour_list.get_pairs(positions[1:])
+    assert neighbour_list.rebuilds == 3
+
+
+@pytest.mark.parametrize("engine_type", [Engine, ArrayEngine])
+def test_short_range_force_generators_match_all_pairs(engine_type):
+    rng = np.random.default_rng(1)
+    positions = rng.uniform(-60, 60, (200, 2)).tolist()
+
+    def run(repulsion: SoftRepulsion) -> np.ndarray:
+        engine = engine_type(
+            particle_number=200,
+            get_mass=lambda i: 10,
+            get_position=lambda i: list(positions[i]),
+            get_velocity=lambda i: [0.0, 0.0],
+            force_generators=(Gravity(), repulsion),
+            solver=DirectSolver(),
+        )
+        engine.run(max_turns=5)
+        return np.array(sorted(engine.get_state()[2].tolist()))
+
+    short_range, all_pairs = SoftRepulsion(), GlobalSoftRepulsion()
+    assert np.allclose(run(short_range), run(all_pairs))
+    # Only the neighbours are evaluated, the long-range gravity still acts on every pair
+    assert short_range.calls < all_pairs.calls / 20
@@ -0,0 +1,139 @@
+import base64
+import socket
+import struct
+from threading import Thread
+from time import sleep, monotonic
+
+import numpy as np
+import pytest
+
+from newchanic.array_engine import ArrayEngine
+from newchanic.engine import Engine, Feature
+from newchanic.streaming import (
+    StreamingServer,
+    StreamDecoder,
+    encode_frame,
+    quantize,
+    iter_stream,
+)
+
+from helpers import build_merging_pairs_engine
+
+
+class CapturedStates(Feature[None]):
+    # Copies the state seen by the features which run after this one
+    def __init__(self, states):
+        self.states = states
+
+    def __call__(self, engine):
+        particles, _, positions, _ = engine.get_state()
+        self.states.append(([particle.id for particle in particles], np.array(positions, dtype=float)))
+
+
+def wait_for(condition, timeout=10):
+    deadline = monotonic() + timeout
+    while not condition():
+        assert monotonic() < deadline, "Timed out"
+        sleep(0.01)
+
+
+def test_delta_frames_rebuild_the_quantized_states():
+    rng = np.random.default_rng(0)
+    ids = np.arange(1000)
+    positions = rng.uniform(-1000, 1000, (1000, 3))
+    states = [quantize(0, ids, positions, 0.01)]
+    # Particles move, some are removed and others are added, given out of order
+    positions = positions + rng.uniform(-1, 1, positions.shape)
+    kept = rng.uniform(size=1000) > 0.1
+    states.append(
+        quantize(1, np.concatenate((ids[kept], [2000, 1500])), np.concatenate((positions[kept], [[1, 2, 3]] * 2)), 0.01)
+    )
+    keyframe, delta = encode_frame(states[0], None, 0.01), encode_frame(states[1], states[0], 0.01)
+    # The moves of less than 1.28 resolution units fit in 16 bits instead of the 32 of the positions
+    assert len(delta) < 0.6 * len(keyframe)
+    decoder = StreamDecoder()
+    first, second = decoder.decode(keyframe), decoder.decode(delta)
+    assert first.turn == 0 and second.turn == 1
+    assert np.array_equal(second.ids, np.sort(np.concatenate((ids[kept], [1500, 2000]))))
+    assert np.abs(second.positions[: kept.sum()] - positions[kept]).max() <= 0.005 + 1e-9
+    assert np.array_equal(second.positions[-2:], [[1, 2, 3]] * 2)
+
+
+@pytest.mark.parametrize("engine_type", [Engine, ArrayEngine])
+def test_clients_receive_every_turn(engine_type):
+    engine = build_merging_pairs_engine(engine_type)
+    states = []
+    engine.features["capture"] = CapturedStates(states)
+    with StreamingServer(max_fps=0, keyframe_every=2) as server:
+        engine.features["stream"] = server
+        frames = iter_stream(*server.address, timeout=10)
+        wait_for(lambda: server.client_nbr == 1)
+        for turn in range(4):
+            engine.run(max_turns=1)
+            frame = next(frames)
+            ids, positions = states[-1]
+            assert frame.turn == turn
+            assert list(frame.ids) == ids
+            assert np.abs(frame.positions - positions).max() <= 0.005 + 1e-9
+        # The merges of the second turn removed half of the particles
+        assert len(frame.ids) == 5
+    wait_for(lambda: server.client_nbr == 0)
+
+
+def test_slow_clients_do_not_block_the_engine():
+    engine = ArrayEngine(particle_number=20000, force_generators=())
+    with StreamingServer(max_fps=0) as server:
+        engine.features["stream"] = server
+        # This client never reads, its frames of 320 kB fill the socket buffers at once
+        slow = socket.create_connection(server.address)
+        slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        slow.sendall(b"NWCSTR01")
+        frames = []
+        stream = iter_stream(*server.address, timeout=10)
+        reader = Thread(target=lambda: frames.extend(stream), daemon=True)
+        reader.start()
+        wait_for(lambda: server.client_nbr == 2)
+        start = monotonic()
+        engine.run(max_turns=50)
+        assert monotonic() - start < 10
+        # The other client gets the last turn, skipping the frames published while it was busy
+        wait_for(lambda: frames and frames[-1].turn == 49)
+        assert len(frames) <= 50
+        slow.close()
+    reader.join(10)
+    assert not reader.is_alive()
+
+
+def test_websocket_clients():
+    engine = build_merging_pairs_engine(ArrayEngine)
+    with StreamingServer(max_fps=0) as server:
+        engine.features["stream"] = server
+        with socket.create_connection(server.address, timeout=10) as connection:
+            # Handshake example of RFC 6455
+            key = base64.b64encode(b"the sample nonce").decode()
+            connection.sendall(
+                (
+                    "GET /stream HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                    f"Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n"
+                ).encode()
+            )
+            stream = connection.makefile("rb")
+            response = b""
+            while not response.endswith(b"\r\n\r\n"):
+                response += stream.readline()
+            assert response.startswith(b"HTTP/1.1 101")
+            assert b"Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=" in response
+            wait_for(lambda: server.client_nbr == 1)
+            engine.run(max_turns=1)
+            opcode, size = stream.read(2)
+            assert opcode == 0x82 and size == 126
+            (size,) = struct.unpack("!H", stream.read(2))
+            frame = StreamDecoder().decode(stream.read(size))
+            assert frame.turn == 0 and len(frame.ids) == 10
+
+
+def test_unknown_protocols_are_closed():
+    with StreamingServer() as server:
+        with socket.create_connection(server.address, timeout=10) as connection:
+            connection.sendall(b"HELLO")
+            assert connection.recv(1) == b""
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from newchanic.array_engine import ArrayEngine
+from newchanic.engine import Engine
+from newchanic.laws import Gravity
+from newchanic.trajectory import TrajectoryRecorder, TrajectoryReader
+
+from helpers import build_merging_pairs_engine
+
+
+@pytest.mark.parametrize("engine_type", [Engine, ArrayEngine])
+def test_recorded_frames_and_removals(engine_type, tmp_path):
+    path = str(tmp_path / "run.trj")
+    engine = build_merging_pairs_engine(engine_type)
+    with TrajectoryRecorder(path, record_masses=True, record_velocities=True, dtype=np.float64) as recorder:
+        engine.features["record"] = recorder
+        engine.run(max_turns=3)
+    reader = TrajectoryReader(path)
+    assert len(reader) == 3
+    assert list(reader.turns) == [0, 1, 2]
+    first, last = reader[0], reader[2]
+    assert list(first.ids) == list(range(10)) and first.velocities.shape == (10, 3)
+    assert list(reader.removals) == [1]
+    assert sorted(reader.removals[1].tolist() + reader[1].ids.tolist()) == list(range(10))
+    particles, masses, positions, velocities = engine.get_state()
+    order = np.argsort(masses)
+    assert np.allclose(np.sort(last.masses), masses[order])
+    # The last frame is recorded before the positions of the last turn are updated
+    assert np.allclose(last.positions[np.argsort(last.masses)], (positions - velocities)[order])
+
+
+def test_interrupted_recording_is_readable(tmp_path):
+    path = tmp_path / "run.trj"
+    with TrajectoryRecorder(str(path), every=2) as recorder:
+        engine = Engine(particle_number=4, force_generators=(Gravity(),))
+        engine.features["record"] = recorder
+        engine.run(max_turns=5)
+    path.write_bytes(path.read_bytes()[:-10])
+    reader = TrajectoryReader(str(path))
+    assert list(reader.turns) == [0, 2]
+    assert reader[1].positions.dtype == np.float32
+    assert reader.seek(3) == 1 and reader.seek(0) == 0
+
+
+def test_replay(tmp_path, monkeypatch):
+    monkeypatch.setenv("SDL_VIDEODRIVER", "dummy")
+    from newchanic.graphical_engine import GraphicalReplay2D
+
+    path = str(tmp_path / "run.trj")
+    with TrajectoryRecorder(path) as recorder:
+        engine = build_merging_pairs_engine(ArrayEngine)
+        engine.features["record"] = recorder
+        engine.run(max_turns=4)
+    replay = GraphicalReplay2D(path, graphical_options={"window_size": (200, 100)})
+    assert replay.run(max_turns=10) == 10
+    assert replay.frame_index == 3
+    replay.seek(-2)
+    assert replay.frame_index == 1
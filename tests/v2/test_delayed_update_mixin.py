@@ -28,3 +28,18 @@ def test_particle_delayed_update():
     assert p.MASS == 0
     p.update()
     assert p.MASS == 8
+
+
+def test_particle_is_double_buffered():
+    p = Particle()
+    assert not hasattr(p, "__dict__")
+    assert p.position is p._position
+    p.position = [1.0, 2.0]
+    p._speed = [0.5, 0.5]
+    assert p.position == [] and p._speed == []
+    p.update()
+    assert p.position == [1.0, 2.0] and p._speed == [0.5, 0.5]
+    p.update()
+    assert p.position == [1.0, 2.0]
+    with pytest.raises(AttributeError):
+        p.unknown = 1